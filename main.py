@@ -1,16 +1,10 @@
-
-from proc_metrics_collector import ProcMetricsCollector
-from proc_task_executor import ProcTaskExecutor
+from proc_supervisor import ProcSupervisor
 
 
 def main():
-    # ToDo: Each func should start by single process or thread
-    # ProcMetricsCollector().start()
-    ProcTaskExecutor().start()
+    # The collector and the executor run side by side, each sharded over worker processes, see proc_supervisor_cfg.yaml
+    ProcSupervisor().start()
 
 
 if __name__ == '__main__':
     main()
-
-
-
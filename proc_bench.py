@@ -0,0 +1,397 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import shlex
+import socket
+import random
+import argparse
+import resource
+import threading
+import contextlib
+import multiprocessing
+import paramiko
+
+from proc_metrics_collector import ProcMetricsCollectorCfgMgr, ProcMetricsCollector
+from proc_task_executor import ProcTaskExecutor
+from utils import UtilsSSHConnPool, logger_for_proc_metrics_collector, logger_for_proc_task_executor
+
+
+PROC_BENCH_TOP = ('Mem: {used}K used, {free}K free, 0K shrd, 0K buff, 100K cached\n'
+                  'CPU:  1% usr  1% sys  0% nic 97% idle  0% io  0% irq  0% sirq\n'
+                  'Load average: 0.10 0.20 0.30 1/100 {pid}\n'
+                  '  PID  PPID USER     STAT   VSZ %VSZ CPU %CPU COMMAND\n')
+PROC_BENCH_TOP_PROC = ' {pid}     1 root     S     {vsz}m{vsz_pct:.1f}   1  12.5 {command}\n'
+PROC_BENCH_TOP_TAIL = ('   77     1 root     S     998m 54.6   0   1.0 gdb {command}\n'
+                       '    1     0 root     S     2000  0.1   0   0.0 init\n')
+
+PROC_BENCH_BATCH_MARKER = re.compile(r'__PROC_OPS_[0-9a-f]+__')
+PROC_BENCH_BATCH_COMMAND = re.compile(r'^\( eval (.*) \)$', re.MULTILINE)
+
+PROC_BENCH_SCENARIOS = ('normal', 'valgrind', 'crash', 'leak')
+
+
+class ProcBenchHost:
+    # Canned answers of one simulated board, leak hosts lose free memory at a steady rate from the fleet start
+    def __init__(self, p_ip, p_scenario, p_pid, p_start, p_normal_command, p_valgrind_prefix):
+        self.ip = p_ip
+        self.scenario = p_scenario
+        self.pid = p_pid
+        self.start = p_start
+        self.normal_command = p_normal_command
+        self.valgrind_prefix = p_valgrind_prefix
+
+    def mem_ram_free(self):
+        if self.scenario == 'leak':
+            return max(0, 300000 - int((time.time() - self.start) * 500))
+        return 60000
+
+    def top(self):
+        free = self.mem_ram_free()
+        ret_stdout = PROC_BENCH_TOP.format(used=1000000 - free, free=free, pid=self.pid)
+        if self.scenario == 'crash':
+            return ret_stdout + PROC_BENCH_TOP_TAIL.format(command=self.normal_command)
+        command = f'{self.valgrind_prefix} {self.normal_command}' if self.scenario in ('valgrind', 'leak') else self.normal_command
+        return ret_stdout + PROC_BENCH_TOP_PROC.format(pid=self.pid, vsz=1222, vsz_pct=149.9, command=command) + PROC_BENCH_TOP_TAIL.format(command=self.normal_command)
+
+    def proc_probe(self):
+        if self.scenario == 'crash':
+            return ''
+        ticks = int((time.time() - self.start) * 100)
+        comm = os.path.basename(self.normal_command)[:15]
+        return (f'{self.pid} ({comm}) S 1 {self.pid} {self.pid} 0 -1 4194560 0 0 0 0 {ticks // 8} {ticks // 16} 0 0 20 0 1 0 0 1251328000 0\n'
+                f'Name:\t{comm}\nVmSize:\t 1251328 kB\n'
+                f'cpu  {ticks} 0 {ticks} {ticks * 2} 0 0 0 0 0 0\n'
+                f'MemFree:        {self.mem_ram_free()} kB\n')
+
+
+class ProcBenchServer(paramiko.ServerInterface):
+    def __init__(self, p_fleet, p_host):
+        self.fleet = p_fleet
+        self.host = p_host
+
+    def check_auth_password(self, p_username, p_password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, p_username):
+        return 'password'
+
+    def check_channel_request(self, p_kind, p_chanid):
+        return paramiko.OPEN_SUCCEEDED if p_kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, p_channel, p_command):
+        threading.Thread(target=self.fleet.handle_command, args=(self.host, p_channel, p_command.decode('utf-8')), daemon=True).start()
+        return True
+
+
+class ProcBenchFleet:
+    # One paramiko server for every simulated host, hosts are loopback addresses 127.x.y.z and told apart by the
+    # local address of the accepted socket (Linux routes the whole 127.0.0.0/8 to lo)
+    def __init__(self, p_host_cnt, p_port=0, p_connect_latency=0.0, p_command_latency=0.0, p_fail_rate=0.0, p_timeout_rate=0.0,
+                 p_command_fail_rate=0.0, p_scenarios=None, p_seed=0, p_normal_command='./kvm4', p_valgrind_prefix='{memcheck-arm-li}'):
+        self.port = p_port
+        self.connect_latency = p_connect_latency        # second before the server banner
+        self.command_latency = p_command_latency        # second before every command answers
+        self.fail_rate = p_fail_rate                    # share of connects reset at once
+        self.timeout_rate = p_timeout_rate              # share of connects left silent until the client gives up
+        self.command_fail_rate = p_command_fail_rate    # share of generic commands exiting 1
+        self.random = random.Random(p_seed)
+
+        # Scenario shares, the rest of the hosts run normal
+        scenarios = p_scenarios or {}
+        start = time.time()
+        self.hosts = {}
+        for cur_index in range(p_host_cnt):
+            draw, scenario = self.random.random(), 'normal'
+            for cur_scenario in PROC_BENCH_SCENARIOS[1:]:
+                draw -= scenarios.get(cur_scenario, 0)
+                if draw < 0:
+                    scenario = cur_scenario
+                    break
+            ip = f'127.{1 + cur_index // (254 * 256)}.{cur_index // 254 % 256}.{1 + cur_index % 254}'
+            self.hosts[ip] = ProcBenchHost(ip, scenario, 1000 + cur_index, start, p_normal_command, p_valgrind_prefix)
+
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self._socket = None
+        self._lock = threading.Lock()
+
+    @property
+    def ips(self):
+        return list(self.hosts)
+
+    def scenario_counts(self):
+        ret_counts = {cur_scenario: 0 for cur_scenario in PROC_BENCH_SCENARIOS}
+        for cur_host in self.hosts.values():
+            ret_counts[cur_host.scenario] += 1
+        return ret_counts
+
+    def _draw(self, p_rate):
+        with self._lock:
+            return self.random.random() < p_rate
+
+    def _answer(self, p_host, p_command):
+        # -> (stdout, exit status) of one command
+        if p_command.startswith('top'):
+            return p_host.top(), 0
+        if p_command.startswith('cat /proc/'):
+            stdout = p_host.proc_probe()
+            return stdout, 0 if stdout else 1
+        if p_command.startswith('pidof'):
+            return ('', 1) if p_host.scenario == 'crash' else (f'{p_host.pid}\n', 0)
+        if p_command.startswith('kill'):
+            return '', 0
+        return ('', 1) if self._draw(self.command_fail_rate) else (f'{p_command}\n', 0)
+
+    def _answer_batch(self, p_host, p_script):
+        # Same stdout/stderr layout as the script built by ProcTaskWorker._build_batch_script
+        marker = PROC_BENCH_BATCH_MARKER.search(p_script).group()
+        stdout, stderr, exit_status = [], [], 0
+        for cur_index, cur_quoted in enumerate(PROC_BENCH_BATCH_COMMAND.findall(p_script)):
+            output, exit_status = self._answer(p_host, shlex.split(cur_quoted)[0])
+            stdout.append(f'{output}\n{marker} {cur_index} {exit_status}\n')
+            stderr.append(f'\n{marker} {cur_index}\n')
+            if exit_status != 0:
+                break
+        return ''.join(stdout), ''.join(stderr), exit_status
+
+    def handle_command(self, p_host, p_channel, p_command):
+        try:
+            if self.command_latency:
+                time.sleep(self.command_latency)
+            if p_command.startswith('sh -c '):
+                stdout, stderr, exit_status = self._answer_batch(p_host, shlex.split(p_command)[2])
+            else:
+                (stdout, exit_status), stderr = self._answer(p_host, p_command), ''
+            p_channel.sendall(stdout.encode('utf-8'))
+            if stderr:
+                p_channel.sendall_stderr(stderr.encode('utf-8'))
+            p_channel.send_exit_status(exit_status)
+            # EOF instead of close, a close may overtake the reply to the exec request and fail exec_command on the
+            # client, the client closes the channel once it is done with it
+            p_channel.shutdown_write()
+        except Exception:
+            p_channel.close()    # the client went away
+
+    def _handle_connection(self, p_socket):
+        host = self.hosts.get(p_socket.getsockname()[0])
+        if (host is None) or self._draw(self.fail_rate):
+            p_socket.close()
+            return
+        if self._draw(self.timeout_rate):
+            # Hold the connection without a banner until the client closes it
+            with contextlib.suppress(OSError):
+                while p_socket.recv(4096):
+                    pass
+            p_socket.close()
+            return
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        transport = paramiko.Transport(p_socket)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=ProcBenchServer(self, host))
+        except Exception:
+            transport.close()
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('0.0.0.0', self.port))
+        self._socket.listen(4096)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self.port
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._socket.accept()
+            except OSError:
+                return    # closed by stop()
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def proc_bench_fleet_process(p_fleet, p_port_queue):
+    # Entry of the fleet child process, lives until the parent terminates it
+    p_port_queue.put(p_fleet.start())
+    threading.Event().wait()
+
+
+def proc_bench_percentiles(p_values):
+    if not p_values:
+        return None
+    values = sorted(p_values)
+
+    def closure_at(p_pct):
+        return round(values[min(len(values) - 1, int(p_pct / 100 * len(values)))], 6)
+    return {'p50': closure_at(50), 'p90': closure_at(90), 'p99': closure_at(99), 'max': round(values[-1], 6), 'mean': round(sum(values) / len(values), 6)}
+
+
+class ProcBenchUsage:
+    # CPU seconds and peak RSS of this process over one phase, the fleet child is not counted
+    def __enter__(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *p_exc_info):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = usage.ru_utime + usage.ru_stime - self.cpu
+        self.wall = time.perf_counter() - self.wall
+        self.peak_rss_mb = round(usage.ru_maxrss / 1024, 1)    # ru_maxrss is in KB on Linux
+
+    def report(self, p_hosts_done):
+        return {'seconds': round(self.wall, 3),
+                'hosts_per_second': round(p_hosts_done / self.wall, 1) if self.wall else None,
+                'cpu_seconds': round(self.cpu, 3),
+                'cpu_ms_per_host': round(self.cpu * 1000 / p_hosts_done, 3) if p_hosts_done else None,
+                'peak_rss_mb': self.peak_rss_mb}
+
+
+def proc_bench_collector(p_ips, p_port, p_seconds, p_max_conns):
+    # The shipped poll loop of start() with the scheduler of the config for p_seconds of wall time, without the file
+    # reload, the endpoint and the history file, the stream mode has no per host round trip to time
+    collector = ProcMetricsCollector()
+    cfg_mgr = collector.cfg_mgr
+    cfg_mgr.ips_of_proc = list(p_ips)
+    cfg_mgr.collect_mode, cfg_mgr.reload_interval, cfg_mgr.metrics_port, cfg_mgr.history_flush_file = 'poll', 0, 0, ''
+    collector.ssh_pool.close_all()
+    collector.ssh_pool = UtilsSSHConnPool(cfg_mgr.username, cfg_mgr.password, logger_for_proc_metrics_collector, p_port=p_port,
+                                          p_connect_timeout=cfg_mgr.connect_timeout, p_keepalive_interval=cfg_mgr.ssh_keepalive_interval,
+                                          p_idle_timeout=cfg_mgr.ssh_idle_timeout, p_health_check_idle=cfg_mgr.ssh_health_check_idle,
+                                          p_max_conns=p_max_conns or cfg_mgr.ssh_max_conns, p_name='proc_bench_collector')
+
+    # Per sample: start behind its due time, then connect to last log line
+    lag_seconds, host_seconds = [], []
+    collect_host = collector._collect_host
+
+    def closure_collect_host(p_proc_metric, p_due=None):
+        begin = time.monotonic()
+        collect_host(p_proc_metric, p_due)
+        lag_seconds.append(max(begin - p_due, 0) if p_due is not None else 0.0)
+        host_seconds.append(time.monotonic() - begin)
+    collector._collect_host = closure_collect_host
+
+    timer = threading.Timer(p_seconds, collector.stop)
+    with ProcBenchUsage() as usage:
+        timer.start()
+        collector.start()
+    timer.cancel()
+
+    statuses = {}
+    for cur_proc_metric in collector.proc_metrics.values():
+        statuses[cur_proc_metric.proc_status.value] = statuses.get(cur_proc_metric.proc_status.value, 0) + 1
+    ret_report = {'seconds_target': p_seconds, 'hosts': len(collector.proc_metrics), 'samples': len(host_seconds), 'max_concurrency': cfg_mgr.max_concurrency,
+                  'probe_mode': cfg_mgr.prompt_misc.probe_type.value, 'collect_interval': cfg_mgr.collect_interval,
+                  'sched_interval': [cfg_mgr.sched_min_interval, cfg_mgr.sched_max_interval]}
+    ret_report.update(usage.report(len(host_seconds)))
+    ret_report.update({'lag_seconds': proc_bench_percentiles(lag_seconds), 'host_seconds': proc_bench_percentiles(host_seconds), 'last_statuses': statuses})
+    return ret_report
+
+
+def proc_bench_executor(p_ips, p_port, p_rounds, p_max_conns):
+    executor = ProcTaskExecutor()
+    cfg_mgr = executor.cfg_mgr
+    cfg_mgr.ips_of_proc, cfg_mgr.ip_groups, cfg_mgr.results_dir = list(p_ips), {}, ''
+    executor.ssh_pool.close_all()
+    executor.ssh_pool = UtilsSSHConnPool(cfg_mgr.username, cfg_mgr.password, logger_for_proc_task_executor, p_port=p_port,
+                                         p_connect_timeout=cfg_mgr.connect_timeout, p_keepalive_interval=cfg_mgr.ssh_keepalive_interval,
+                                         p_idle_timeout=cfg_mgr.ssh_idle_timeout, p_health_check_idle=cfg_mgr.ssh_health_check_idle,
+                                         p_max_conns=p_max_conns or cfg_mgr.ssh_max_conns, p_name='proc_bench_executor')
+
+    # Time from the start of a run to each host result, the results arrive through the callback of the master
+    result_seconds, run_begin = [], [0.0]
+    log_result = executor._log_result
+
+    def closure_log_result(p_result):
+        result_seconds.append(time.perf_counter() - run_begin[0])
+        log_result(p_result)
+    executor._log_result = closure_log_result
+
+    run_seconds, hosts_done, success_cnt = [], 0, 0
+    with ProcBenchUsage() as usage:
+        for _ in range(p_rounds):
+            run_begin[0] = time.perf_counter()
+            results = executor.start(f'bench_{uuid.uuid4().hex[:8]}')
+            run_seconds.append(time.perf_counter() - run_begin[0])
+            hosts_done += len(results)
+            success_cnt += sum(1 for cur_result in results.values() if cur_result['success'])
+    executor.stop()
+
+    ret_report = {'rounds': p_rounds, 'hosts': len(p_ips), 'engine': cfg_mgr.engine, 'batch_mode': cfg_mgr.batch_mode, 'max_concurrency': cfg_mgr.max_concurrency,
+                  'tasks': len(cfg_mgr.tasks)}
+    ret_report.update(usage.report(hosts_done))
+    ret_report.update({'run_seconds': proc_bench_percentiles(run_seconds), 'host_result_seconds': proc_bench_percentiles(result_seconds),
+                       'success_rate': round(success_cnt / hosts_done, 4) if hosts_done else None})
+    return ret_report
+
+
+def main():
+    # Drive the collector loop and the task executor runs against a simulated fleet, print a JSON report to compare runs
+    parser = argparse.ArgumentParser(description='Benchmark proc_metrics_collector and proc_task_executor against a fake SSH fleet')
+    parser.add_argument('--hosts', type=int, default=200, help='simulated hosts, 127.x.y.z loopback addresses')
+    parser.add_argument('--seconds', type=float, default=120, help='wall time of the collector on its shipped schedule, at least a few collect_interval')
+    parser.add_argument('--rounds', type=int, default=3, help='executor runs')
+    parser.add_argument('--targets', default='collector,executor', help='comma separated: collector, executor')
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='second before the server banner')
+    parser.add_argument('--command-latency', type=float, default=0.0, help='second before every command answers')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of connects reset at once')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='share of connects never answered, the client waits connect_timeout')
+    parser.add_argument('--command-fail-rate', type=float, default=0.0, help='share of executor commands exiting 1')
+    parser.add_argument('--valgrind', type=float, default=0.1, help='share of hosts running the process under valgrind')
+    parser.add_argument('--crash', type=float, default=0.05, help='share of hosts without the process')
+    parser.add_argument('--leak', type=float, default=0.05, help='share of valgrind hosts losing free memory steadily')
+    parser.add_argument('--max-conns', type=int, default=0, help='ssh pool cap, 0 keeps the value of the config')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--inline-fleet', action='store_true', help='serve the fleet from threads of this process, its cost is then measured too')
+    parser.add_argument('--output', default='', help='write the report here instead of stdout')
+    args = parser.parse_args()
+
+    collector_cfg = ProcMetricsCollectorCfgMgr()
+    fleet = ProcBenchFleet(args.hosts, 0, args.connect_latency, args.command_latency, args.fail_rate, args.timeout_rate, args.command_fail_rate,
+                           {'valgrind': args.valgrind, 'crash': args.crash, 'leak': args.leak}, args.seed,
+                           collector_cfg.prompt_misc.normal_includes[-1], collector_cfg.prompt_misc.valgrind_includes[0])
+    fleet_process = None
+    if args.inline_fleet:
+        port = fleet.start()
+    else:
+        port_queue = multiprocessing.Queue()
+        fleet_process = multiprocessing.Process(target=proc_bench_fleet_process, args=(fleet, port_queue), daemon=True)
+        fleet_process.start()
+        port = port_queue.get(timeout=60)
+
+    report = {'ts': time.time(), 'python': sys.version.split()[0], 'cpu_count': os.cpu_count(),
+              'fleet': {'hosts': len(fleet.hosts), 'scenarios': fleet.scenario_counts(), 'inline': args.inline_fleet, 'connect_latency': args.connect_latency,
+                        'command_latency': args.command_latency, 'fail_rate': args.fail_rate, 'timeout_rate': args.timeout_rate, 'command_fail_rate': args.command_fail_rate}}
+    targets = [cur_target.strip() for cur_target in args.targets.split(',') if cur_target.strip()]
+    try:
+        # Keep stdout for the report alone
+        with contextlib.redirect_stdout(sys.stderr):
+            if 'collector' in targets:
+                report['collector'] = proc_bench_collector(fleet.ips, port, args.seconds, args.max_conns)
+            if 'executor' in targets:
+                report['executor'] = proc_bench_executor(fleet.ips, port, args.rounds, args.max_conns)
+    finally:
+        if fleet_process is not None:
+            fleet_process.terminate()
+        fleet.stop()
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
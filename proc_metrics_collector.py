@@ -1,12 +1,24 @@
 
 import os
 import time
+import uuid
 import yaml
+import selectors
 import enum
+import heapq
 import numpy
-import paramiko
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from utils import logger_for_proc_metrics_collector as cur_logger, utils_execute_cmd_by_ssh
+from utils import logger_for_proc_metrics_collector as cur_logger, utils_execute_cmd_by_ssh, UTILS_SSH_CMD_ERRORS, UtilsSSHConnPool, utils_result_cache, utils_metrics, utils_metrics_serve, utils_log_limiter
+from utils import UTILS_SHARD_PORT_STRIDE, utils_shard_ips
+from proc_top_parser import ProcTopMatcher, ProcTopRecorder
+from proc_metrics_history import ProcMetricsHistory, proc_metrics_leak_trend
+
+
+PROC_METRICS_SUMMARY_HOSTS = 20    # hosts named per list in the text of the round summary
+PROC_METRICS_HISTOGRAM_X = [0, 1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 500, 1000, 999999]    # bins of pid changes per host
 
 
 class ProcLaunchType(enum.Enum):
@@ -22,8 +34,23 @@ class ProcStatusType(enum.Enum):
     CRASH = 'Crash'
 
 
+PROC_STATUS_CODES = {ProcStatusType.UNKNOWN: 0, ProcStatusType.NORMAL: 1, ProcStatusType.DISCONN: 2, ProcStatusType.CRASH: 3}
+
+utils_metrics.describe('proc_ops_collect_phase_seconds', 'histogram', 'Collector latency per phase: parse, log')
+utils_metrics.describe('proc_ops_collect_host_seconds', 'histogram', 'Time to sample one host, connect to last log line')
+utils_metrics.describe('proc_ops_collect_samples_total', 'counter', 'Samples taken per status')
+utils_metrics.describe('proc_ops_collect_lag_seconds', 'histogram', 'Delay between the due time of a sample and its start, grows once max_concurrency is saturated')
+utils_metrics.describe('proc_ops_collect_summary_seconds', 'histogram', 'Duration of the periodic summary, leak analysis included')
+utils_metrics.describe('proc_ops_collect_kills_total', 'counter', 'Kill commands sent to valgrind runs')
+
+
+class ProcProbeType(enum.Enum):
+    TOP = 'top'      # full top snapshot every round
+    PROC = 'proc'    # read /proc of the cached pid, top only when the pid is gone
+
+
 class ProcMetricPromptMisc:
-    def __init__(self, p_mem_keyword, p_normal_includes, p_normal_excludes, p_valgrind_includes, p_valgrind_excludes, p_cmd_top, p_cmd_kill):
+    def __init__(self, p_mem_keyword, p_normal_includes, p_normal_excludes, p_valgrind_includes, p_valgrind_excludes, p_cmd_top, p_cmd_kill, p_probe_type=ProcProbeType.TOP, p_cmd_proc_probe='', p_cmd_timeout=None):
         self.mem_keyword = p_mem_keyword
         self.normal_includes = p_normal_includes
         self.normal_excludes = p_normal_excludes
@@ -31,14 +58,61 @@ class ProcMetricPromptMisc:
         self.valgrind_excludes = p_valgrind_excludes
         self.cmd_top = p_cmd_top
         self.cmd_kill = p_cmd_kill
+        self.probe_type = p_probe_type
+        self.cmd_proc_probe = p_cmd_proc_probe    # formatted with {pid}
+        self.cmd_timeout = p_cmd_timeout          # second without output before a command is given up, None waits forever
+
+        # Built once at config load, proc_top_parse_reference keeps the original rules to check it against recorded snapshots
+        self.top_matcher = ProcTopMatcher(p_mem_keyword, p_normal_includes, p_normal_excludes, p_valgrind_includes, p_valgrind_excludes)
+        self.top_recorder = None    # ProcTopRecorder when raw snapshots should be kept for offline replay
 
 
 class ProcMetricsCollectorCfgMgr:
-    def __init__(self, p_cfg_file='proc_metrics_collector_cfg.yaml'):
+    # Kept from the first load by reload(), the running loops, pool sizes and files are built from them once
+    RESTART_ONLY = ('collect_mode', 'metrics_port', 'max_concurrency', 'history_capacity', 'history_downsample_factor', 'history_flush_file')
+
+    def __init__(self, p_cfg_file='proc_metrics_collector_cfg.yaml', p_shard_index=0, p_shard_count=1):
         self.cfg_file = p_cfg_file
+        self.shard_index = p_shard_index   # proc_supervisor worker, only the hosts of this shard are sampled
+        self.shard_count = p_shard_count
+        self.cfg_stamp = None              # (mtime ns, size) of the file when it was read
+        self.loaded = False                # the whole file was read without error
 
         self.collect_interval = 600        # second
         self.mem_ram_free_th_min = 50000   # KB
+        self.max_concurrency = 16
+        self.connect_timeout = 8           # second
+        self.cmd_timeout = 30              # second without output before a command is given up, 0 waits forever
+        self.metrics_port = 0              # local Prometheus endpoint, 0 disables
+        self.log_repeat_interval = 300     # second, repeated warnings of one host and kind are only counted in between
+        self.reload_interval = 0           # second between two checks of the file for changes, 0 disables
+        self.proc_name = ''                # shares the pid of this process as fact 'pid:<proc_name>' with proc_task_executor, '' disables
+        self.proc_fact_ttl = 10            # second a published pid stays valid, at most the cache_ttl of get_pid in proc_task_executor
+        self.ssh_keepalive_interval = 15   # second
+        self.ssh_idle_timeout = 300        # second
+        self.ssh_health_check_idle = 60    # second
+        self.ssh_max_conns = 256
+        self.history_capacity = 2880       # samples per host
+        self.history_downsample_factor = 0
+        self.history_flush_file = ''
+        self.history_flush_interval = 300  # second
+        self.leak_window = 60              # latest samples per host used for the trend
+        self.leak_min_samples = 6
+        self.leak_min_r2 = 0.5
+        self.leak_safety_margin = 300      # second, kill valgrind this long before free memory is expected to reach min_free_mem
+        self.leak_top_n = 10
+        self.sched_min_interval = 10       # second, hosts under valgrind or close to min_free_mem
+        self.sched_max_interval = 120      # second, stable healthy hosts drift up to this
+        self.sched_stable_growth = 1.5     # interval factor per stable sample
+        self.sched_near_free_mem = 2.0     # close to min_free_mem means mem_ram_free < near_free_mem * min_free_mem
+        self.sched_backoff_base = 30       # second, first retry of an unreachable host
+        self.sched_backoff_max = 600       # second
+        self.sched_jitter = 0.1            # +- fraction applied to every delay
+        self.collect_mode = 'poll'         # 'poll' or 'stream'
+        self.stream_interval = 2           # second between two samples of the remote loop
+        self.stream_record_interval = 10   # second, history sample per host unless status or pid changes first
+        self.stream_max_buffer = 262144    # bytes buffered per host while waiting for the end of a sample
+        self.stream_stale_frames = 3       # missed samples, plus cmd_timeout, before a silent stream is dropped
         self.username = ''
         self.password = ''
         self.prompt_misc = None
@@ -46,16 +120,55 @@ class ProcMetricsCollectorCfgMgr:
 
         self._load_cfg()
 
+    def _stamp(self):
+        try:
+            stat = os.stat(self.cfg_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
     def _load_cfg(self):
         try:
             if not os.path.exists(self.cfg_file):
                 raise FileNotFoundError(f"The file [{self.cfg_file}] does not exist!")
 
+            self.cfg_stamp = self._stamp()
             with open(self.cfg_file, 'r') as cfg:
                 config = yaml.safe_load(cfg)
 
             self.collect_interval = config['proc_metrics_collector']['general']['collect_interval']
             self.mem_ram_free_th_min = config['proc_metrics_collector']['general']['min_free_mem']
+            self.max_concurrency = config['proc_metrics_collector']['general'].get('max_concurrency', self.max_concurrency)
+            self.connect_timeout = config['proc_metrics_collector']['general'].get('connect_timeout', self.connect_timeout)
+            self.cmd_timeout = config['proc_metrics_collector']['general'].get('cmd_timeout', self.cmd_timeout)
+
+            ssh_pool = config['proc_metrics_collector'].get('ssh_pool', {})
+            self.ssh_keepalive_interval = ssh_pool.get('keepalive_interval', self.ssh_keepalive_interval)
+            self.ssh_idle_timeout = ssh_pool.get('idle_timeout', self.ssh_idle_timeout)
+            self.ssh_health_check_idle = ssh_pool.get('health_check_idle', self.ssh_health_check_idle)
+            self.ssh_max_conns = ssh_pool.get('max_conns', self.ssh_max_conns)
+
+            history = config['proc_metrics_collector'].get('history', {})
+            self.history_capacity = history.get('capacity', self.history_capacity)
+            self.history_downsample_factor = history.get('downsample_factor', self.history_downsample_factor)
+            self.history_flush_file = history.get('flush_file', self.history_flush_file)
+            self.history_flush_interval = history.get('flush_interval', self.history_flush_interval)
+
+            leak_detect = config['proc_metrics_collector'].get('leak_detect', {})
+            self.leak_window = leak_detect.get('window', self.leak_window)
+            self.leak_min_samples = leak_detect.get('min_samples', self.leak_min_samples)
+            self.leak_min_r2 = leak_detect.get('min_r2', self.leak_min_r2)
+            self.leak_safety_margin = leak_detect.get('safety_margin', self.leak_safety_margin)
+            self.leak_top_n = leak_detect.get('top_n', self.leak_top_n)
+
+            scheduler = config['proc_metrics_collector'].get('scheduler', {})
+            self.sched_min_interval = scheduler.get('min_interval', self.sched_min_interval)
+            self.sched_max_interval = scheduler.get('max_interval', self.sched_max_interval)
+            self.sched_stable_growth = scheduler.get('stable_growth', self.sched_stable_growth)
+            self.sched_near_free_mem = scheduler.get('near_free_mem', self.sched_near_free_mem)
+            self.sched_backoff_base = scheduler.get('backoff_base', self.sched_backoff_base)
+            self.sched_backoff_max = scheduler.get('backoff_max', self.sched_backoff_max)
+            self.sched_jitter = scheduler.get('jitter', self.sched_jitter)
 
             self.username = config['proc_metrics_collector']['credentials_of_ssh']['username']
             self.password = config['proc_metrics_collector']['credentials_of_ssh']['password']
@@ -67,7 +180,27 @@ class ProcMetricsCollectorCfgMgr:
             valgrind_excludes = config['proc_metrics_collector']['prompt_of_proc']['launch_by_valgrind']['excludes']
             cmd_top = config['proc_metrics_collector']['prompt_of_cmd']['cmd_top']
             cmd_kill = config['proc_metrics_collector']['prompt_of_cmd']['cmd_kill']
-            self.prompt_misc = ProcMetricPromptMisc(mem_keyword, normal_includes, normal_excludes, valgrind_includes, valgrind_excludes, cmd_top, cmd_kill)
+            cmd_proc_probe = config['proc_metrics_collector']['prompt_of_cmd'].get('cmd_proc_probe', '')
+            probe_type = ProcProbeType(config['proc_metrics_collector']['general'].get('probe_mode', ProcProbeType.TOP.value))
+            if (ProcProbeType.PROC == probe_type) and (not cmd_proc_probe):
+                cur_logger.warning(f'[probe_mode: {probe_type.value}] needs prompt_of_cmd.cmd_proc_probe, fall back to [{ProcProbeType.TOP.value}]')
+                probe_type = ProcProbeType.TOP
+            self.prompt_misc = ProcMetricPromptMisc(mem_keyword, normal_includes, normal_excludes, valgrind_includes, valgrind_excludes, cmd_top, cmd_kill, probe_type, cmd_proc_probe, self.cmd_timeout or None)
+            record_dir = config['proc_metrics_collector']['general'].get('record_dir', '')
+            self.collect_mode = config['proc_metrics_collector']['general'].get('collect_mode', self.collect_mode)
+
+            stream = config['proc_metrics_collector'].get('stream', {})
+            self.stream_interval = stream.get('interval', self.stream_interval)
+            self.stream_record_interval = stream.get('record_interval', self.stream_record_interval)
+            self.stream_max_buffer = stream.get('max_buffer', self.stream_max_buffer)
+            self.stream_stale_frames = stream.get('stale_frames', self.stream_stale_frames)
+            self.proc_name = config['proc_metrics_collector']['general'].get('proc_name', self.proc_name)
+            self.proc_fact_ttl = config['proc_metrics_collector']['general'].get('proc_fact_ttl', self.proc_fact_ttl)
+            self.metrics_port = config['proc_metrics_collector']['general'].get('metrics_port', self.metrics_port)
+            self.log_repeat_interval = config['proc_metrics_collector']['general'].get('log_repeat_interval', self.log_repeat_interval)
+            self.reload_interval = config['proc_metrics_collector']['general'].get('reload_interval', self.reload_interval)
+            if record_dir:
+                self.prompt_misc.top_recorder = ProcTopRecorder(record_dir)
 
             ip_groups_selected = config['proc_metrics_collector']['ips_of_proc']['ip_groups_selected']
             ip_groups_all = config['proc_metrics_collector']['ips_of_proc']['ip_groups_all']
@@ -76,13 +209,32 @@ class ProcMetricsCollectorCfgMgr:
                     self.ips_of_proc.extend(ip_groups_all[cur_group])
                 else:
                     cur_logger.warning(f'[ip_groups: {cur_group}] not found in configuration!')
-
-            cur_logger.info(f'CfgMgrForProcMetricsCollector [collect_interval: {self.collect_interval}], [mem_ram_free_th_min: {self.mem_ram_free_th_min}]')
+            # A host listed in several selected groups is only sampled once
+            self.ips_of_proc = list(dict.fromkeys(self.ips_of_proc))
+            # A shard keeps its own endpoint and history file next to the other shards
+            if self.shard_count > 1:
+                self.ips_of_proc = utils_shard_ips(self.ips_of_proc, self.shard_index, self.shard_count)
+                if self.metrics_port:
+                    self.metrics_port += self.shard_index * UTILS_SHARD_PORT_STRIDE
+                if self.history_flush_file:
+                    self.history_flush_file = f'{self.history_flush_file}.shard{self.shard_index}'
+
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [collect_interval: {self.collect_interval}], [mem_ram_free_th_min: {self.mem_ram_free_th_min}], [shard: {self.shard_index}/{self.shard_count}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [max_concurrency: {self.max_concurrency}], [connect_timeout: {self.connect_timeout}], [cmd_timeout: {self.cmd_timeout}], [metrics_port: {self.metrics_port}], [log_repeat_interval: {self.log_repeat_interval}], [reload_interval: {self.reload_interval}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [ssh_keepalive_interval: {self.ssh_keepalive_interval}], [ssh_idle_timeout: {self.ssh_idle_timeout}], [ssh_health_check_idle: {self.ssh_health_check_idle}], [ssh_max_conns: {self.ssh_max_conns}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [history_capacity: {self.history_capacity}], [history_downsample_factor: {self.history_downsample_factor}], [history_flush_file: {self.history_flush_file}], [history_flush_interval: {self.history_flush_interval}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [leak_window: {self.leak_window}], [leak_min_samples: {self.leak_min_samples}], [leak_min_r2: {self.leak_min_r2}], [leak_safety_margin: {self.leak_safety_margin}], [leak_top_n: {self.leak_top_n}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [sched_min_interval: {self.sched_min_interval}], [sched_max_interval: {self.sched_max_interval}], [sched_stable_growth: {self.sched_stable_growth}], [sched_near_free_mem: {self.sched_near_free_mem}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [sched_backoff_base: {self.sched_backoff_base}], [sched_backoff_max: {self.sched_backoff_max}], [sched_jitter: {self.sched_jitter}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [collect_mode: {self.collect_mode}], [stream_interval: {self.stream_interval}], [stream_record_interval: {self.stream_record_interval}], [stream_max_buffer: {self.stream_max_buffer}], [stream_stale_frames: {self.stream_stale_frames}]')
             cur_logger.info(f'CfgMgrForProcMetricsCollector [valgrind_includes: {self.prompt_misc.valgrind_includes}], [valgrind_excludes: {self.prompt_misc.valgrind_excludes}]')
             cur_logger.info(f'CfgMgrForProcMetricsCollector [normal_includes: {self.prompt_misc.normal_includes}], [normal_excludes: {self.prompt_misc.normal_excludes}]')
             cur_logger.info(f'CfgMgrForProcMetricsCollector [mem_keyword: {self.prompt_misc.mem_keyword}]')
             cur_logger.info(f'CfgMgrForProcMetricsCollector [cmd_top: {self.prompt_misc.cmd_top}], [cmd_kill: {self.prompt_misc.cmd_kill}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [probe_mode: {self.prompt_misc.probe_type.value}], [cmd_proc_probe: {self.prompt_misc.cmd_proc_probe}], [proc_name: {self.proc_name}], [proc_fact_ttl: {self.proc_fact_ttl}]')
+            cur_logger.info(f'CfgMgrForProcMetricsCollector [top_pattern: {self.prompt_misc.top_matcher.pattern.pattern}], [record_dir: {self.prompt_misc.top_recorder.record_dir if self.prompt_misc.top_recorder else None}]')
             cur_logger.info(f'CfgMgrForProcMetricsCollector [len_of_ips_of_proc: {len(self.ips_of_proc)}], [ips_of_proc: {self.ips_of_proc}]')
+            self.loaded = True
         except FileNotFoundError as e:
             cur_logger.error(f"File Not Found: {e}")
         except yaml.YAMLError as e:
@@ -90,6 +242,27 @@ class ProcMetricsCollectorCfgMgr:
         except Exception as e:
             cur_logger.error(f"An unexpected error occurred: {e}")
 
+    def reload(self):
+        # -> (added ips, removed ips) once a changed file was read completely, None otherwise, a broken file keeps the running settings
+        stamp = self._stamp()
+        if (stamp is None) or (stamp == self.cfg_stamp):
+            return None
+        fresh = ProcMetricsCollectorCfgMgr(self.cfg_file, self.shard_index, self.shard_count)
+        self.cfg_stamp = stamp    # a broken file is reported once, not on every check
+        if not fresh.loaded:
+            cur_logger.error(f'CfgMgrForProcMetricsCollector [{self.cfg_file}] changed but cannot be loaded, keep the running settings')
+            return None
+        for cur_name in self.RESTART_ONLY:
+            if getattr(fresh, cur_name) != getattr(self, cur_name):
+                cur_logger.warning(f'CfgMgrForProcMetricsCollector [{cur_name}: {getattr(self, cur_name)} -> {getattr(fresh, cur_name)}] takes effect after a restart')
+                setattr(fresh, cur_name, getattr(self, cur_name))
+
+        old_ips, new_ips = set(self.ips_of_proc), set(fresh.ips_of_proc)
+        ret_added = [cur_ip for cur_ip in fresh.ips_of_proc if cur_ip not in old_ips]
+        ret_removed = [cur_ip for cur_ip in self.ips_of_proc if cur_ip not in new_ips]
+        vars(self).update(vars(fresh))
+        return ret_added, ret_removed
+
 
 class ProcMetric:
     def __init__(self, p_ip, p_cmd_prompt):
@@ -105,7 +278,18 @@ class ProcMetric:
 
         self.pid_change_cnt = 0
 
+        # State of the /proc probe, only set by a successful top scan or a shared pid fact checked against its comm,
+        # so a recycled pid is never adopted blindly
+        self.probe_pid = ''
+        self.probe_launch_type = ProcLaunchType.UNKNOWN
+        self.probe_comm = ''
+        self.probe_cpu_ticks = None    # (proc ticks, total ticks) of the last probe
+
     def _update_meter(self, p_proc_status, p_launch_type, p_pid, p_mem_ram_free, p_mem_vsz, p_cpu_pct):
+        if (ProcStatusType.NORMAL == p_proc_status) and (ProcStatusType.NORMAL != self.proc_status):
+            # Recovered, the next failure is reported at once
+            for cur_kind in ('crash', 'disconn', 'connect', 'top'):
+                utils_log_limiter.reset(self.ip, cur_kind)
         self.proc_status = p_proc_status
         self.launch_type = p_launch_type
 
@@ -122,91 +306,677 @@ class ProcMetric:
     def _reset_meter(self, p_proc_status=ProcStatusType.UNKNOWN):
         self._update_meter(p_proc_status, ProcLaunchType.UNKNOWN, '', 0, 0, 0)
 
-    def metric_collect(self, ssh_client):
-        def closure_extract_metric():
-            parts = [cur_part.strip() for cur_part in cur_line.split()]
-            part_mem_split = [cur_part.strip() for cur_part in parts[4].split('m') if cur_part]    # parts[4] maybe "998m 54.6" or "1222m149.9", should be split
-            parts = parts[:4] + part_mem_split + parts[5:]
-            return parts[0], parts[4], parts[7]
+    def metric_update_by_top(self, p_stdout, p_warn_crash=True):
+        if self.cmd_prompt.top_recorder is not None:
+            self.cmd_prompt.top_recorder.record(self.ip, p_stdout)
+        with utils_metrics.timer('proc_ops_collect_phase_seconds', phase='parse'):
+            record = self.cmd_prompt.top_matcher.parse(p_stdout)
+        ret_launch_type = ProcLaunchType(record.launch_type)
 
+        ret_proc_status = ProcStatusType.NORMAL if record.pid else ProcStatusType.CRASH
+        if (ProcStatusType.CRASH == ret_proc_status) and p_warn_crash and utils_log_limiter.allow(self.ip, 'crash'):
+            cur_logger.warning('[Host: {}] cannot find pid, maybe crashed!', self.ip, host=self.ip)
+            cur_logger.debug('[Host: {}] top output of the crash:\n    {}', self.ip, p_stdout, host=self.ip)
+
+        self._update_meter(ret_proc_status, ret_launch_type, record.pid, record.mem_ram_free, record.mem_vsz, record.cpu_pct)
+        self.probe_pid, self.probe_launch_type, self.probe_comm, self.probe_cpu_ticks = record.pid, ret_launch_type, '', None
+
+    def _metric_collect_by_top(self, ssh_client):
         try:
-            stdout = utils_execute_cmd_by_ssh(ssh_client, self.ip, self.cmd_prompt.cmd_top, cur_logger)
-            ret_launch_type, ret_pid, ret_proc_status, ret_mem_ram_free, ret_mem_vsz, ret_cpu_pct = ProcLaunchType.UNKNOWN, '', '', 0, 0, 0
-            for cur_line in stdout.split('\n'):
-                if self.cmd_prompt.mem_keyword in cur_line:
-                    ret_mem_ram_free = [cur_part.strip() for cur_part in cur_line.split()][3].rstrip('K')    # remove last 'K'
-                elif any(include in cur_line for include in self.cmd_prompt.valgrind_includes) and all(exclude not in cur_line for exclude in self.cmd_prompt.valgrind_excludes):    # !!! valgrind must before normal !!!
-                    ret_launch_type = ProcLaunchType.VALGRIND
-                    ret_pid, ret_mem_vsz, ret_cpu_pct = closure_extract_metric()
-                elif any(cur_line.endswith(include) for include in self.cmd_prompt.normal_includes) and all(exclude not in cur_line for exclude in self.cmd_prompt.normal_excludes):
-                    ret_launch_type = ProcLaunchType.NORMAL
-                    ret_pid, ret_mem_vsz, ret_cpu_pct = closure_extract_metric()
-
-            ret_proc_status = ProcStatusType.NORMAL if ret_pid else ProcStatusType.CRASH
-            if ProcStatusType.CRASH == ret_proc_status:
-                cur_logger.warning(f"[Host: {self.ip}] cannot find pid, maybe crashed!:\n    {stdout}")
-
-            self._update_meter(ret_proc_status, ret_launch_type, ret_pid, ret_mem_ram_free, ret_mem_vsz, ret_cpu_pct)
+            stdout = utils_execute_cmd_by_ssh(ssh_client, self.ip, self.cmd_prompt.cmd_top, cur_logger, self.cmd_prompt.cmd_timeout)
+            self.metric_update_by_top(stdout)
+        except UTILS_SSH_CMD_ERRORS:
+            raise
         except Exception as e:
-            cur_logger.error(f"Failed to get process info of [Host: {self.ip}]: {e}")
+            if utils_log_limiter.allow(self.ip, 'top'):
+                cur_logger.error('Failed to get process info of [Host: {}]: {}', self.ip, e, host=self.ip)
             self._reset_meter()    # really need?
+            self.probe_pid = ''
+
+    @staticmethod
+    def _parse_proc_probe(p_stdout):
+        # -> (comm, proc ticks, total ticks, vm_size KB, mem_free KB), None for anything missing
+        ret_comm, ret_proc_ticks, ret_total_ticks, ret_vm_size, ret_mem_free = None, None, None, None, None
+        for cur_line in p_stdout.split('\n'):
+            if cur_line.startswith('cpu '):
+                ret_total_ticks = sum(int(cur_part) for cur_part in cur_line.split()[1:9])    # user .. steal
+            elif cur_line.startswith('Name:'):
+                ret_comm = cur_line[len('Name:'):].strip()
+            elif cur_line.startswith('VmSize:'):
+                ret_vm_size = int(cur_line.split()[1])
+            elif cur_line.startswith('MemFree:'):
+                ret_mem_free = int(cur_line.split()[1])
+            elif cur_line[:1].isdigit() and (') ' in cur_line):
+                fields = cur_line.rpartition(') ')[2].split()    # comm may contain spaces, fields restart at 'state'
+                ret_proc_ticks = int(fields[11]) + int(fields[12])    # utime + stime
+        return ret_comm, ret_proc_ticks, ret_total_ticks, ret_vm_size, ret_mem_free
+
+    def _metric_collect_by_proc(self, ssh_client):
+        # Return False when the cached pid is gone or reused, the caller falls back to a top scan
+        stdout = utils_execute_cmd_by_ssh(ssh_client, self.ip, self.cmd_prompt.cmd_proc_probe.format(pid=self.probe_pid), cur_logger, self.cmd_prompt.cmd_timeout)
+        with utils_metrics.timer('proc_ops_collect_phase_seconds', phase='parse'):
+            comm, proc_ticks, total_ticks, vm_size, mem_free = self._parse_proc_probe(stdout)
+        if (comm is None) or (proc_ticks is None) or (mem_free is None) or (self.probe_comm and (comm != self.probe_comm)):
+            cur_logger.debug('[Host: {}] pid [{}] of [comm: {}] is gone, fall back to top', self.ip, self.probe_pid, self.probe_comm)
+            return False
+
+        # The first probe after a top scan or a pid change has no tick baseline yet, the last value is kept instead of a false drop to 0
+        cpu_pct = self.cpu_pct
+        if (self.probe_cpu_ticks is not None) and (total_ticks is not None) and (total_ticks > self.probe_cpu_ticks[1]):
+            cpu_pct = round(100.0 * (proc_ticks - self.probe_cpu_ticks[0]) / (total_ticks - self.probe_cpu_ticks[1]), 1)
+        self.probe_comm, self.probe_cpu_ticks = comm, (proc_ticks, total_ticks)
+
+        # Same units as the top path, vsz in MB, free memory in KB
+        self._update_meter(ProcStatusType.NORMAL, self.probe_launch_type, self.probe_pid, mem_free, (vm_size or 0) / 1024, cpu_pct)
+        return True
+
+    def metric_collect(self, ssh_client):
+        if (ProcProbeType.PROC == self.cmd_prompt.probe_type) and (self.probe_pid != ''):
+            try:
+                if self._metric_collect_by_proc(ssh_client):
+                    return
+            except UTILS_SSH_CMD_ERRORS:
+                raise
+            except Exception as e:
+                cur_logger.error('Failed to probe /proc of [Host: {}]: {}', self.ip, e, host=self.ip)
+        self._metric_collect_by_top(ssh_client)
+
+    def probe_adopt(self, p_pid, p_launch_type, p_comm):
+        self.probe_pid, self.probe_launch_type, self.probe_comm, self.probe_cpu_ticks = p_pid, p_launch_type, p_comm, None
 
     def metric_update_by_disconn(self):
-        cur_logger.warning(f"[Host: {self.ip}] cannot connect! reset metric!")
+        if utils_log_limiter.allow(self.ip, 'disconn'):
+            cur_logger.warning('[Host: {}] cannot connect! reset metric!', self.ip, host=self.ip)
         self._reset_meter(ProcStatusType.DISCONN)
 
 
+class ProcMetricsScheduler:
+    # Min-heap of (next due, seq, host ip), every host carries its own interval
+    def __init__(self, p_cfg_mgr):
+        self.cfg_mgr = p_cfg_mgr
+        self._heap = []
+        self._seq = 0
+        # host ip -> seq of its one live heap entry, a host removed and added back while sampled gets a second push when
+        # the sample finishes, the older entry is stale and dropped
+        self.live_seqs = {}
+        self.intervals = {}            # host ip -> current polling interval
+        self.fail_cnts = {}            # host ip -> consecutive connect failures
+        self.pid_change_cnts = {}      # host ip -> pid_change_cnt at the previous sample
+
+    def _jitter(self, p_delay):
+        return p_delay * random.uniform(1 - self.cfg_mgr.sched_jitter, 1 + self.cfg_mgr.sched_jitter)
+
+    def push(self, p_host_ip, p_due):
+        heapq.heappush(self._heap, (p_due, self._seq, p_host_ip))
+        self.live_seqs[p_host_ip] = self._seq
+        self._seq += 1
+
+    def add_hosts(self, p_host_ips, p_now, p_spread=True):
+        # At start the first samples are spread over one collect_interval so the fleet is not hit in a burst,
+        # the few hosts a reload adds are sampled right away
+        for cur_host_ip in p_host_ips:
+            self.intervals[cur_host_ip] = self.cfg_mgr.collect_interval
+            self.fail_cnts[cur_host_ip] = 0
+            self.push(cur_host_ip, p_now + (random.uniform(0, self.cfg_mgr.collect_interval) if p_spread else 0))
+
+    def remove_hosts(self, p_host_ips):
+        for cur_host_ip in p_host_ips:
+            self.intervals.pop(cur_host_ip, None)
+            self.fail_cnts.pop(cur_host_ip, None)
+            self.pid_change_cnts.pop(cur_host_ip, None)
+            self.live_seqs.pop(cur_host_ip, None)
+        self._heap = [cur_entry for cur_entry in self._heap if self._is_live(cur_entry)]
+        heapq.heapify(self._heap)
+
+    def _is_live(self, p_entry):
+        return self.live_seqs.get(p_entry[2]) == p_entry[1]
+
+    def pop_due(self, p_now):
+        # -> [(host ip, due)]
+        ret_due = []
+        while self._heap and (self._heap[0][0] <= p_now):
+            entry = heapq.heappop(self._heap)
+            if self._is_live(entry):
+                ret_due.append((entry[2], entry[0]))
+        return ret_due
+
+    def next_due(self):
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def interval_of(self, p_host_ip):
+        return self.intervals.get(p_host_ip, self.cfg_mgr.collect_interval)
+
+    def reschedule(self, p_proc_metric, p_now):
+        host_ip = p_proc_metric.ip
+        if host_ip not in self.intervals:
+            return
+
+        if ProcStatusType.DISCONN == p_proc_metric.proc_status:
+            # Exponential backoff, an unreachable host costs a connect timeout every time it is tried
+            self.fail_cnts[host_ip] += 1
+            delay = min(self.cfg_mgr.sched_backoff_max, self.cfg_mgr.sched_backoff_base * 2 ** (self.fail_cnts[host_ip] - 1))
+            self.push(host_ip, p_now + self._jitter(delay))
+            return
+
+        self.fail_cnts[host_ip] = 0
+        stable = (ProcStatusType.NORMAL == p_proc_metric.proc_status) and (self.pid_change_cnts.get(host_ip) == p_proc_metric.pid_change_cnt)
+        self.pid_change_cnts[host_ip] = p_proc_metric.pid_change_cnt
+        if (ProcLaunchType.VALGRIND == p_proc_metric.launch_type) or (ProcStatusType.CRASH == p_proc_metric.proc_status) or \
+                (p_proc_metric.mem_ram_free < self.cfg_mgr.sched_near_free_mem * self.cfg_mgr.mem_ram_free_th_min):
+            interval = self.cfg_mgr.sched_min_interval
+        elif stable:
+            interval = min(self.cfg_mgr.sched_max_interval, max(self.intervals[host_ip], self.cfg_mgr.collect_interval) * self.cfg_mgr.sched_stable_growth)
+        else:
+            interval = self.cfg_mgr.collect_interval
+        self.intervals[host_ip] = interval
+        self.push(host_ip, p_now + self._jitter(interval))
+
+
+class ProcMetricsStreamMonitor:
+    # One long running sampling loop per host on a channel of its pooled connection, every channel multiplexed by one selector
+    # in the caller's thread, connects run on the executor so a dead host never stalls the others
+    def __init__(self, p_collector, p_proc_metrics):
+        self.collector = p_collector
+        self.cfg_mgr = p_collector.cfg_mgr
+        self.proc_metrics = p_proc_metrics    # ip -> ProcMetric
+        self.marker = f'\n__PROC_OPS_FRAME_{uuid.uuid4().hex}__\n'.encode()
+
+        self.streams = {}       # channel -> [proc_metric, ssh_client, buffer, monotonic time of the last sample]
+        # epoll on Linux, registered while the stream is open, select() would stop at FD_SETSIZE and paramiko takes 2 fds per channel
+        self.selector = selectors.DefaultSelector()
+        self.opening = {}       # future -> proc_metric
+        self.reopen_at = {cur_ip: 0 for cur_ip in p_proc_metrics}    # hosts without a stream -> monotonic time of the next attempt
+        self.fail_cnts = {}
+        self.last_record = {}   # ip -> monotonic time of the last history sample
+
+    def _remote_cmd(self):
+        # The loop dies on SIGPIPE once the channel is closed
+        marker = self.marker.decode().strip()
+        return f"while :; do {self.cfg_mgr.prompt_misc.cmd_top}; printf '\\n%s\\n' '{marker}'; sleep {self.cfg_mgr.stream_interval}; done"
+
+    def _open(self, p_proc_metric):
+        ssh_client = self.collector.ssh_pool.acquire(p_proc_metric.ip)
+        try:
+            channel = ssh_client.get_transport().open_session(timeout=self.cfg_mgr.connect_timeout)
+            channel.exec_command(self._remote_cmd())
+        except Exception:
+            self.collector.ssh_pool.release(p_proc_metric.ip, ssh_client, p_broken=True)
+            raise
+        return ssh_client, channel
+
+    def _close(self, p_channel, p_broken=False):
+        proc_metric, ssh_client = self.streams.pop(p_channel)[:2]
+        try:
+            self.selector.unregister(p_channel)
+            p_channel.close()
+        finally:
+            self.collector.ssh_pool.release(proc_metric.ip, ssh_client, p_broken)
+        return proc_metric
+
+    def remove_hosts(self, p_host_ips):
+        for cur_channel in [cur_channel for cur_channel, cur_stream in self.streams.items() if cur_stream[0].ip in p_host_ips]:
+            self._close(cur_channel)
+        for cur_ip in p_host_ips:
+            self.reopen_at.pop(cur_ip, None)
+
+    def add_hosts(self, p_host_ips):
+        # A host still connecting keeps that attempt
+        opening_ips = {cur_proc_metric.ip for cur_proc_metric in self.opening.values()}
+        for cur_ip in p_host_ips:
+            if cur_ip not in opening_ips:
+                self.reopen_at.setdefault(cur_ip, 0)
+
+    def _backoff(self, p_host_ip):
+        fail_cnt = self.fail_cnts.get(p_host_ip, 0)
+        return min(self.cfg_mgr.sched_backoff_base * (2 ** max(fail_cnt - 1, 0)), self.cfg_mgr.sched_backoff_max)
+
+    def _handle_frame(self, p_executor, p_proc_metric, p_frame, p_now):
+        old_status, old_pid = p_proc_metric.proc_status, p_proc_metric.pid
+        try:
+            # Samples arrive every stream_interval, a crash is only reported when it starts
+            p_proc_metric.metric_update_by_top(p_frame.decode('utf-8', errors='replace'), ProcStatusType.CRASH != old_status)
+        except Exception as e:
+            cur_logger.error('Failed to parse streamed sample of [Host: {}]: {}', p_proc_metric.ip, e, host=p_proc_metric.ip)
+            return
+
+        # Status and pid changes are recorded the moment they are seen, steady samples only every record_interval
+        changed = (old_status != p_proc_metric.proc_status) or (old_pid != p_proc_metric.pid)
+        if changed or (p_now - self.last_record.get(p_proc_metric.ip, 0) >= self.cfg_mgr.stream_record_interval):
+            self.collector._record_sample(p_proc_metric)
+            self.last_record[p_proc_metric.ip] = p_now
+
+        if self.collector._need_threshold_kill(p_proc_metric) and self.collector._claim_kill(p_proc_metric):
+            reason = f'mem_ram_free[{p_proc_metric.mem_ram_free}] < p_mem_ram_free_th_min[{self.cfg_mgr.mem_ram_free_th_min}]'
+            p_executor.submit(self.collector._kill_host, p_proc_metric, reason)
+
+    def _read(self, p_executor, p_channel, p_now):
+        stream = self.streams[p_channel]
+        proc_metric, buffer = stream[0], stream[2]
+        while p_channel.recv_stderr_ready():
+            p_channel.recv_stderr(65536)    # drained so a chatty stderr never stalls the channel window
+        data = p_channel.recv(65536) if p_channel.recv_ready() or p_channel.eof_received else b''
+        if not data:
+            if p_channel.eof_received or p_channel.closed:
+                # The remote loop ended, a dead transport shows up as a connect failure on the next open
+                broken = not p_channel.get_transport().is_active()
+                self._close(p_channel, broken)
+                self.reopen_at[proc_metric.ip] = p_now + self.cfg_mgr.stream_interval
+                if utils_log_limiter.allow(proc_metric.ip, 'stream'):
+                    cur_logger.warning('[Host: {}] stream ended, reopen in [{}] seconds', proc_metric.ip, self.cfg_mgr.stream_interval, host=proc_metric.ip)
+            return
+
+        buffer.extend(data)
+        while True:
+            index = buffer.find(self.marker)
+            if index < 0:
+                break
+            frame = bytes(buffer[:index])
+            del buffer[:index + len(self.marker)]
+            # The backoff is only forgotten once samples flow, a host that accepts streams but goes silent keeps backing off
+            stream[3] = p_now
+            self.fail_cnts.pop(proc_metric.ip, None)
+            self._handle_frame(p_executor, proc_metric, frame, p_now)
+        if len(buffer) > self.cfg_mgr.stream_max_buffer:
+            # No end of sample within the bound, drop it but keep what could be the start of a marker
+            if utils_log_limiter.allow(proc_metric.ip, 'stream_buffer'):
+                cur_logger.warning('[Host: {}] streamed sample exceeds [{}] bytes, dropped', proc_metric.ip, self.cfg_mgr.stream_max_buffer, host=proc_metric.ip)
+            del buffer[:len(buffer) - len(self.marker)]
+
+    def poll(self, p_executor, p_timeout):
+        now = time.monotonic()
+        for cur_ip in [cur_ip for cur_ip, cur_at in self.reopen_at.items() if cur_at <= now]:
+            del self.reopen_at[cur_ip]
+            self.opening[p_executor.submit(self._open, self.proc_metrics[cur_ip])] = self.proc_metrics[cur_ip]
+
+        for cur_future in [cur_future for cur_future in self.opening if cur_future.done()]:
+            proc_metric = self.opening.pop(cur_future)
+            if proc_metric.ip not in self.proc_metrics:
+                # Removed while connecting
+                if cur_future.exception() is None:
+                    ssh_client, channel = cur_future.result()
+                    channel.close()
+                    self.collector.ssh_pool.release(proc_metric.ip, ssh_client)
+                continue
+            try:
+                ssh_client, channel = cur_future.result()
+            except Exception as e:
+                self.fail_cnts[proc_metric.ip] = self.fail_cnts.get(proc_metric.ip, 0) + 1
+                self.reopen_at[proc_metric.ip] = now + self._backoff(proc_metric.ip)
+                if utils_log_limiter.allow(proc_metric.ip, 'connect'):
+                    cur_logger.error('Failed to open stream [host: {}]:\n    except: {}', proc_metric.ip, e, host=proc_metric.ip)
+                self.collector._record_disconn(proc_metric)
+                continue
+            self.streams[channel] = [proc_metric, ssh_client, bytearray(), now]
+            self.selector.register(channel, selectors.EVENT_READ)
+
+        # Short waits while connects are pending, so new streams are registered quickly
+        timeout = min(p_timeout, 0.2) if self.opening else p_timeout
+        if not self.streams:
+            time.sleep(max(timeout, 0))
+            return
+        events = self.selector.select(max(timeout, 0))
+        now = time.monotonic()
+        for cur_key, _ in events:
+            cur_channel = cur_key.fileobj
+            if cur_channel not in self.streams:
+                continue
+            proc_metric = self.streams[cur_channel][0]
+            try:
+                self._read(p_executor, cur_channel, now)
+            except Exception as e:
+                # _read may have closed it already, or _close failed after taking it out
+                if cur_channel in self.streams:
+                    self._close(cur_channel, p_broken=True)
+                self.reopen_at[proc_metric.ip] = now + self.cfg_mgr.stream_interval
+                if utils_log_limiter.allow(proc_metric.ip, 'stream'):
+                    cur_logger.error('Failed to read stream of [Host: {}]: {}', proc_metric.ip, e, host=proc_metric.ip)
+        self._drop_stale(now)
+
+    def _drop_stale(self, p_now):
+        # keepalive never waits for a reply, a host gone dark would otherwise look alive until TCP gives up minutes later
+        stale_after = self.cfg_mgr.stream_stale_frames * self.cfg_mgr.stream_interval + (self.cfg_mgr.cmd_timeout or 0)
+        for cur_channel in [cur_channel for cur_channel, cur_stream in self.streams.items() if p_now - cur_stream[3] > stale_after]:
+            proc_metric = self._close(cur_channel, p_broken=True)
+            self.collector.ssh_pool.discard(proc_metric.ip)
+            self.fail_cnts[proc_metric.ip] = self.fail_cnts.get(proc_metric.ip, 0) + 1
+            self.reopen_at[proc_metric.ip] = p_now + self._backoff(proc_metric.ip)
+            if utils_log_limiter.allow(proc_metric.ip, 'stream'):
+                cur_logger.warning('[Host: {}] no sample for [{}] seconds, stream dropped', proc_metric.ip, stale_after, host=proc_metric.ip)
+            self.collector._record_disconn(proc_metric)
+
+    def close(self):
+        for cur_channel in list(self.streams):
+            self._close(cur_channel)
+        self.selector.close()
+
+
+def proc_metrics_summary_log(p_summary, p_logger=cur_logger):
+    # Lists and histogram of a round summary, also logged by proc_supervisor for the summary merged over its shards
+    round_counter, ips_disconn, fail_cnts, ips_crash = p_summary['round'], p_summary['ips_disconn'], p_summary['fail_cnts'], p_summary['ips_crash']
+    # One line per list, the most failing hosts first and at most PROC_METRICS_SUMMARY_HOSTS in the text, the full lists ride along as fields
+    ips_disconn = sorted(ips_disconn, key=lambda p_ip: -fail_cnts.get(p_ip, 0))
+    p_logger.info('Disconnect processes: [count: {}], [Host (Connect failures)]: {}{}', len(ips_disconn),
+                  ', '.join(f'{cur_ip} ({fail_cnts.get(cur_ip, 0)})' for cur_ip in ips_disconn[:PROC_METRICS_SUMMARY_HOSTS]),
+                  ', ...' if len(ips_disconn) > PROC_METRICS_SUMMARY_HOSTS else '',
+                  round=round_counter, hosts=ips_disconn, fail_cnts={cur_ip: fail_cnts.get(cur_ip, 0) for cur_ip in ips_disconn})
+    p_logger.info('Crash processes: [count: {}], [Host]: {}{}', len(ips_crash), ', '.join(ips_crash[:PROC_METRICS_SUMMARY_HOSTS]),
+                  ', ...' if len(ips_crash) > PROC_METRICS_SUMMARY_HOSTS else '', round=round_counter, hosts=ips_crash)
+
+    # 计算进程变化的直方图
+    p_logger.info(f'The histogram of process changes')
+    for index in range(len(PROC_METRICS_HISTOGRAM_X) - 1):
+        p_logger.info(f'        [{PROC_METRICS_HISTOGRAM_X[index]:8d} -- {PROC_METRICS_HISTOGRAM_X[index + 1]:8d}] change counter is [{p_summary["histogram"][index]:12d}]')
+
+
 class ProcMetricsCollector:
-    def __init__(self):
-        self.cfg_mgr = ProcMetricsCollectorCfgMgr()
+    def __init__(self, p_shard_index=0, p_shard_count=1, p_report=None):
+        self.cfg_mgr = ProcMetricsCollectorCfgMgr(p_shard_index=p_shard_index, p_shard_count=p_shard_count)
+        # Called with each round summary instead of logging its lists, proc_supervisor merges them over the shards
+        self.report = p_report
+        self.ssh_pool = UtilsSSHConnPool(self.cfg_mgr.username, self.cfg_mgr.password, cur_logger,
+                                         p_connect_timeout=self.cfg_mgr.connect_timeout, p_keepalive_interval=self.cfg_mgr.ssh_keepalive_interval,
+                                         p_idle_timeout=self.cfg_mgr.ssh_idle_timeout, p_health_check_idle=self.cfg_mgr.ssh_health_check_idle,
+                                         p_max_conns=self.cfg_mgr.ssh_max_conns, p_name='proc_metrics_collector')
+        utils_log_limiter.interval = self.cfg_mgr.log_repeat_interval
+        self.history = None
+        self.scheduler = None
+        self.stream_monitor = None
+        self.proc_metrics = {}
+        self._proc_metrics_lock = threading.Lock()    # reloads add and remove hosts while a scrape walks them
+        self.killed = {}    # ip -> pid a kill was sent to, threshold and predicted kills of the poll and stream paths go once per pid
+        self._kill_lock = threading.Lock()
+        self.stop_event = threading.Event()    # set by stop(), start() returns once the samples in flight are done
+
+    def _record_history(self, p_proc_metric):
+        pid = int(p_proc_metric.pid) if (ProcStatusType.NORMAL == p_proc_metric.proc_status) and p_proc_metric.pid.isdigit() else 0
+        self.history.append(p_proc_metric.ip, time.time(), PROC_STATUS_CODES[p_proc_metric.proc_status], pid,
+                            p_proc_metric.mem_ram_free, p_proc_metric.mem_vsz, p_proc_metric.cpu_pct)
+
+    def _collect_host(self, p_proc_metric, p_due=None):
+        if p_due is not None:
+            utils_metrics.observe('proc_ops_collect_lag_seconds', max(time.monotonic() - p_due, 0))
+        with utils_metrics.timer('proc_ops_collect_host_seconds'):
+            self._collect_host_timed(p_proc_metric)
+
+    def _record_disconn(self, p_proc_metric):
+        p_proc_metric.metric_update_by_disconn()
+        self._record_history(p_proc_metric)
+        utils_metrics.inc('proc_ops_collect_samples_total', status=p_proc_metric.proc_status.value)
+        if self.cfg_mgr.proc_name:
+            self._publish_pid_fact(p_proc_metric)
+
+    def _collect_host_timed(self, p_proc_metric):
+        try:
+            ssh_client = self.ssh_pool.acquire(p_proc_metric.ip)
+        except Exception as e:
+            if utils_log_limiter.allow(p_proc_metric.ip, 'connect'):
+                cur_logger.error('Failed to ssh_client.connect[host: {}]:\n    except: {}', p_proc_metric.ip, e, host=p_proc_metric.ip)
+            self._record_disconn(p_proc_metric)
+            return
 
-    def start(self):
-        proc_metrics = [ProcMetric(cur_ip, self.cfg_mgr.prompt_misc) for cur_ip in self.cfg_mgr.ips_of_proc]
+        silent = False
+        try:
+            if self.cfg_mgr.proc_name:
+                self._adopt_pid_fact(p_proc_metric)
+            p_proc_metric.metric_collect(ssh_client)
+            self._record_sample(p_proc_metric)
+
+            if self._need_threshold_kill(p_proc_metric) and self._claim_kill(p_proc_metric):
+                cur_logger.info('To kill process[{}] of [Host: {}] for mem_ram_free[{}] < p_mem_ram_free_th_min[{}]', p_proc_metric.pid, p_proc_metric.ip,
+                                p_proc_metric.mem_ram_free, self.cfg_mgr.mem_ram_free_th_min, host=p_proc_metric.ip)
+                cmd_kill_proc_by_id = f"{self.cfg_mgr.prompt_misc.cmd_kill} {p_proc_metric.pid}"
+                utils_metrics.inc('proc_ops_collect_kills_total', reason='threshold')
+                utils_execute_cmd_by_ssh(ssh_client, p_proc_metric.ip, cmd_kill_proc_by_id, cur_logger, p_proc_metric.cmd_prompt.cmd_timeout)
+        except UTILS_SSH_CMD_ERRORS:
+            # Connected but silent, counted like a failed connect instead of a crash
+            silent = True
+            self._record_disconn(p_proc_metric)
+        finally:
+            self.ssh_pool.release(p_proc_metric.ip, ssh_client, silent)
+            if silent:
+                self.ssh_pool.discard(p_proc_metric.ip)
+
+    def _record_sample(self, p_proc_metric):
+        self._record_history(p_proc_metric)
+        utils_metrics.inc('proc_ops_collect_samples_total', status=p_proc_metric.proc_status.value)
+        if self.cfg_mgr.proc_name:
+            self._publish_pid_fact(p_proc_metric)
+        with utils_metrics.timer('proc_ops_collect_phase_seconds', phase='log'):
+            cur_logger.info('[Host: {host}], [Status: {status}], [PID Change Cnt: {pid_change_cnt}], [Launch: {launch}], [PID: {pid}], [mem_ram_free: {mem_ram_free}], [mem_vsz: {mem_vsz}], [cpu_pct: {cpu_pct}]',
+                            host=p_proc_metric.ip, status=p_proc_metric.proc_status.value, pid_change_cnt=p_proc_metric.pid_change_cnt, launch=p_proc_metric.launch_type.value,
+                            pid=p_proc_metric.pid, mem_ram_free=p_proc_metric.mem_ram_free, mem_vsz=p_proc_metric.mem_vsz, cpu_pct=p_proc_metric.cpu_pct)
+
+    def _need_threshold_kill(self, p_proc_metric):
+        # In valgrind, kill proc if mem is exceed limit and so valgrind can save information
+        return (ProcLaunchType.VALGRIND == p_proc_metric.launch_type) and (p_proc_metric.mem_ram_free < self.cfg_mgr.mem_ram_free_th_min) and (p_proc_metric.pid != '')
+
+    def _adopt_pid_fact(self, p_proc_metric):
+        # A fresh 'pidof' answer from proc_task_executor saves the top scan of the /proc probe, the comm is checked on the first probe
+        if (ProcProbeType.PROC != self.cfg_mgr.prompt_misc.probe_type) or (p_proc_metric.probe_pid != ''):
+            return
+        pids = (utils_result_cache.get(p_proc_metric.ip, f'pid:{self.cfg_mgr.proc_name}') or '').split()
+        if len(pids) == 1:
+            p_proc_metric.probe_adopt(pids[0], ProcLaunchType.NORMAL, self.cfg_mgr.proc_name[:15])    # /proc comm is cut to 15 chars
+
+    def _publish_pid_fact(self, p_proc_metric):
+        # Same shape as the stdout of 'pidof', valgrind runs are skipped since pidof would not report them under proc_name
+        if (ProcStatusType.NORMAL == p_proc_metric.proc_status) and (ProcLaunchType.NORMAL == p_proc_metric.launch_type) and p_proc_metric.pid:
+            # Valid until the host is sampled again, no longer than get_pid itself would trust its answer
+            ttl = self.scheduler.interval_of(p_proc_metric.ip) if self.scheduler is not None else self.cfg_mgr.collect_interval
+            utils_result_cache.put(p_proc_metric.ip, f'pid:{self.cfg_mgr.proc_name}', f'{p_proc_metric.pid}\n', min(ttl, self.cfg_mgr.proc_fact_ttl))
+        else:
+            # Crashed, unreachable or under valgrind, a pid published before is dead or not the normal launch any more
+            utils_result_cache.invalidate(p_proc_metric.ip, f'pid:{self.cfg_mgr.proc_name}')
+
+    def _claim_kill(self, p_proc_metric):
+        # -> True for the first path deciding to kill this pid, a failed kill is not resent, a restarted process has a new pid
+        with self._kill_lock:
+            if self.killed.get(p_proc_metric.ip) == p_proc_metric.pid:
+                return False
+            self.killed[p_proc_metric.ip] = p_proc_metric.pid
+            return True
+
+    def _kill_host(self, p_proc_metric, p_reason):
+        utils_metrics.inc('proc_ops_collect_kills_total', reason='predicted' if p_reason.startswith('predicted') else 'threshold')
+        cur_logger.info('To kill process[{}] of [Host: {}] for {}', p_proc_metric.pid, p_proc_metric.ip, p_reason, host=p_proc_metric.ip)
+        try:
+            with self.ssh_pool.connection(p_proc_metric.ip) as ssh_client:
+                utils_execute_cmd_by_ssh(ssh_client, p_proc_metric.ip, f"{self.cfg_mgr.prompt_misc.cmd_kill} {p_proc_metric.pid}", cur_logger, self.cfg_mgr.prompt_misc.cmd_timeout)
+        except Exception as e:
+            cur_logger.error('Failed to kill process[{}] of [Host: {}]: {}', p_proc_metric.pid, p_proc_metric.ip, e, host=p_proc_metric.ip)
+
+    def _analyze_leaks(self, p_executor, p_proc_metrics):
+        window, valid = self.history.latest(self.cfg_mgr.leak_window)
+        trend = proc_metrics_leak_trend(window, valid, PROC_STATUS_CODES[ProcStatusType.NORMAL], self.cfg_mgr.mem_ram_free_th_min, self.cfg_mgr.leak_min_samples, self.cfg_mgr.leak_min_r2)
+
+        # Kill valgrind early enough that the expected exhaustion is still safety_margin away after the next sample,
+        # hosts already below the threshold were killed during collection, kills run on the executor and log their own
+        # failure, a silent host must not stall the loop for connect_timeout + cmd_timeout
+        for cur_proc_metric in p_proc_metrics:
+            index = self.history.host_index.get(cur_proc_metric.ip)
+            if (index is None) or (ProcLaunchType.VALGRIND != cur_proc_metric.launch_type) or (ProcStatusType.NORMAL != cur_proc_metric.proc_status):
+                continue
+            kill_horizon = self.cfg_mgr.leak_safety_margin + (self.scheduler.interval_of(cur_proc_metric.ip) if self.scheduler else self.cfg_mgr.collect_interval)
+            if (cur_proc_metric.mem_ram_free >= self.cfg_mgr.mem_ram_free_th_min) and (trend['tte'][index] <= kill_horizon) and self._claim_kill(cur_proc_metric):
+                reason = f"predicted exhaustion in [{trend['tte'][index]:.0f}] seconds <= [{kill_horizon:.0f}], [slope_free: {trend['slope_free'][index] * 60:.1f} KB/min]"
+                p_executor.submit(self._kill_host, cur_proc_metric, reason)
+
+        ranked = [cur_index for cur_index in numpy.argsort(-trend['leak_score'], kind='stable')[:self.cfg_mgr.leak_top_n] if trend['leak_score'][cur_index] > 0]
+        cur_logger.info('Top leakers')
+        for cur_index in ranked:
+            cur_logger.info('        [Host: {:>15}], [leak_score: {:8.4f}], [slope_free: {:10.1f} KB/min], [slope_vsz: {:8.2f} MB/min], [r2_free: {:.2f}], [tte: {:.0f} s], [samples: {}]',
+                            self.history.hosts[cur_index], trend['leak_score'][cur_index], trend['slope_free'][cur_index] * 60, trend['slope_vsz'][cur_index] * 60,
+                            trend['r2_free'][cur_index], trend['tte'][cur_index], trend['samples_cnt'][cur_index], host=self.history.hosts[cur_index])
+
+    def _log_summary(self, p_round_counter, p_executor, p_proc_metrics):
+        # Built from the current state of every host, whenever each of them was sampled last
+        begin = time.perf_counter()
+        shard = f', shard: {self.cfg_mgr.shard_index}/{self.cfg_mgr.shard_count}' if self.cfg_mgr.shard_count > 1 else ''
+        cur_logger.info('-' * 50 + f'Round: {p_round_counter}{shard}' + '-' * 50)
+        fail_cnts = self.scheduler.fail_cnts if self.scheduler else self.stream_monitor.fail_cnts if self.stream_monitor else {}
+        ips_disconn = [cur_proc_metric.ip for cur_proc_metric in p_proc_metrics if ProcStatusType.DISCONN == cur_proc_metric.proc_status]
+        pid_change_counts_histogram = numpy.histogram([metric.pid_change_cnt for metric in p_proc_metrics], PROC_METRICS_HISTOGRAM_X)
+        summary = {'round': p_round_counter, 'hosts': len(p_proc_metrics), 'ips_disconn': ips_disconn,
+                   'fail_cnts': {cur_ip: fail_cnts.get(cur_ip, 0) for cur_ip in ips_disconn},
+                   'ips_crash': [cur_proc_metric.ip for cur_proc_metric in p_proc_metrics if ProcStatusType.CRASH == cur_proc_metric.proc_status],
+                   'histogram': [int(cur_cnt) for cur_cnt in pid_change_counts_histogram[0]]}
+        if self.report is None:
+            proc_metrics_summary_log(summary)
+        else:
+            try:
+                self.report(summary)
+            except Exception as e:
+                cur_logger.error(f'Failed to report the summary of round [{p_round_counter}]: {e}')
+        utils_log_limiter.summary(cur_logger)
+
+        self._analyze_leaks(p_executor, p_proc_metrics)
+        self.history.maybe_flush()
+
+        if self.scheduler is not None:
+            intervals = numpy.array([self.scheduler.interval_of(cur_proc_metric.ip) for cur_proc_metric in p_proc_metrics]) if p_proc_metrics else numpy.zeros(1)
+            cur_logger.info(f'Polling intervals: [min: {intervals.min():.0f} s], [median: {numpy.median(intervals):.0f} s], [max: {intervals.max():.0f} s]')
+        utils_metrics.observe('proc_ops_collect_summary_seconds', time.perf_counter() - begin)
+
+    def _metrics(self):
+        # Current state of every host, read at scrape time
+        status, mem_ram_free, mem_vsz, cpu_pct, pid_changes, intervals = [], [], [], [], [], []
+        with self._proc_metrics_lock:
+            proc_metrics = list(self.proc_metrics.values())
+        for cur_proc_metric in proc_metrics:
+            labels = {'host': cur_proc_metric.ip}
+            status.append((dict(labels, status=cur_proc_metric.proc_status.value, launch=cur_proc_metric.launch_type.value), PROC_STATUS_CODES[cur_proc_metric.proc_status]))
+            mem_ram_free.append((labels, cur_proc_metric.mem_ram_free))
+            mem_vsz.append((labels, cur_proc_metric.mem_vsz))
+            cpu_pct.append((labels, cur_proc_metric.cpu_pct))
+            pid_changes.append((labels, cur_proc_metric.pid_change_cnt))
+            if self.scheduler is not None:
+                intervals.append((labels, self.scheduler.interval_of(cur_proc_metric.ip)))
+        ret_metrics = [('proc_ops_proc_status', 'gauge', 'Status code per host, 0 unknown, 1 normal, 2 disconnected, 3 crashed', status),
+                       ('proc_ops_proc_mem_ram_free_kb', 'gauge', 'Free memory of the host in KB', mem_ram_free),
+                       ('proc_ops_proc_mem_vsz_mb', 'gauge', 'VSZ of the process in MB', mem_vsz),
+                       ('proc_ops_proc_cpu_pct', 'gauge', 'CPU percent of the process', cpu_pct),
+                       ('proc_ops_proc_pid_changes_total', 'counter', 'PID changes seen per host', pid_changes),
+                       ('proc_ops_collect_interval_seconds', 'gauge', 'Current polling interval per host', intervals)]
+        if self.stream_monitor is not None:
+            ret_metrics.append(('proc_ops_collect_streams', 'gauge', 'Open sampling streams', [({}, len(self.stream_monitor.streams))]))
+        return ret_metrics
+
+    def _reload_cfg(self):
+        # Only added and removed hosts are touched, the others keep their metric state, schedule, stream and pooled connections
+        remote_cmd = self.stream_monitor._remote_cmd() if self.stream_monitor is not None else None
+        diff = self.cfg_mgr.reload()
+        if diff is None:
+            return
+        added, removed = diff
+        self.ssh_pool.configure(self.cfg_mgr.username, self.cfg_mgr.password, self.cfg_mgr.connect_timeout, self.cfg_mgr.ssh_keepalive_interval,
+                                self.cfg_mgr.ssh_idle_timeout, self.cfg_mgr.ssh_health_check_idle, self.cfg_mgr.ssh_max_conns)
+        utils_log_limiter.interval = self.cfg_mgr.log_repeat_interval
+        for cur_proc_metric in self.proc_metrics.values():
+            cur_proc_metric.cmd_prompt = self.cfg_mgr.prompt_misc    # matcher, commands and probe mode recompiled by the load
+
+        with self._proc_metrics_lock:
+            for cur_ip in removed:
+                self.proc_metrics.pop(cur_ip, None)
+            for cur_ip in added:
+                self.proc_metrics[cur_ip] = ProcMetric(cur_ip, self.cfg_mgr.prompt_misc)
+        for cur_ip in removed:
+            with self._kill_lock:
+                self.killed.pop(cur_ip, None)
+            self.ssh_pool.discard(cur_ip)
+            utils_result_cache.invalidate(cur_ip)
+        self.history.set_hosts(self.cfg_mgr.ips_of_proc)
+
+        if self.scheduler is not None:
+            self.scheduler.remove_hosts(removed)
+            self.scheduler.add_hosts(added, time.monotonic(), p_spread=False)
+        if self.stream_monitor is not None:
+            self.stream_monitor.remove_hosts(removed)
+            if self.stream_monitor._remote_cmd() != remote_cmd:
+                # The remote loops run the old command or interval, restart them
+                kept = [cur_ip for cur_ip in self.proc_metrics if cur_ip not in added]
+                self.stream_monitor.remove_hosts(kept)
+                self.stream_monitor.add_hosts(kept)
+            self.stream_monitor.add_hosts(added)
+        cur_logger.info('ProcMetricsCollector reloaded [{}]: [added: {}], [removed: {}], [hosts: {}]', self.cfg_mgr.cfg_file, added, removed, len(self.proc_metrics),
+                        added=added, removed=removed)
+
+    def _start_stream(self, p_proc_metrics):
+        self.stream_monitor = ProcMetricsStreamMonitor(self, p_proc_metrics)
+        round_counter = 0
+        next_summary = time.monotonic() + self.cfg_mgr.collect_interval
+        next_reload = time.monotonic() + self.cfg_mgr.reload_interval
+        try:
+            with ThreadPoolExecutor(max_workers=self.cfg_mgr.max_concurrency) as executor:
+                while not self.stop_event.is_set():
+                    if self.cfg_mgr.reload_interval and (time.monotonic() >= next_reload):
+                        self._reload_cfg()
+                        next_reload = time.monotonic() + self.cfg_mgr.reload_interval
+                    self.stream_monitor.poll(executor, min(next_summary - time.monotonic(), 1))
+                    if time.monotonic() >= next_summary:
+                        self._log_summary(round_counter, executor, list(p_proc_metrics.values()))
+                        round_counter += 1
+                        next_summary = max(next_summary + self.cfg_mgr.collect_interval, time.monotonic())
+        finally:
+            self.stream_monitor.close()
+            self.history.flush()
+            self.ssh_pool.close_all()
 
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def start(self):
+        proc_metrics = {cur_ip: ProcMetric(cur_ip, self.cfg_mgr.prompt_misc) for cur_ip in self.cfg_mgr.ips_of_proc}
+        self.proc_metrics = proc_metrics
+        utils_metrics.add_collector(self._metrics)
+        utils_metrics_serve(self.cfg_mgr.metrics_port)
+        self.history = ProcMetricsHistory(self.cfg_mgr.ips_of_proc, self.cfg_mgr.history_capacity, self.cfg_mgr.history_downsample_factor,
+                                          self.cfg_mgr.history_flush_file, self.cfg_mgr.history_flush_interval, cur_logger)
+        if self.cfg_mgr.collect_mode == 'stream':
+            return self._start_stream(proc_metrics)
+
+        self.scheduler = ProcMetricsScheduler(self.cfg_mgr)
+        self.scheduler.add_hosts(proc_metrics, time.monotonic())
 
         round_counter = 0
+        next_summary = time.monotonic() + self.cfg_mgr.collect_interval
+        next_reload = time.monotonic() + self.cfg_mgr.reload_interval
+        inflight = {}    # future -> ProcMetric
         try:
-            while True:
-                cur_logger.info('-' * 50 + f'Round: {round_counter}' + '-' * 50)
-                round_counter += 1
-                for cur_proc_metric in proc_metrics:
-                    try:
-                        ssh_client.connect(hostname=cur_proc_metric.ip, username=self.cfg_mgr.username, password=self.cfg_mgr.password, timeout=8)
-                        cur_proc_metric.metric_collect(ssh_client)
-                    except Exception as e:
-                        cur_proc_metric.metric_update_by_disconn()
-                        cur_logger.error(f"Failed to ssh_client.connect[host: {cur_proc_metric.ip}]:\n    except: {e}")
-                    finally:
-                        ssh_client.close()
-
-                    cur_logger.info(f"[Host: {cur_proc_metric.ip}], [Status: {cur_proc_metric.proc_status.value}], [PID Change Cnt: {cur_proc_metric.pid_change_cnt}], [Launch: {cur_proc_metric.launch_type.value}], [PID: {cur_proc_metric.pid}], [mem_ram_free: {cur_proc_metric.mem_ram_free}], [mem_vsz: {cur_proc_metric.mem_vsz}], [cpu_pct: {cur_proc_metric.cpu_pct}]")
-
-                    # In valgrind, kill proc if mem is exceed limit and so valgrind can save information
-                    if (ProcLaunchType.VALGRIND == cur_proc_metric.launch_type) and (cur_proc_metric.mem_ram_free < self.cfg_mgr.mem_ram_free_th_min) and (cur_proc_metric.pid != ''):
-                        cur_logger.info(f'To kill process[{cur_proc_metric.pid}] for mem_ram_free[{cur_proc_metric.mem_ram_free}] < p_mem_ram_free_th_min[{self.cfg_mgr.mem_ram_free_th_min}]')
-                        cmd_kill_proc_by_id = f"{self.cfg_mgr.prompt_misc.cmd_kill} {cur_proc_metric.pid}"
-                        utils_execute_cmd_by_ssh(ssh_client, cur_proc_metric.ip, cmd_kill_proc_by_id, cur_logger)
-
-                ips_disconn = [cur_proc_metric.ip for cur_proc_metric in proc_metrics if ProcStatusType.DISCONN == cur_proc_metric.proc_status]
-                ips_crash = [cur_proc_metric.ip for cur_proc_metric in proc_metrics if ProcStatusType.CRASH == cur_proc_metric.proc_status]
-                cur_logger.info(f'Disconnect processes:')
-                for cur_ip in ips_disconn:
-                    cur_logger.info(f'        [Host: {cur_ip}]')
-                cur_logger.info(f'Crash processes:')
-                for cur_ip in ips_crash:
-                    cur_logger.info(f'        [Host: {cur_ip}]')
-
-                # 计算进程变化的直方图
-                cur_logger.info(f'The histogram of process changes')
-                pid_change_counts = [metric.pid_change_cnt for metric in proc_metrics]
-                histogram_x = [0, 1, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 500, 1000, 999999]
-                pid_change_counts_histogram = numpy.histogram(pid_change_counts, histogram_x)
-                for index in range(len(histogram_x) - 1):
-                    cur_logger.info(f'        [{histogram_x[index]:8d} -- {histogram_x[index + 1]:8d}] change counter is [{int(pid_change_counts_histogram[0][index]):12d}]')
-
-                time.sleep(self.cfg_mgr.collect_interval)
+            with ThreadPoolExecutor(max_workers=self.cfg_mgr.max_concurrency) as executor:
+                while not self.stop_event.is_set():
+                    if self.cfg_mgr.reload_interval and (time.monotonic() >= next_reload):
+                        self._reload_cfg()
+                        next_reload = time.monotonic() + self.cfg_mgr.reload_interval
+                    now = time.monotonic()
+                    inflight_ips = {cur_proc_metric.ip for cur_proc_metric in inflight.values()}
+                    for cur_ip, cur_due in self.scheduler.pop_due(now):
+                        if (cur_ip in inflight_ips) or (cur_ip not in proc_metrics):
+                            continue    # still running, rescheduled when it finishes
+                        inflight[executor.submit(self._collect_host, proc_metrics[cur_ip], cur_due)] = proc_metrics[cur_ip]
+
+                    next_due = self.scheduler.next_due()
+                    next_wakeup = min(next_summary, next_reload) if self.cfg_mgr.reload_interval else next_summary
+                    timeout = max(0, min(next_wakeup, next_due if next_due is not None else next_wakeup) - now)
+                    if inflight:
+                        done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+                    else:
+                        done = set()
+                        self.stop_event.wait(timeout)
+
+                    for cur_future in done:
+                        cur_proc_metric = inflight.pop(cur_future)
+                        try:
+                            cur_future.result()
+                        except Exception as e:
+                            cur_logger.error('Failed to collect [Host: {}]: {}', cur_proc_metric.ip, e, host=cur_proc_metric.ip)
+                        self.scheduler.reschedule(cur_proc_metric, time.monotonic())
+
+                    if time.monotonic() >= next_summary:
+                        self._log_summary(round_counter, executor, list(proc_metrics.values()))
+                        round_counter += 1
+                        next_summary = max(next_summary + self.cfg_mgr.collect_interval, time.monotonic())
         finally:
-            ssh_client.close()
+            self.history.flush()
+            self.ssh_pool.close_all()
 
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import numpy
+import threading
+
+
+PROC_METRICS_HISTORY_DTYPE = numpy.dtype([
+    ('ts', 'f8'),              # epoch second, 0 marks an empty slot
+    ('status', 'i1'),          # code of ProcStatusType, see PROC_STATUS_CODES
+    ('pid', 'i4'),             # 0 when no process was found
+    ('mem_ram_free', 'i8'),    # KB
+    ('mem_vsz', 'f4'),         # MB
+    ('cpu_pct', 'f4'),
+])
+
+
+class ProcMetricsRing:
+    # Preallocated [host, slot] ring, heads is the next slot to write and counts the samples ever written per host
+    def __init__(self, p_host_cnt, p_capacity):
+        self.capacity = p_capacity
+        self.samples = numpy.zeros((p_host_cnt, p_capacity), dtype=PROC_METRICS_HISTORY_DTYPE)
+        self.heads = numpy.zeros(p_host_cnt, dtype=numpy.int64)
+        self.counts = numpy.zeros(p_host_cnt, dtype=numpy.int64)
+
+    def append(self, p_index, p_sample):
+        # -> the sample that was overwritten, None while the ring is not full
+        head = self.heads[p_index]
+        evicted = self.samples[p_index, head].copy() if self.counts[p_index] >= self.capacity else None
+        self.samples[p_index, head] = p_sample
+        self.heads[p_index] = (head + 1) % self.capacity
+        self.counts[p_index] += 1
+        return evicted
+
+    def ordered(self, p_index):
+        valid = min(int(self.counts[p_index]), self.capacity)
+        return numpy.roll(self.samples[p_index], -int(self.heads[p_index]))[self.capacity - valid:]
+
+    def latest(self, p_size):
+        # -> ([host, p_size] samples oldest to newest, [host, p_size] valid mask), for every host at once
+        size = min(p_size, self.capacity)
+        offsets = numpy.arange(size - 1, -1, -1)
+        slots = (self.heads[:, None] - 1 - offsets[None, :]) % self.capacity
+        window = numpy.take_along_axis(self.samples, slots, axis=1)
+        valid = offsets[None, :] < numpy.minimum(self.counts, self.capacity)[:, None]
+        return window, valid
+
+    def remap(self, p_old_hosts, p_new_hosts):
+        # Rows follow their host, new hosts start empty
+        new_ring = ProcMetricsRing(len(p_new_hosts), self.capacity)
+        old_index = {cur_ip: cur_index for cur_index, cur_ip in enumerate(p_old_hosts)}
+        for cur_new_index, cur_ip in enumerate(p_new_hosts):
+            if cur_ip in old_index:
+                new_ring.samples[cur_new_index] = self.samples[old_index[cur_ip]]
+                new_ring.heads[cur_new_index] = self.heads[old_index[cur_ip]]
+                new_ring.counts[cur_new_index] = self.counts[old_index[cur_ip]]
+        return new_ring
+
+
+class ProcMetricsHistory:
+    def __init__(self, p_hosts, p_capacity=2880, p_downsample_factor=0, p_flush_file='', p_flush_interval=300, p_logger=None):
+        self.hosts = list(p_hosts)
+        self.host_index = {cur_ip: cur_index for cur_index, cur_ip in enumerate(self.hosts)}
+        self.capacity = p_capacity
+        self.downsample_factor = p_downsample_factor    # every n-th sample leaving the fine ring is kept in the coarse ring, 0 disables
+        self.flush_file = p_flush_file                  # prefix of <prefix>.fine.npy, <prefix>.coarse.npy and <prefix>.meta.json
+        self.flush_interval = p_flush_interval          # second
+        self.logger = p_logger
+
+        self.fine = ProcMetricsRing(len(self.hosts), self.capacity)
+        self.coarse = ProcMetricsRing(len(self.hosts), self.capacity) if self.downsample_factor > 1 else None
+
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        if self.flush_file:
+            self._load()
+
+    def append(self, p_host_ip, p_ts, p_status, p_pid, p_mem_ram_free, p_mem_vsz, p_cpu_pct):
+        # Looked up under the lock, set_hosts swaps the index and the rings together
+        with self._lock:
+            index = self.host_index.get(p_host_ip)
+            if index is None:
+                return
+            evicted = self.fine.append(index, (p_ts, p_status, p_pid, p_mem_ram_free, p_mem_vsz, p_cpu_pct))
+            if (evicted is not None) and (self.coarse is not None) and ((self.fine.counts[index] - self.capacity - 1) % self.downsample_factor == 0):
+                self.coarse.append(index, evicted)
+
+    def host_series(self, p_host_ip, p_coarse=False):
+        # -> samples of one host oldest to newest, coarse ones are older than every fine one
+        with self._lock:
+            ring = self.coarse if p_coarse else self.fine
+            if (ring is None) or (p_host_ip not in self.host_index):
+                return numpy.zeros(0, dtype=PROC_METRICS_HISTORY_DTYPE)
+            return ring.ordered(self.host_index[p_host_ip])
+
+    def latest(self, p_size):
+        with self._lock:
+            return self.fine.latest(p_size)
+
+    def set_hosts(self, p_hosts):
+        with self._lock:
+            new_hosts = list(p_hosts)
+            self.fine = self.fine.remap(self.hosts, new_hosts)
+            if self.coarse is not None:
+                self.coarse = self.coarse.remap(self.hosts, new_hosts)
+            self.hosts = new_hosts
+            self.host_index = {cur_ip: cur_index for cur_index, cur_ip in enumerate(self.hosts)}
+
+    def _paths(self):
+        return f'{self.flush_file}.fine.npy', f'{self.flush_file}.coarse.npy', f'{self.flush_file}.meta.json'
+
+    @staticmethod
+    def _write_memmap(p_path, p_samples):
+        memmap = None
+        if os.path.exists(p_path):
+            memmap = numpy.lib.format.open_memmap(p_path, mode='r+')
+            if (memmap.shape != p_samples.shape) or (memmap.dtype != p_samples.dtype):
+                del memmap
+                memmap = None
+        if memmap is None:
+            memmap = numpy.lib.format.open_memmap(p_path, mode='w+', dtype=p_samples.dtype, shape=p_samples.shape)
+        memmap[...] = p_samples
+        memmap.flush()
+        del memmap
+
+    def flush(self):
+        if not self.flush_file:
+            return
+        fine_path, coarse_path, meta_path = self._paths()
+        os.makedirs(os.path.dirname(os.path.abspath(self.flush_file)), exist_ok=True)
+        with self._lock:
+            self._write_memmap(fine_path, self.fine.samples)
+            if self.coarse is not None:
+                self._write_memmap(coarse_path, self.coarse.samples)
+            meta = {'hosts': self.hosts, 'capacity': self.capacity, 'downsample_factor': self.downsample_factor,
+                    'fine': {'heads': self.fine.heads.tolist(), 'counts': self.fine.counts.tolist()},
+                    'coarse': {'heads': self.coarse.heads.tolist(), 'counts': self.coarse.counts.tolist()} if self.coarse is not None else None}
+        # Meta is replaced atomically once the rows are on disk, a reader never sees a half written meta
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        self._last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        if self.flush_file and (time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _load(self):
+        fine_path, coarse_path, meta_path = self._paths()
+        if not (os.path.exists(meta_path) and os.path.exists(fine_path)):
+            return
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['capacity'] != self.capacity:
+                raise ValueError(f"capacity changed [{meta['capacity']}] -> [{self.capacity}]")
+
+            for cur_ring, cur_path, cur_meta in ((self.fine, fine_path, meta['fine']), (self.coarse, coarse_path, meta['coarse'])):
+                if (cur_ring is None) or (cur_meta is None) or (not os.path.exists(cur_path)):
+                    continue
+                stored = ProcMetricsRing(len(meta['hosts']), self.capacity)
+                stored.samples[...] = numpy.load(cur_path, mmap_mode='r')
+                stored.heads[...] = cur_meta['heads']
+                stored.counts[...] = cur_meta['counts']
+                restored = stored.remap(meta['hosts'], self.hosts)
+                cur_ring.samples, cur_ring.heads, cur_ring.counts = restored.samples, restored.heads, restored.counts
+            if self.logger is not None:
+                self.logger.info(f'ProcMetricsHistory restored from [{self.flush_file}]: [hosts: {len(meta["hosts"])}], [samples: {int(self.fine.counts.sum())}]')
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(f'ProcMetricsHistory failed to restore from [{self.flush_file}], start empty: {e}')
+
+
+def proc_metrics_leak_trend(p_window, p_valid, p_status_normal, p_mem_ram_free_th_min, p_min_samples=6, p_min_r2=0.5):
+    # One batched least squares pass over [host, sample] windows, only samples of the latest pid in normal status count
+    # -> dict of [host] arrays:
+    #   slope_free   KB/s of free memory, slope_vsz MB/s of VSZ, r2_free/r2_vsz quality of the linear fit
+    #   tte          seconds until free memory reaches p_mem_ram_free_th_min, inf when it is not falling or the fit is below p_min_r2
+    #   leak_score   share of the current free memory (or VSZ) eaten per hour, weighted by r2, 0 for no trend
+    latest_pid = p_window['pid'][:, -1]
+    mask = p_valid & (p_window['status'] == p_status_normal) & (p_window['pid'] == latest_pid[:, None]) & (latest_pid[:, None] != 0)
+    weights = mask.astype(numpy.float64)
+    samples_cnt = weights.sum(axis=1)
+    enough = samples_cnt >= max(p_min_samples, 2)
+    safe_cnt = numpy.maximum(samples_cnt, 1)
+
+    ts = p_window['ts'] - p_window['ts'][:, -1:]    # relative time keeps the float64 sums exact
+    mean_ts = (ts * weights).sum(axis=1) / safe_cnt
+    d_ts = (ts - mean_ts[:, None]) * weights
+    var_ts = (d_ts * d_ts).sum(axis=1)
+    fit = enough & (var_ts > 0)
+    safe_var_ts = numpy.where(fit, var_ts, 1)
+
+    def closure_fit(p_values):
+        values = p_values.astype(numpy.float64)
+        mean_values = (values * weights).sum(axis=1) / safe_cnt
+        d_values = (values - mean_values[:, None]) * weights
+        cov = (d_ts * d_values).sum(axis=1)
+        var_values = (d_values * d_values).sum(axis=1)
+        slope = numpy.where(fit, cov / safe_var_ts, 0.0)
+        r2 = numpy.where(fit & (var_values > 0), cov * cov / (safe_var_ts * numpy.where(var_values > 0, var_values, 1)), 0.0)
+        return slope, r2
+
+    slope_free, r2_free = closure_fit(p_window['mem_ram_free'])
+    slope_vsz, r2_vsz = closure_fit(p_window['mem_vsz'])
+
+    latest_free = p_window['mem_ram_free'][:, -1].astype(numpy.float64)
+    latest_vsz = p_window['mem_vsz'][:, -1].astype(numpy.float64)
+    falling = fit & (slope_free < 0) & (r2_free >= p_min_r2)
+    tte = numpy.full(len(latest_free), numpy.inf)
+    tte[falling] = numpy.maximum(latest_free[falling] - p_mem_ram_free_th_min, 0) / -slope_free[falling]
+
+    score_free = numpy.clip(-slope_free, 0, None) * 3600 / numpy.maximum(latest_free, 1) * r2_free
+    score_vsz = numpy.clip(slope_vsz, 0, None) * 3600 / numpy.maximum(latest_vsz, 1) * r2_vsz
+    return {'samples_cnt': samples_cnt.astype(numpy.int64), 'slope_free': slope_free, 'r2_free': r2_free, 'slope_vsz': slope_vsz, 'r2_vsz': r2_vsz,
+            'tte': tte, 'leak_score': numpy.maximum(score_free, score_vsz)}
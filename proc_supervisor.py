@@ -0,0 +1,256 @@
+import os
+import sys
+import time
+import uuid
+import yaml
+import queue
+import numpy
+import signal
+import multiprocessing
+from loguru import logger
+
+from utils import logger_for_proc_supervisor as cur_logger, utils_result_cache
+from proc_metrics_collector import ProcMetricsCollector, PROC_METRICS_HISTOGRAM_X, proc_metrics_summary_log
+from proc_task_executor import ProcTaskExecutor
+
+
+# Workers are forked, they inherit the loaded modules and log through the queue of the supervisor's loguru sinks
+PROC_SUPERVISOR_CONTEXT = multiprocessing.get_context('fork')
+PROC_SUPERVISOR_COLLECTOR = 'collector'
+PROC_SUPERVISOR_EXECUTOR = 'executor'
+# Result cache keys relayed between the workers, a collector shard and an executor shard may own the same host
+PROC_SUPERVISOR_SHARED_FACTS = ('pid:',)
+
+
+class ProcSupervisorCfgMgr:
+    def __init__(self, p_cfg_file='proc_supervisor_cfg.yaml'):
+        self.cfg_file = p_cfg_file
+
+        self.collector_shards = 1       # worker processes of proc_metrics_collector, 0 does not run it
+        self.executor_shards = 1        # worker processes of proc_task_executor, one run each, 0 does not run it
+        self.summary_interval = 30      # second between two fleet summaries
+        self.stale_after = 90           # second, a collector shard without a round summary for this long is listed as missing
+        self.restart_backoff = 1        # second before a dead worker is started again, doubled per death in a row
+        self.restart_backoff_max = 60   # second
+        self.stable_after = 300         # second a worker has to live before its deaths in a row are forgotten
+        self.executor_max_restarts = 5  # per shard, an executor shard dying more often is given up
+        self.stop_timeout = 10          # second for the workers to exit on SIGTERM before they are killed
+
+        self._load_cfg()
+
+    def _load_cfg(self):
+        try:
+            if not os.path.exists(self.cfg_file):
+                raise FileNotFoundError(f"The file [{self.cfg_file}] does not exist!")
+
+            with open(self.cfg_file, 'r') as cfg:
+                config = yaml.safe_load(cfg)
+
+            general = config['proc_supervisor']['general']
+            self.collector_shards = general.get('collector_shards', self.collector_shards)
+            self.executor_shards = general.get('executor_shards', self.executor_shards)
+            self.summary_interval = general.get('summary_interval', self.summary_interval)
+            self.stale_after = general.get('stale_after', self.stale_after)
+            self.stop_timeout = general.get('stop_timeout', self.stop_timeout)
+
+            restart = config['proc_supervisor'].get('restart', {})
+            self.restart_backoff = restart.get('backoff', self.restart_backoff)
+            self.restart_backoff_max = restart.get('backoff_max', self.restart_backoff_max)
+            self.stable_after = restart.get('stable_after', self.stable_after)
+            self.executor_max_restarts = restart.get('executor_max_restarts', self.executor_max_restarts)
+
+            cur_logger.info(f'CfgMgrForProcSupervisor [collector_shards: {self.collector_shards}], [executor_shards: {self.executor_shards}], [summary_interval: {self.summary_interval}], [stale_after: {self.stale_after}], [stop_timeout: {self.stop_timeout}]')
+            cur_logger.info(f'CfgMgrForProcSupervisor [restart_backoff: {self.restart_backoff}], [restart_backoff_max: {self.restart_backoff_max}], [stable_after: {self.stable_after}], [executor_max_restarts: {self.executor_max_restarts}]')
+        except FileNotFoundError as e:
+            cur_logger.error(f"File Not Found: {e}")
+        except yaml.YAMLError as e:
+            cur_logger.error(f"Error parsing YAML file: {e}")
+        except Exception as e:
+            cur_logger.error(f"An unexpected error occurred: {e}")
+
+
+def proc_supervisor_share_facts(p_facts):
+    if p_facts is not None:
+        utils_result_cache.share(p_facts, PROC_SUPERVISOR_SHARED_FACTS)
+
+
+def proc_supervisor_run_collector(p_shard_index, p_shard_count, p_reports, p_facts=None):
+    logger.configure(extra={'shard': p_shard_index})
+    proc_supervisor_share_facts(p_facts)
+    collector = ProcMetricsCollector(p_shard_index, p_shard_count,
+                                     lambda p_summary: p_reports.put((PROC_SUPERVISOR_COLLECTOR, p_shard_index, p_summary)))
+    collector.start()
+
+
+def proc_supervisor_run_executor(p_shard_index, p_shard_count, p_run_id, p_reports, p_facts=None):
+    logger.configure(extra={'shard': p_shard_index})
+    proc_supervisor_share_facts(p_facts)
+    executor = ProcTaskExecutor(p_shard_index, p_shard_count)
+    begin = time.monotonic()
+    try:
+        results = executor.start(executor.cfg_mgr.results_run_id or p_run_id)
+    finally:
+        executor.stop()
+    success = sum(1 for cur_result in results.values() if cur_result['success'])
+    p_reports.put((PROC_SUPERVISOR_EXECUTOR, p_shard_index, {'hosts': len(executor.cfg_mgr.ips_of_proc), 'run': len(results), 'success': success,
+                                                             'failure': len(results) - success, 'seconds': time.monotonic() - begin}))
+
+
+class ProcSupervisorWorker:
+    # One shard of one component, its process is replaced when it dies, the other shards never notice
+    def __init__(self, p_component, p_shard_index, p_target, p_args):
+        self.component = p_component
+        self.shard_index = p_shard_index
+        self.name = f'{p_component}/{p_shard_index}'
+        self.target = p_target
+        self.args = p_args
+        self.process = None
+        self.started_at = 0         # monotonic
+        self.restart_at = None      # monotonic when a dead worker is started again, None while it runs or after it is done
+        self.deaths = 0             # in a row, forgotten once a process lives stable_after
+        self.restarts = 0
+        self.done = False           # an executor shard finished its run, or was given up
+
+    def spawn(self):
+        self.process = PROC_SUPERVISOR_CONTEXT.Process(target=self.target, args=self.args, name=f'proc_{self.component}_{self.shard_index}')
+        self.process.start()
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        cur_logger.info('ProcSupervisor started [{}]: [pid: {}], [restarts: {}]', self.name, self.process.pid, self.restarts,
+                        worker=self.name, pid=self.process.pid)
+
+
+class ProcSupervisor:
+    def __init__(self):
+        self.cfg_mgr = ProcSupervisorCfgMgr()
+        self.reports = PROC_SUPERVISOR_CONTEXT.Queue()
+        self.manager = None
+        self.facts = None               # (host, key) -> (value, expire_at) of the shared facts, a Manager dict when both components run
+        self.workers = []
+        self.run_id = ''
+        self.collector_summaries = {}   # shard -> (monotonic, latest round summary)
+        self.executor_summaries = {}    # shard -> run summary
+        self.fleet_round = 0
+
+    def _build_workers(self):
+        if self.cfg_mgr.collector_shards and self.cfg_mgr.executor_shards:
+            # The pid a collector shard samples spares the executor's pidof and the other way round, across processes
+            self.manager = PROC_SUPERVISOR_CONTEXT.Manager()
+            self.facts = self.manager.dict()
+        for cur_index in range(self.cfg_mgr.collector_shards):
+            self.workers.append(ProcSupervisorWorker(PROC_SUPERVISOR_COLLECTOR, cur_index, proc_supervisor_run_collector,
+                                                     (cur_index, self.cfg_mgr.collector_shards, self.reports, self.facts)))
+        if self.cfg_mgr.executor_shards > 0:
+            # Shared by the shards and kept over restarts, a restarted shard resumes its own results file
+            self.run_id = f"{time.strftime('%Y_%m_%d_%H_%M_%S')}_{uuid.uuid4().hex[:8]}"
+            for cur_index in range(self.cfg_mgr.executor_shards):
+                self.workers.append(ProcSupervisorWorker(PROC_SUPERVISOR_EXECUTOR, cur_index, proc_supervisor_run_executor,
+                                                         (cur_index, self.cfg_mgr.executor_shards, self.run_id, self.reports, self.facts)))
+
+    def _on_report(self, p_component, p_shard_index, p_summary):
+        if PROC_SUPERVISOR_COLLECTOR == p_component:
+            self.collector_summaries[p_shard_index] = (time.monotonic(), p_summary)
+            return
+        self.executor_summaries[p_shard_index] = p_summary
+        cur_logger.info('ProcSupervisor [executor/{}] done: [hosts: {}], [run: {}], [success: {}], [failure: {}], [seconds: {:.1f}]', p_shard_index,
+                        p_summary['hosts'], p_summary['run'], p_summary['success'], p_summary['failure'], p_summary['seconds'], **p_summary)
+        if len(self.executor_summaries) == self.cfg_mgr.executor_shards:
+            totals = {cur_key: sum(cur_summary[cur_key] for cur_summary in self.executor_summaries.values()) for cur_key in ('hosts', 'run', 'success', 'failure')}
+            cur_logger.info('ProcSupervisor executor [run_id: {}] done: [hosts: {}], [run: {}], [success: {}], [failure: {}]', self.run_id,
+                            totals['hosts'], totals['run'], totals['success'], totals['failure'], run_id=self.run_id, **totals)
+
+    def _drain_reports(self, p_timeout):
+        try:
+            self._on_report(*self.reports.get(timeout=p_timeout))
+            while True:
+                self._on_report(*self.reports.get_nowait())
+        except queue.Empty:
+            pass
+
+    def _check_workers(self, p_now):
+        for cur_worker in self.workers:
+            if cur_worker.done:
+                continue
+            if cur_worker.restart_at is not None:
+                if p_now >= cur_worker.restart_at:
+                    cur_worker.restarts += 1
+                    cur_worker.spawn()
+                continue
+            if cur_worker.process.is_alive():
+                continue
+
+            cur_worker.process.join()
+            exitcode = cur_worker.process.exitcode
+            if (PROC_SUPERVISOR_EXECUTOR == cur_worker.component) and (0 == exitcode):
+                cur_worker.done = True
+                continue
+            if PROC_SUPERVISOR_COLLECTOR == cur_worker.component:
+                self.collector_summaries.pop(cur_worker.shard_index, None)    # its hosts are unknown until it reports again
+            elif cur_worker.restarts >= self.cfg_mgr.executor_max_restarts:
+                cur_worker.done = True
+                cur_logger.error('ProcSupervisor [{}] died [exitcode: {}] after [restarts: {}], given up', cur_worker.name, exitcode, cur_worker.restarts,
+                                 worker=cur_worker.name, exitcode=exitcode)
+                continue
+
+            if p_now - cur_worker.started_at >= self.cfg_mgr.stable_after:
+                cur_worker.deaths = 0
+            cur_worker.deaths += 1
+            delay = min(self.cfg_mgr.restart_backoff * (2 ** (cur_worker.deaths - 1)), self.cfg_mgr.restart_backoff_max)
+            cur_worker.restart_at = p_now + delay
+            cur_logger.warning('ProcSupervisor [{}] died [exitcode: {}], restart in [{:.1f} s]', cur_worker.name, exitcode, delay,
+                               worker=cur_worker.name, exitcode=exitcode)
+
+    def _log_fleet_summary(self, p_now):
+        # Latest round of every shard, each host counted by the one shard that owns it
+        fresh = {cur_index: cur_summary for cur_index, (cur_at, cur_summary) in self.collector_summaries.items() if p_now - cur_at <= self.cfg_mgr.stale_after}
+        missing = [cur_index for cur_index in range(self.cfg_mgr.collector_shards) if cur_index not in fresh]
+        cur_logger.info('-' * 50 + f'Fleet round: {self.fleet_round}, shards: {len(fresh)}/{self.cfg_mgr.collector_shards}' + '-' * 50)
+        if missing:
+            cur_logger.warning('ProcSupervisor collector shards without a recent round: {}', missing, round=self.fleet_round, shards=missing)
+
+        summary = {'round': self.fleet_round, 'hosts': 0, 'ips_disconn': [], 'fail_cnts': {}, 'ips_crash': [],
+                   'histogram': numpy.zeros(len(PROC_METRICS_HISTOGRAM_X) - 1, dtype=numpy.int64)}
+        for cur_summary in fresh.values():
+            summary['hosts'] += cur_summary['hosts']
+            summary['ips_disconn'].extend(cur_summary['ips_disconn'])
+            summary['fail_cnts'].update(cur_summary['fail_cnts'])
+            summary['ips_crash'].extend(cur_summary['ips_crash'])
+            summary['histogram'] += numpy.asarray(cur_summary['histogram'], dtype=numpy.int64)
+        summary['histogram'] = [int(cur_cnt) for cur_cnt in summary['histogram']]
+        cur_logger.info('ProcSupervisor fleet [hosts: {}]', summary['hosts'], round=self.fleet_round, hosts=summary['hosts'])
+        proc_metrics_summary_log(summary, cur_logger)
+        self.fleet_round += 1
+
+    def _stop_workers(self):
+        alive = [cur_worker.process for cur_worker in self.workers if (cur_worker.process is not None) and cur_worker.process.is_alive()]
+        for cur_process in alive:
+            cur_process.terminate()
+        deadline = time.monotonic() + self.cfg_mgr.stop_timeout
+        for cur_process in alive:
+            cur_process.join(max(deadline - time.monotonic(), 0))
+            if cur_process.is_alive():
+                cur_logger.warning(f'ProcSupervisor [{cur_process.name}] did not exit on SIGTERM, killed')
+                cur_process.kill()
+                cur_process.join()
+
+    def start(self):
+        # SIGTERM unwinds the supervisor and, inherited, every worker through its finally blocks
+        signal.signal(signal.SIGTERM, lambda p_signum, p_frame: sys.exit(128 + p_signum))
+        self._build_workers()
+        for cur_worker in self.workers:
+            cur_worker.spawn()
+
+        next_summary = time.monotonic() + self.cfg_mgr.summary_interval
+        try:
+            while any(not cur_worker.done for cur_worker in self.workers):
+                self._drain_reports(max(min(next_summary - time.monotonic(), 1), 0))
+                now = time.monotonic()
+                self._check_workers(now)
+                if self.cfg_mgr.collector_shards and (now >= next_summary):
+                    self._log_fleet_summary(now)
+                    next_summary = max(next_summary + self.cfg_mgr.summary_interval, now)
+            self._drain_reports(0)
+        finally:
+            self._stop_workers()
+            if self.manager is not None:
+                self.manager.shutdown()
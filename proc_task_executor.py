@@ -1,52 +1,179 @@
 
 import os
+import re
 import time
+import uuid
 import yaml
+import shlex
+import socket
 import enum
 import numpy
 import queue
-import paramiko
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import heapq
+import asyncio
+import selectors
+import threading
+import itertools
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
-from utils import logger_for_proc_task_executor as cur_logger, utils_execute_cmd_by_ssh
+from utils import logger_for_proc_task_executor as cur_logger, utils_execute_cmd_by_ssh, UtilsSSHConnPool, utils_result_cache, utils_metrics, utils_metrics_serve
+from utils import UTILS_SHARD_PORT_STRIDE, utils_shard_ips
+from proc_task_results import ProcTaskResultsSink, ProcTaskOutputCapture
+from proc_task_fetch import ProcTaskFetcher
+
+
+# One concrete command of a task group, cache_key names the cached answer (a shared fact like 'pid:kvm4' or the command), cache_ttl 0 never caches,
+# fetch is the remote path pattern of a retrieval over SFTP, command then only names the task in its result
+ProcTask = collections.namedtuple('ProcTask', ['group', 'command', 'cache_key', 'cache_ttl', 'fetch'], defaults=(None,))
+
+PROC_TASK_READ_CHUNK = 65536    # bytes per read of a command output
+PROC_TASK_ABORT_WAIT = 5        # second the attempts stopped by a deadline or cancel get to unwind once their connection is closed
+
+utils_metrics.describe('proc_ops_task_attempt_seconds', 'histogram', 'Duration of one attempt on a host, connect to last output read')
+utils_metrics.describe('proc_ops_task_retries_total', 'counter', 'Retries scheduled per host')
+utils_metrics.describe('proc_ops_task_results_total', 'counter', 'Finished hosts per outcome')
+utils_metrics.describe('proc_ops_task_circuit_open_total', 'counter', 'Hosts failed fast by an open circuit')
+utils_metrics.describe('proc_ops_task_run_seconds', 'histogram', 'Duration of a whole run over every host')
+utils_metrics.describe('proc_ops_task_concurrency_limit', 'gauge', 'Hosts allowed in flight by the adaptive limiter')
+utils_metrics.describe('proc_ops_task_inflight', 'gauge', 'Hosts with an attempt running')
 
 
 
 class ProcTaskExecutorCfgMgr:
-    def __init__(self, p_cfg_file='proc_task_executor_cfg.yaml'):
+    # Kept from the first load by reload(), the endpoint is bound once
+    RESTART_ONLY = ('metrics_port',)
+
+    def __init__(self, p_cfg_file='proc_task_executor_cfg.yaml', p_shard_index=0, p_shard_count=1):
         self.cfg_file = p_cfg_file
+        self.shard_index = p_shard_index    # proc_supervisor worker, only the hosts of this shard are run
+        self.shard_count = p_shard_count
+        self.cfg_stamp = None       # (mtime ns, size) of the file when it was read
+        self.loaded = False         # the whole file was read without error
 
         self.max_concurrency = 4
         self.max_retries = 3        #
-        self.retry_interval = 1     # second
+        self.retry_interval = 1     # second, cool-down after a host's first failure, doubled per consecutive failure
+        self.retry_interval_max = 300      # second
+        self.breaker_threshold = 3         # consecutive failures of a host before its next first attempts fail fast while it cools down
+        self.adaptive_concurrency = True   # AIMD between min_concurrency and max_concurrency
+        self.min_concurrency = 1
+        self.initial_concurrency = 4       # hosts in flight before the first adjustment
+        self.concurrency_window = 8        # finished attempts per adjustment
+        self.concurrency_latency_target = 2.0    # second, p90 connect latency of a window above this halves the limit
+        self.concurrency_error_rate_max = 0.2    # failed share of a window above this halves the limit
+        self.group_limits = {}             # ip group -> hosts of that group in flight at once
+        self.ip_groups = {}                # ip -> first selected ip group listing it
+        self.connect_timeout = 8    # second
+        self.cmd_timeout = 300      # second without output before a command is given up, 0 waits forever
+        self.batch_mode = False     # send a host's whole task list as one shell script
+        self.engine = 'thread'      # 'thread' or 'asyncio'
+        self.metrics_port = 0       # local Prometheus endpoint, 0 disables
+        self.deadline = 0           # second for a whole run, asyncio engine only, 0 means no deadline
+        self.ssh_keepalive_interval = 15   # second
+        self.ssh_idle_timeout = 300        # second
+        self.ssh_health_check_idle = 60    # second
+        self.ssh_max_conns = 64
+        self.results_dir = ''              # '' keeps results in memory only
+        self.results_run_id = ''           # '' starts a new run per start()
+        self.results_resume = True         # skip hosts already recorded as successful for the same run_id
+        self.results_max_output_bytes = 65536
+        self.results_flush_every = 64      # records
+        self.fetch_dir = './fetched'       # fetch tasks write <fetch_dir>/<host>/<file>
+        self.fetch_host_concurrency = 1    # files of one host in flight
+        self.fetch_bandwidth = 0           # KB/s over every transfer of all shards, 0 unlimited
+        self.fetch_chunk_size = 32768      # bytes per SFTP read request
+        self.fetch_pipeline = 64           # read requests in flight per file
+        self.fetch_compress = False        # gzip on the fly to <file>.gz
+        self.fetch_compress_level = 6
+        self.fetch_checkpoint_bytes = 8388608    # source bytes between two resume points
+        self.fetch_verify = True           # md5sum on the host, unchanged files are skipped and retrieved ones checked
         self.username = ''
         self.password = ''
-        self.tasks = {}
+        self.tasks = []             # ProcTask compiled from the selected task groups, shared by every host
         self.ips_of_proc = []
 
         self._load_cfg()
 
+    def _stamp(self):
+        try:
+            stat = os.stat(self.cfg_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
     def _load_cfg(self):
         try:
             if not os.path.exists(self.cfg_file):
                 raise FileNotFoundError(f"The file [{self.cfg_file}] does not exist!")
 
+            self.cfg_stamp = self._stamp()
             with open(self.cfg_file, 'r') as cfg:
                 config = yaml.safe_load(cfg)
 
             self.max_concurrency = config['proc_task_executor']['general']['max_concurrency']
             self.max_retries = config['proc_task_executor']['general']['max_retries']
             self.retry_interval = config['proc_task_executor']['general']['retry_interval']
+            self.retry_interval_max = config['proc_task_executor']['general'].get('retry_interval_max', self.retry_interval_max)
+            self.breaker_threshold = config['proc_task_executor']['general'].get('breaker_threshold', self.breaker_threshold)
+
+            concurrency = config['proc_task_executor'].get('concurrency', {})
+            self.adaptive_concurrency = concurrency.get('adaptive', self.adaptive_concurrency)
+            self.min_concurrency = concurrency.get('min', self.min_concurrency)
+            self.initial_concurrency = concurrency.get('initial', self.initial_concurrency)
+            self.concurrency_window = concurrency.get('window', self.concurrency_window)
+            self.concurrency_latency_target = concurrency.get('latency_target', self.concurrency_latency_target)
+            self.concurrency_error_rate_max = concurrency.get('error_rate_max', self.concurrency_error_rate_max)
+            self.group_limits = {cur_group: max(int(cur_limit), 1) for cur_group, cur_limit in (concurrency.get('group_limits') or {}).items()}
+            self.connect_timeout = config['proc_task_executor']['general'].get('connect_timeout', self.connect_timeout)
+            self.cmd_timeout = config['proc_task_executor']['general'].get('cmd_timeout', self.cmd_timeout)
+            self.batch_mode = config['proc_task_executor']['general'].get('batch_mode', self.batch_mode)
+            self.engine = config['proc_task_executor']['general'].get('engine', self.engine)
+            self.metrics_port = config['proc_task_executor']['general'].get('metrics_port', self.metrics_port)
+            self.deadline = config['proc_task_executor']['general'].get('deadline', self.deadline)
+
+            ssh_pool = config['proc_task_executor'].get('ssh_pool', {})
+            self.ssh_keepalive_interval = ssh_pool.get('keepalive_interval', self.ssh_keepalive_interval)
+            self.ssh_idle_timeout = ssh_pool.get('idle_timeout', self.ssh_idle_timeout)
+            self.ssh_health_check_idle = ssh_pool.get('health_check_idle', self.ssh_health_check_idle)
+            self.ssh_max_conns = ssh_pool.get('max_conns', self.ssh_max_conns)
+
+            results = config['proc_task_executor'].get('results', {})
+            self.results_dir = results.get('dir', self.results_dir)
+            self.results_run_id = results.get('run_id', self.results_run_id)
+            self.results_resume = results.get('resume', self.results_resume)
+            self.results_max_output_bytes = results.get('max_output_bytes', self.results_max_output_bytes)
+            self.results_flush_every = results.get('flush_every', self.results_flush_every)
+
+            fetch = config['proc_task_executor'].get('fetch', {})
+            self.fetch_dir = fetch.get('dir', self.fetch_dir)
+            self.fetch_host_concurrency = fetch.get('host_concurrency', self.fetch_host_concurrency)
+            self.fetch_bandwidth = fetch.get('bandwidth', self.fetch_bandwidth)
+            self.fetch_chunk_size = fetch.get('chunk_size', self.fetch_chunk_size)
+            self.fetch_pipeline = fetch.get('pipeline', self.fetch_pipeline)
+            self.fetch_compress = fetch.get('compress', self.fetch_compress)
+            self.fetch_compress_level = fetch.get('compress_level', self.fetch_compress_level)
+            self.fetch_checkpoint_bytes = fetch.get('checkpoint_bytes', self.fetch_checkpoint_bytes)
+            self.fetch_verify = fetch.get('verify', self.fetch_verify)
 
             self.username = config['proc_task_executor']['credentials_of_ssh']['username']
             self.password = config['proc_task_executor']['credentials_of_ssh']['password']
 
             task_selected = config['proc_task_executor']['tasks']['task_selected']
             task_all = config['proc_task_executor']['tasks']['task_all']
+            task_templates = config['proc_task_executor']['tasks'].get('task_templates', {})
             for cur_group in task_selected:
                 if cur_group in task_all:
-                    self.tasks.update({cur_group: task_all[cur_group]})
+                    try:
+                        task = self._compile_task_group(cur_group, task_all[cur_group], task_templates)
+                    except (KeyError, IndexError, ValueError) as e:
+                        cur_logger.warning(f'[task_groups: {cur_group}] cannot be rendered, skipped: {e}')
+                        continue
+                    # The same command selected twice is only run once per host
+                    if all(cur_task.command != task.command for cur_task in self.tasks):
+                        self.tasks.append(task)
                 else:
                     cur_logger.warning(f'[task_groups: {cur_group}] not found in configuration!')
 
@@ -55,12 +182,29 @@ class ProcTaskExecutorCfgMgr:
             for cur_group in ip_groups_selected:
                 if cur_group in ip_groups_all:
                     self.ips_of_proc.extend(ip_groups_all[cur_group])
+                    for cur_ip in ip_groups_all[cur_group]:
+                        self.ip_groups.setdefault(cur_ip, cur_group)
                 else:
                     cur_logger.warning(f'[ip_groups: {cur_group}] not found in configuration!')
-
-            cur_logger.info(f'CfgMgrForProcMetricsCollector [max_concurrency: {self.max_concurrency}], [max_retries: {self.max_retries}], [retry_interval: {self.retry_interval}]')
-            cur_logger.info(f'CfgMgrForProcMetricsCollector [tasks: {self.tasks}]')
-            cur_logger.info(f'CfgMgrForProcMetricsCollector [len_of_ips_of_proc: {len(self.ips_of_proc)}], [ips_of_proc: {self.ips_of_proc}]')
+            # A host listed in several selected groups is only visited once
+            self.ips_of_proc = list(dict.fromkeys(self.ips_of_proc))
+            if self.shard_count > 1:
+                self.ips_of_proc = utils_shard_ips(self.ips_of_proc, self.shard_index, self.shard_count)
+                if self.metrics_port:
+                    self.metrics_port += self.shard_index * UTILS_SHARD_PORT_STRIDE
+                # Every shard takes an even part of the cap, the uplink of the fleet is shared
+                if self.fetch_bandwidth > 0:
+                    self.fetch_bandwidth = max(self.fetch_bandwidth // self.shard_count, 1)
+
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [max_concurrency: {self.max_concurrency}], [max_retries: {self.max_retries}], [retry_interval: {self.retry_interval}], [batch_mode: {self.batch_mode}], [engine: {self.engine}], [deadline: {self.deadline}], [metrics_port: {self.metrics_port}], [shard: {self.shard_index}/{self.shard_count}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [retry_interval_max: {self.retry_interval_max}], [breaker_threshold: {self.breaker_threshold}], [adaptive_concurrency: {self.adaptive_concurrency}], [min_concurrency: {self.min_concurrency}], [initial_concurrency: {self.initial_concurrency}], [concurrency_window: {self.concurrency_window}], [concurrency_latency_target: {self.concurrency_latency_target}], [concurrency_error_rate_max: {self.concurrency_error_rate_max}], [group_limits: {self.group_limits}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [connect_timeout: {self.connect_timeout}], [cmd_timeout: {self.cmd_timeout}], [ssh_keepalive_interval: {self.ssh_keepalive_interval}], [ssh_idle_timeout: {self.ssh_idle_timeout}], [ssh_health_check_idle: {self.ssh_health_check_idle}], [ssh_max_conns: {self.ssh_max_conns}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [results_dir: {self.results_dir}], [results_run_id: {self.results_run_id}], [results_resume: {self.results_resume}], [results_max_output_bytes: {self.results_max_output_bytes}], [results_flush_every: {self.results_flush_every}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [fetch_dir: {self.fetch_dir}], [fetch_host_concurrency: {self.fetch_host_concurrency}], [fetch_bandwidth: {self.fetch_bandwidth}], [fetch_chunk_size: {self.fetch_chunk_size}], [fetch_pipeline: {self.fetch_pipeline}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [fetch_compress: {self.fetch_compress}], [fetch_compress_level: {self.fetch_compress_level}], [fetch_checkpoint_bytes: {self.fetch_checkpoint_bytes}], [fetch_verify: {self.fetch_verify}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [tasks: {[(cur_task.group, cur_task.command, cur_task.cache_ttl) for cur_task in self.tasks]}]')
+            cur_logger.info(f'CfgMgrForProcTaskExecutor [len_of_ips_of_proc: {len(self.ips_of_proc)}], [ips_of_proc: {self.ips_of_proc}]')
+            self.loaded = True
         except FileNotFoundError as e:
             cur_logger.error(f"File Not Found: {e}")
         except yaml.YAMLError as e:
@@ -68,154 +212,770 @@ class ProcTaskExecutorCfgMgr:
         except Exception as e:
             cur_logger.error(f"An unexpected error occurred: {e}")
 
+    def reload(self):
+        # -> (added ips, removed ips) once a changed file was read completely, None otherwise, a broken file keeps the running settings
+        stamp = self._stamp()
+        if (stamp is None) or (stamp == self.cfg_stamp):
+            return None
+        fresh = ProcTaskExecutorCfgMgr(self.cfg_file, self.shard_index, self.shard_count)
+        self.cfg_stamp = stamp    # a broken file is reported once, not on every check
+        if not fresh.loaded:
+            cur_logger.error(f'CfgMgrForProcTaskExecutor [{self.cfg_file}] changed but cannot be loaded, keep the running settings')
+            return None
+        for cur_name in self.RESTART_ONLY:
+            if getattr(fresh, cur_name) != getattr(self, cur_name):
+                cur_logger.warning(f'CfgMgrForProcTaskExecutor [{cur_name}: {getattr(self, cur_name)} -> {getattr(fresh, cur_name)}] takes effect after a restart')
+                setattr(fresh, cur_name, getattr(self, cur_name))
+
+        old_ips, new_ips = set(self.ips_of_proc), set(fresh.ips_of_proc)
+        ret_added = [cur_ip for cur_ip in fresh.ips_of_proc if cur_ip not in old_ips]
+        ret_removed = [cur_ip for cur_ip in self.ips_of_proc if cur_ip not in new_ips]
+        vars(self).update(vars(fresh))
+        return ret_added, ret_removed
+
+    @staticmethod
+    def _compile_task_group(p_group, p_params, p_templates):
+        # task_all holds parameters, the template named by 'template' (default: the group name) turns them into a command once
+        params = dict(p_params or {})
+        template = p_templates[params.pop('template', p_group)]
+        if 'fetch' in template:
+            fetch = template['fetch'].format(**params)
+            return ProcTask(p_group, f'fetch {fetch}', f'fetch {fetch}', 0, fetch)
+        cache_ttl = params.pop('cache_ttl', template.get('cache_ttl', 0))
+        command = template['cmd'].format(**params)
+        fact = template.get('fact', '')
+        return ProcTask(p_group, command, fact.format(**params) if fact else command, cache_ttl)
+
 
 class ProcTaskDesc:
-    def __init__(self, p_host_ip, p_username, p_password, p_tasks, p_max_retries=3, p_retry_interval=1):
+    def __init__(self, p_host_ip, p_username, p_password, p_tasks, p_max_retries=3, p_retry_interval=1, p_batch_mode=False, p_ip_group='', p_fetcher=None, p_cmd_timeout=None):
         self.host_ip = p_host_ip
         self.username = p_username
         self.password = p_password
-        self.tasks = p_tasks
+        self.tasks = [cur_task if isinstance(cur_task, ProcTask) else ProcTask('', cur_task, cur_task, 0) for cur_task in p_tasks]
 
         self.max_retries = p_max_retries
         self.retry_interval = p_retry_interval
+        self.batch_mode = p_batch_mode
+        self.ip_group = p_ip_group
+        self.fetcher = p_fetcher    # ProcTaskFetcher shared by the hosts of a run, needed by fetch tasks
+        self.cmd_timeout = p_cmd_timeout    # second without output before a command is given up, None waits forever
+
+
+class ProcTaskBatchSplitter:
+    # One stream of a batch script cut at its markers while it is read, the output between two markers goes to the
+    # capture of the next command, only a possible marker is held back at the end of a chunk
+    def __init__(self, p_pattern, p_capture_of, p_marker_len):
+        self.pattern = p_pattern            # bytes regex of a marker, group 1 the index of the command, group 2 its exit status if any
+        self.capture_of = p_capture_of      # index -> ProcTaskOutputCapture
+        self.hold = p_marker_len + 32       # newlines, index and exit status around the marker
+        self.exit_statuses = {}             # index -> exit status, in the order the markers arrived
+        self.index = 0                      # command whose output is being read
+        self._buffer = bytearray()
+
+    def write(self, p_data):
+        self._buffer += p_data
+        begin = 0
+        for cur_match in self.pattern.finditer(self._buffer):
+            self.capture_of(self.index).write(bytes(self._buffer[begin:cur_match.start()]))
+            self.index = int(cur_match.group(1))
+            if self.pattern.groups >= 2:
+                self.exit_statuses[self.index] = int(cur_match.group(2))
+            self.index += 1
+            begin = cur_match.end()
+        end = max(begin, len(self._buffer) - self.hold)
+        if end > begin:
+            self.capture_of(self.index).write(bytes(self._buffer[begin:end]))
+        del self._buffer[:end]
+
+    def close(self):
+        # The trailing part belongs to the command that never got its marker
+        if self._buffer:
+            self.capture_of(self.index).write(bytes(self._buffer))
+        self._buffer.clear()
 
 
 class ProcTaskWorker:
-    def __init__(self, p_task_desc):
-        self.task_desc = p_task_desc
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    def __init__(self, task_desc, p_ssh_pool, p_cache=None, p_sink=None):
+        self.task_desc = task_desc
+        self.ssh_pool = p_ssh_pool
+        self.cache = p_cache
+        self.sink = p_sink              # ProcTaskResultsSink, outputs over its max_output_bytes are streamed to its spill files
         self.retries = 0
+        self.cached_results = None      # answers served from the cache, looked up once before the first attempt
+        self.connect_latency = None     # second to get a connection in the last attempt, None when it failed before
+        # Set from any thread, checked between commands and retries, a command already running on the host is not interrupted
+        self.cancel_event = threading.Event()
+        self.client = None              # pooled connection of the running attempt, closed by abort()
 
     def is_retryable(self):
-        return self.retries < self.task_desc.max_retries
+        return (self.retries < self.task_desc.max_retries) and not self.cancel_event.is_set()
 
-    def execute_commands(self, tasks):
-        results = []
-        for command in tasks:
-            self.client.connect(self.task_desc.host_ip, self.task_desc.username, self.task_desc.password)
-            stdin, stdout, stderr = self.client.exec_command(command)
-            stdout.channel.recv_exit_status()  # 等待命令执行完成
-            results.append({
-                'command': command,
-                'stdout': stdout.read().decode('utf-8'),
-                'stderr': stderr.read().decode('utf-8')
-            })
-        return results
+    def cancel(self):
+        self.cancel_event.set()
 
-    def execute(self):
-        while not self.is_retryable():
-            try:
-                stdin, stdout, stderr = self.execute_commands(self.task_desc.tasks)
-                stdout.channel.recv_exit_status()
-                result = {
-                    'hostname': self.task_desc.host_ip,
-                    'success': True,
-                    'stdout': stdout.read().decode('utf-8'),
-                    'stderr': stderr.read().decode('utf-8')
-                }
-                break
-            except Exception as e:
-                self.retries += 1
-                print(f"Retry {self.retries}/{3} for {self.task_desc.host_ip} due to error: {e}")
-                self.close()
-            finally:
-                if not (self.is_retryable()):
-                    result = {
-                        'hostname': self.task_desc.host_ip,
-                        'success': False,
-                        'error': str(e)
-                    }
-                    break
-                self.client.close()
-        return result
+    def abort(self):
+        # cancel() that also interrupts the running command, closing the connection ends a blocked read at once
+        self.cancel()
+        client = self.client
+        if client is not None:
+            client.close()
 
+    @contextlib.contextmanager
+    def _hold(self, p_client):
+        self.client = p_client
+        try:
+            yield p_client
+        finally:
+            self.client = None
+
+    def _cached_results(self):
+        # Leading tasks with a fresh answer in the cache are served without a round trip, the first miss runs the rest
+        ret_results = []
+        if self.cache is None:
+            return ret_results
+        for cur_task in self.task_desc.tasks:
+            stdout = self.cache.get(self.task_desc.host_ip, cur_task.cache_key) if cur_task.cache_ttl > 0 else None
+            if stdout is None:
+                break
+            ret_results.append({'command': cur_task.command, 'exit_status': 0, 'stdout': stdout, 'stderr': '', 'cached': True})
+        return ret_results
+
+    def _cache_results(self, p_tasks, p_results):
+        if self.cache is None:
+            return
+        for cur_task, cur_result in zip(p_tasks, p_results):
+            # A spilled output only has its head in the result
+            if (cur_task.cache_ttl > 0) and (cur_result['exit_status'] == 0) and ('stdout_spill' not in cur_result):
+                self.cache.put(self.task_desc.host_ip, cur_task.cache_key, cur_result['stdout'], cur_task.cache_ttl)
+
+    @staticmethod
+    def _build_batch_script(p_commands, p_marker):
+        # Every command is eval'ed in its own subshell like a separate exec_command would, so a syntax error only fails
+        # that command, followed by a marker carrying its exit status on stdout and a bare marker on stderr,
+        # then stop on the first failure
+        lines = []
+        for index, command in enumerate(p_commands):
+            lines.append(f'( eval {shlex.quote(command)} )')
+            lines.append(f'__rc=$?; printf \'\\n{p_marker} {index} %d\\n\' $__rc; printf \'\\n{p_marker} {index}\\n\' >&2; [ $__rc -eq 0 ] || exit $__rc')
+        return '\n'.join(lines)
+
+    def _capture(self, p_index, p_stream):
+        # p_index is the position in the host's results, cached answers included, as the sink numbers them
+        if self.sink is None:
+            return ProcTaskOutputCapture()
+        return self.sink.capture(self.task_desc.host_ip, p_index, p_stream)
+
+    @staticmethod
+    def _read_outputs(p_channel, p_stdout, p_stderr, p_timeout):
+        # Both streams chunk by chunk as they arrive until EOF, neither of them can fill the channel window and stall the other,
+        # p_timeout second without any data raises socket.timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(p_channel, selectors.EVENT_READ)
+            while True:
+                if p_channel.recv_stderr_ready():
+                    p_stderr.write(p_channel.recv_stderr(PROC_TASK_READ_CHUNK))
+                elif p_channel.recv_ready():
+                    p_stdout.write(p_channel.recv(PROC_TASK_READ_CHUNK))
+                elif p_channel.eof_received or p_channel.closed:
+                    return
+                elif not selector.select(p_timeout):
+                    raise socket.timeout(f'no output for {p_timeout} seconds')
+
+    def execute_commands_batched(self, p_tasks=None, p_first=0):
+        commands = [cur_task.command for cur_task in (self.task_desc.tasks if p_tasks is None else p_tasks)]
+        marker = f'__PROC_OPS_{uuid.uuid4().hex}__'
+        captures = {}    # (stream, index in commands) -> ProcTaskOutputCapture
+
+        def closure_capture(p_stream, p_index):
+            if (p_stream, p_index) not in captures:
+                captures[(p_stream, p_index)] = self._capture(p_first + p_index, p_stream)
+            return captures[(p_stream, p_index)]
+
+        def closure_entries(p_index):
+            return dict(closure_capture('stdout', p_index).entry('stdout'), **closure_capture('stderr', p_index).entry('stderr'))
 
+        results = []
+        try:
+            stdout_splitter = ProcTaskBatchSplitter(re.compile(f'\n{marker} (\\d+) (-?\\d+)\n'.encode()), lambda p_index: closure_capture('stdout', p_index), len(marker))
+            stderr_splitter = ProcTaskBatchSplitter(re.compile(f'\n{marker} (\\d+)\n'.encode()), lambda p_index: closure_capture('stderr', p_index), len(marker))
+            begin = time.monotonic()
+            with self.ssh_pool.connection(self.task_desc.host_ip) as client, self._hold(client):
+                self.connect_latency = time.monotonic() - begin
+                with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='exec'):
+                    stdin, stdout, stderr = client.exec_command('sh -c ' + shlex.quote(self._build_batch_script(commands, marker)), timeout=self.task_desc.cmd_timeout)
+                # Read both streams before waiting for the exit status, a large output would otherwise block the remote side
+                with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='read'):
+                    self._read_outputs(stdout.channel, stdout_splitter, stderr_splitter, self.task_desc.cmd_timeout)
+                    stdout_splitter.close()
+                    stderr_splitter.close()
+                    script_exit_status = stdout.channel.recv_exit_status()
+
+            for cur_index, cur_exit_status in stdout_splitter.exit_statuses.items():
+                results.append(dict({'command': commands[cur_index], 'exit_status': cur_exit_status}, **closure_entries(cur_index)))
+
+            # The script stopped without a marker for the running command, e.g. the shell or the command was killed
+            if (len(results) < len(commands)) and ((not results) or (results[-1]['exit_status'] == 0)):
+                results.append(dict({'command': commands[len(results)], 'exit_status': script_exit_status if script_exit_status != 0 else -1}, **closure_entries(len(results))))
+        except Exception as e:
+            cur_logger.debug('Error executing commands on [{}]: {}', self.task_desc.host_ip, e, host=self.task_desc.host_ip)
+            results = {'error': str(e) or repr(e)}
+        finally:
+            for cur_capture in captures.values():
+                cur_capture.close()
+        return results
 
-class ProcTaskWorker:
-    def __init__(self, task_desc):
-        self.task_desc = task_desc
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.retries = 0
+    def execute_commands(self, p_tasks=None, p_first=0):
+        tasks = self.task_desc.tasks if p_tasks is None else p_tasks
+        if self.task_desc.batch_mode:
+            return self.execute_commands_batched(tasks, p_first)
 
-    def is_retryable(self):
-        return self.retries < self.task_desc.max_retries
-
-    def connect(self):
-        self.client.connect(self.task_desc.host_ip, username=self.task_desc.username, password=self.task_desc.password)
+        results = []
+        try:
+            # One pooled connection for the whole task list, a broken transport is replaced on the next acquire
+            begin = time.monotonic()
+            with self.ssh_pool.connection(self.task_desc.host_ip) as client, self._hold(client):
+                self.connect_latency = time.monotonic() - begin
+                for command in [cur_task.command for cur_task in tasks]:
+                    if self.cancel_event.is_set():
+                        # Commands after the cancel point are skipped, the finished ones are kept
+                        results = {'error': 'cancelled', 'results': results}
+                        break
+                    with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='exec'):
+                        stdin, stdout, stderr = client.exec_command(command, timeout=self.task_desc.cmd_timeout)
+                    stdout_capture, stderr_capture = self._capture(p_first + len(results), 'stdout'), self._capture(p_first + len(results), 'stderr')
+                    with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='read'):
+                        # Output first, the reads time out on a silent host while the exit status would be waited for forever
+                        try:
+                            self._read_outputs(stdout.channel, stdout_capture, stderr_capture, self.task_desc.cmd_timeout)
+                        finally:
+                            stdout_capture.close()
+                            stderr_capture.close()
+                        exit_status = stdout.channel.recv_exit_status()
+                        results.append(dict({'command': command, 'exit_status': exit_status}, **stdout_capture.entry('stdout'), **stderr_capture.entry('stderr')))
+                    if exit_status != 0:
+                        break  # 如果命令执行失败，则中断后续命令的执行
+        except Exception as e:
+            cur_logger.debug('Error executing commands on [{}]: {}', self.task_desc.host_ip, e, host=self.task_desc.host_ip)
+            results = {'error': str(e) or repr(e)}
+        return results
 
-    def execute_commands(self):
+    def execute_fetch(self, p_tasks):
+        # Same contract as execute_commands, transport errors fail the attempt so a retry resumes the partial files
         results = []
         try:
-            for command in self.task_desc.tasks:
-                self.connect()  # 重新连接，以处理可能的网络问题
-                stdin, stdout, stderr = self.client.exec_command(command)
-                exit_status = stdout.channel.recv_exit_status()
-                results.append({
-                    'command': command,
-                    'exit_status': exit_status,
-                    'stdout': stdout.read().decode('utf-8'),
-                    'stderr': stderr.read().decode('utf-8')
-                })
-                if exit_status != 0:
-                    break  # 如果命令执行失败，则中断后续命令的执行
+            if self.task_desc.fetcher is None:
+                raise ValueError('fetch tasks need a ProcTaskFetcher')
+            begin = time.monotonic()
+            with self.ssh_pool.connection(self.task_desc.host_ip) as client, self._hold(client):
+                self.connect_latency = time.monotonic() - begin
+                for cur_task in p_tasks:
+                    if self.cancel_event.is_set():
+                        results = {'error': 'cancelled', 'results': results}
+                        break
+                    with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='fetch'):
+                        exit_status, files = self.task_desc.fetcher.fetch(client, self.task_desc.host_ip, cur_task.fetch, self.cancel_event)
+                    results.append({
+                        'command': cur_task.command,
+                        'exit_status': exit_status,
+                        'stdout': '\n'.join(f"{cur_file['file']} {cur_file['status']} {cur_file.get('bytes', 0)}" for cur_file in files),
+                        'stderr': '\n'.join(f"{cur_file['file']} {cur_file['status']}" for cur_file in files if cur_file['status'] not in ('fetched', 'skipped')),
+                        'files': files
+                    })
+                    if exit_status != 0:
+                        break
         except Exception as e:
-            print(f"Error executing commands on {self.task_desc.host_ip}: {e}")
-            results = {'error': str(e)}
-        finally:
-            self.client.close()
+            cur_logger.debug('Error fetching files from [{}]: {}', self.task_desc.host_ip, e, host=self.task_desc.host_ip)
+            results = {'error': str(e) or repr(e)}
         return results
 
-    def execute(self):
-        while self.is_retryable():
-            results = self.execute_commands()
-            if isinstance(results, dict) and results.get('error'):
-                # 记录重试次数，然后等待一段时间后重试
-                self.retries += 1
-                print(f"Retry {self.retries}/{self.task_desc.max_retries} for {self.task_desc.host_ip} due to error: {results['error']}")
-                time.sleep(self.task_desc.retry_interval)
-            else:
-                # 命令执行成功或出现异常但不可重试
+    def execute_tasks(self, p_tasks, p_first=0):
+        # Runs of commands go to execute_commands as before, runs of fetch tasks to execute_fetch, the first failure stops the rest,
+        # p_first is the position of the first task in the host's results
+        if all(cur_task.fetch is None for cur_task in p_tasks):
+            return self.execute_commands(p_tasks, p_first)
+        ret_results = []
+        for cur_is_fetch, cur_tasks in itertools.groupby(p_tasks, key=lambda p_task: p_task.fetch is not None):
+            cur_tasks = list(cur_tasks)
+            if self.cancel_event.is_set():
+                return {'error': 'cancelled', 'results': ret_results}
+            results = self.execute_fetch(cur_tasks) if cur_is_fetch else self.execute_commands(cur_tasks, p_first + len(ret_results))
+            if isinstance(results, dict):
+                if 'results' in results:
+                    results = dict(results, results=ret_results + results['results'])
+                return results
+            ret_results.extend(results)
+            if (len(results) < len(cur_tasks)) or (results and results[-1]['exit_status'] != 0):
                 break
+        return ret_results
+
+    def execute_once(self):
+        # One attempt without any waiting, -> results of the tasks not served from the cache, a dict with 'error' when the host failed
+        if self.cached_results is None:
+            self.cached_results = self._cached_results()
+        tasks = self.task_desc.tasks[len(self.cached_results):]
+        if not tasks:
+            return []
+        if self.cancel_event.is_set():
+            return {'error': 'cancelled'}
+        self.connect_latency = None
+        with utils_metrics.timer('proc_ops_task_attempt_seconds'):
+            results = self.execute_tasks(tasks, len(self.cached_results))
+        if isinstance(results, list):
+            self._cache_results(tasks, results)
+        elif results.get('error') and not self.cancel_event.is_set():
+            self.retries += 1
+        return results
+
+    def finish(self, p_results):
+        results = self.cached_results + p_results if isinstance(p_results, list) else p_results
         return {
             'hostname': self.task_desc.host_ip,
             'success': not isinstance(results, dict) or not results.get('error'),
             'results': results
         }
 
+    def execute(self):
+        # Serial retries of a single host, ProcTaskMaster schedules retries itself so a waiting host holds no thread
+        results = self.execute_once()
+        while isinstance(results, dict) and results.get('error') and self.is_retryable():
+            # 记录重试次数，然后等待一段时间后重试
+            cur_logger.warning('Retry {}/{} for {} due to error: {}', self.retries, self.task_desc.max_retries, self.task_desc.host_ip, results['error'], host=self.task_desc.host_ip)
+            self.cancel_event.wait(self.task_desc.retry_interval)
+            results = self.execute_once()
+        return self.finish(results)
+
+
+class ProcTaskConcurrencyLimiter:
+    # AIMD on the hosts in flight: doubled from initial after every good window until the first bad one, then +1 per good window,
+    # halved per bad window down to min, a window is bad when its error rate or p90 connect latency is above target
+    def __init__(self, p_min, p_max, p_window=8, p_latency_target=2.0, p_error_rate_max=0.2, p_adaptive=True, p_initial=0):
+        self.min = max(p_min, 1)
+        self.max = max(p_max, self.min)
+        self.window = p_window
+        self.latency_target = p_latency_target
+        self.error_rate_max = p_error_rate_max
+        self.adaptive = p_adaptive
+
+        self.limit = min(max(p_initial, self.min), self.max) if self.adaptive else self.max
+        utils_metrics.set('proc_ops_task_concurrency_limit', self.limit)
+        self.slow_start = True
+        self._attempts = 0
+        self._errors = 0
+        self._latencies = []
+
+    def configure(self, p_min, p_max, p_window, p_latency_target, p_error_rate_max, p_adaptive):
+        # Live settings change, the learned limit is kept inside the new bounds
+        self.min = max(p_min, 1)
+        self.max = max(p_max, self.min)
+        self.window = p_window
+        self.latency_target = p_latency_target
+        self.error_rate_max = p_error_rate_max
+        self.adaptive = p_adaptive
+        self.limit = min(max(self.limit, self.min), self.max) if self.adaptive else self.max
+        utils_metrics.set('proc_ops_task_concurrency_limit', self.limit)
+
+    def record(self, p_connect_latency, p_ok):
+        if not self.adaptive:
+            return
+        self._attempts += 1
+        self._errors += 0 if p_ok else 1
+        if p_connect_latency is not None:
+            self._latencies.append(p_connect_latency)
+        if self._attempts < self.window:
+            return
+
+        error_rate = self._errors / self._attempts
+        latency_p90 = float(numpy.percentile(self._latencies, 90)) if self._latencies else 0.0
+        old_limit = self.limit
+        if (error_rate > self.error_rate_max) or (latency_p90 > self.latency_target):
+            self.slow_start = False
+            self.limit = max(self.min, self.limit // 2)
+        elif self.slow_start:
+            self.limit = min(self.max, self.limit * 2)
+        else:
+            self.limit = min(self.max, self.limit + 1)
+        self._attempts, self._errors, self._latencies = 0, 0, []
+        utils_metrics.set('proc_ops_task_concurrency_limit', self.limit)
+        if self.limit != old_limit:
+            cur_logger.info(f'ProcTaskConcurrencyLimiter [limit: {old_limit} -> {self.limit}], [error_rate: {error_rate:.2f}], [connect_latency_p90: {latency_p90:.2f} s]')
+
+
+class ProcTaskCircuitBreaker:
+    # Per host and kept across runs, every consecutive failure doubles the cool-down before the next retry, from threshold
+    # consecutive failures on the breaker is open and a first attempt during the cool-down fails fast
+    def __init__(self, p_backoff_base=1, p_backoff_max=300, p_threshold=3):
+        self.backoff_base = p_backoff_base
+        self.backoff_max = p_backoff_max
+        self.threshold = max(p_threshold, 1)
+        self.fail_cnts = {}
+        self._retry_at = {}     # ip -> monotonic time
+
+    def retry_at(self, p_host_ip):
+        return self._retry_at.get(p_host_ip, 0)
+
+    def open_until(self, p_host_ip):
+        return self.retry_at(p_host_ip) if self.fail_cnts.get(p_host_ip, 0) >= self.threshold else 0
+
+    def forget(self, p_host_ips):
+        for cur_host_ip in p_host_ips:
+            self.fail_cnts.pop(cur_host_ip, None)
+            self._retry_at.pop(cur_host_ip, None)
+
+    def record(self, p_host_ip, p_ok, p_now):
+        if p_ok:
+            self.fail_cnts.pop(p_host_ip, None)
+            self._retry_at.pop(p_host_ip, None)
+            return
+        self.fail_cnts[p_host_ip] = self.fail_cnts.get(p_host_ip, 0) + 1
+        self._retry_at[p_host_ip] = p_now + min(self.backoff_base * (2 ** (self.fail_cnts[p_host_ip] - 1)), self.backoff_max)
+
+
+class ProcTaskDispatcher:
+    # Decides which attempts may start under the overall limit, the ip group limits and the circuit breaker,
+    # a host waiting for its retry sits in a heap instead of on a thread
+    def __init__(self, p_workers, p_limiter, p_breaker, p_group_limits=None):
+        self.limiter = p_limiter
+        self.breaker = p_breaker
+        self.group_limits = p_group_limits or {}
+
+        self.queued = collections.OrderedDict()     # ip group -> deque of workers before their first attempt
+        for cur_worker in p_workers:
+            self.queued.setdefault(cur_worker.task_desc.ip_group, collections.deque()).append(cur_worker)
+        self.retries = []       # heap of (due, seq, worker)
+        self.inflight = 0
+        self.group_inflight = collections.Counter()
+        self._seq = 0
+
+    def _group_full(self, p_group):
+        limit = self.group_limits.get(p_group)
+        return (limit is not None) and (self.group_inflight[p_group] >= limit)
+
+    def _start(self, p_worker):
+        self.inflight += 1
+        self.group_inflight[p_worker.task_desc.ip_group] += 1
+        utils_metrics.set('proc_ops_task_inflight', self.inflight)
+
+    def take(self, p_now):
+        # -> (workers to start now, [(worker, result)] of hosts answered without an attempt)
+        ret_started, ret_finished = [], []
+
+        # Due retries first, they already waited
+        deferred = []
+        while self.retries and (self.retries[0][0] <= p_now) and (self.inflight < self.limiter.limit):
+            item = heapq.heappop(self.retries)
+            if self._group_full(item[2].task_desc.ip_group):
+                deferred.append(item)
+                continue
+            self._start(item[2])
+            ret_started.append(item[2])
+        for cur_item in deferred:
+            heapq.heappush(self.retries, cur_item)
+
+        # First attempts round robin over the ip groups, so one big group does not starve the others
+        progressed = True
+        while progressed and (self.inflight < self.limiter.limit):
+            progressed = False
+            for cur_group in list(self.queued):
+                if self.inflight >= self.limiter.limit:
+                    break
+                if self._group_full(cur_group):
+                    continue
+                worker = self.queued[cur_group].popleft()
+                if not self.queued[cur_group]:
+                    del self.queued[cur_group]
+                progressed = True
+
+                open_until = self.breaker.open_until(worker.task_desc.host_ip)
+                if open_until > p_now:
+                    utils_metrics.inc('proc_ops_task_circuit_open_total', host=worker.task_desc.host_ip)
+                    ret_finished.append((worker, worker.finish({'error': f'circuit open for another [{open_until - p_now:.1f}] seconds'})))
+                    continue
+                self._start(worker)
+                ret_started.append(worker)
+        return ret_started, ret_finished
+
+    def done(self, p_worker, p_results, p_now):
+        # -> the host's final result, None when a retry was scheduled
+        self.inflight -= 1
+        self.group_inflight[p_worker.task_desc.ip_group] -= 1
+        utils_metrics.set('proc_ops_task_inflight', self.inflight)
+        failed = isinstance(p_results, dict) and bool(p_results.get('error'))
+        if not p_worker.cancel_event.is_set():
+            self.limiter.record(p_worker.connect_latency, not failed)
+            self.breaker.record(p_worker.task_desc.host_ip, not failed, p_now)
+        if (not failed) or (not p_worker.is_retryable()):
+            return p_worker.finish(p_results)
+
+        due = self.breaker.retry_at(p_worker.task_desc.host_ip)
+        cur_logger.warning('Retry {}/{} for {} in [{:.1f}] seconds due to error: {}', p_worker.retries, p_worker.task_desc.max_retries, p_worker.task_desc.host_ip,
+                           max(due - p_now, 0), p_results['error'], host=p_worker.task_desc.host_ip)
+        utils_metrics.inc('proc_ops_task_retries_total', host=p_worker.task_desc.host_ip)
+        heapq.heappush(self.retries, (due, self._seq, p_worker))
+        self._seq += 1
+        return None
+
+    def next_wakeup(self, p_now):
+        # Monotonic time a retry can start, None when only a finishing attempt can unblock anything
+        if (not self.retries) or (self.inflight >= self.limiter.limit) or (self.retries[0][0] <= p_now):
+            return None
+        return self.retries[0][0]
+
+    def pending(self):
+        return bool(self.queued or self.retries or self.inflight)
+
+    def drain(self):
+        # -> workers that never got to finish, queued or waiting for a retry
+        ret_workers = [cur_worker for cur_queue in self.queued.values() for cur_worker in cur_queue] + [cur_item[2] for cur_item in self.retries]
+        self.queued.clear()
+        self.retries = []
+        return ret_workers
+
 
 class ProcTaskMaster:
-    def __init__(self, p_tasks_desc, p_max_concurrency):
+    def __init__(self, p_tasks_desc, p_max_concurrency, p_ssh_pool, p_on_result=None, p_cache=None, p_sink=None, p_limiter=None, p_breaker=None, p_group_limits=None):
         self.tasks_desc = p_tasks_desc
         self.max_concurrency = p_max_concurrency
+        self.ssh_pool = p_ssh_pool
+        self.cache = p_cache            # UtilsTTLCache shared across runs, None disables caching
+        self.sink = p_sink              # ProcTaskResultsSink, results then only keeps hostname and success per host
+        self.on_result = p_on_result    # called with each host's result as soon as that host is done
+        # Without a limiter the run keeps max_concurrency hosts in flight, without a breaker retries back off from retry_interval
+        self.limiter = p_limiter if p_limiter is not None else ProcTaskConcurrencyLimiter(p_max_concurrency, p_max_concurrency, p_adaptive=False)
+        self.breaker = p_breaker if p_breaker is not None else ProcTaskCircuitBreaker(p_tasks_desc[0].retry_interval if p_tasks_desc else 1)
+        self.group_limits = p_group_limits or {}
 
         self.results = {}
 
+    def _handle_result(self, p_worker, p_result):
+        utils_metrics.inc('proc_ops_task_results_total', outcome='success' if p_result['success'] else 'failure')
+        if self.sink is not None:
+            try:
+                p_result = self.sink.write(p_result)
+            except Exception as e:
+                cur_logger.error('ProcTaskMaster failed to record [{}]: {}', p_worker.task_desc.host_ip, e, host=p_worker.task_desc.host_ip)
+            self.results[p_worker.task_desc.host_ip] = {'hostname': p_result['hostname'], 'success': p_result['success']}
+        else:
+            self.results[p_worker.task_desc.host_ip] = p_result
+        if self.on_result is not None:
+            try:
+                self.on_result(p_result)
+            except Exception as e:
+                cur_logger.error('ProcTaskMaster on_result failed for [{}]: {}', p_worker.task_desc.host_ip, e, host=p_worker.task_desc.host_ip)
+        return p_result
+
+    @staticmethod
+    def _future_results(p_future):
+        try:
+            return p_future.result()
+        except Exception as e:
+            return {'error': str(e)}
+
     def run(self):
-        workers = [ProcTaskWorker(cur_task_desc) for cur_task_desc in self.tasks_desc]
+        workers = [ProcTaskWorker(cur_task_desc, self.ssh_pool, self.cache, self.sink) for cur_task_desc in self.tasks_desc]
+        dispatcher = ProcTaskDispatcher(workers, self.limiter, self.breaker, self.group_limits)
+
+        # Sized for the ceiling, the dispatcher keeps only limiter.limit attempts in flight
+        with ThreadPoolExecutor(max_workers=self.limiter.max) as executor:
+            inflight = {}
+            while dispatcher.pending():
+                now = time.monotonic()
+                started, finished = dispatcher.take(now)
+                for cur_worker, cur_result in finished:
+                    self._handle_result(cur_worker, cur_result)
+                for cur_worker in started:
+                    inflight[executor.submit(cur_worker.execute_once)] = cur_worker
+
+                wakeup = dispatcher.next_wakeup(now)
+                timeout = None if wakeup is None else max(wakeup - now, 0)
+                if not inflight:
+                    if timeout is None:
+                        break       # nothing running and nothing due, only possible when every host was answered
+                    time.sleep(timeout)
+                    continue
+
+                # A host's result is handled when it finishes instead of after the slowest host
+                done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for cur_future in done:
+                    worker = inflight.pop(cur_future)
+                    result = dispatcher.done(worker, self._future_results(cur_future), time.monotonic())
+                    if result is not None:
+                        self._handle_result(worker, result)
+
+
+class ProcTaskMasterAsync(ProcTaskMaster):
+    # One coroutine per host on a single event loop, only the blocking paramiko calls run on limiter.max threads,
+    # so thousands of hosts cost a future each instead of a thread each
+    def __init__(self, p_tasks_desc, p_max_concurrency, p_ssh_pool, p_on_result=None, p_cache=None, p_sink=None, p_deadline=0, p_limiter=None, p_breaker=None, p_group_limits=None):
+        super().__init__(p_tasks_desc, p_max_concurrency, p_ssh_pool, p_on_result, p_cache, p_sink, p_limiter, p_breaker, p_group_limits)
+        self.deadline = p_deadline      # second for the whole run, 0 means no deadline
+
+        self._loop = None
+        self._cancel_event = None
+        self._workers = []
+
+    def cancel(self):
+        # Thread safe, hosts not started yet are dropped and running ones stop at their next command
+        for cur_worker in self._workers:
+            cur_worker.cancel()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel_event.set)
+
+    async def iter_results(self):
+        # Async iterator yielding each host's result in finish order
+        self._loop = asyncio.get_running_loop()
+        self._cancel_event = asyncio.Event()
+        self._workers = [ProcTaskWorker(cur_task_desc, self.ssh_pool, self.cache, self.sink) for cur_task_desc in self.tasks_desc]
+        dispatcher = ProcTaskDispatcher(self._workers, self.limiter, self.breaker, self.group_limits)
+        deadline_at = time.monotonic() + self.deadline if self.deadline else None
+
+        executor = ThreadPoolExecutor(max_workers=self.limiter.max)
+        inflight = {}
+        cancel_waiter = asyncio.ensure_future(self._cancel_event.wait())
+        stop_reason = ''
+        try:
+            while dispatcher.pending():
+                now = time.monotonic()
+                started, finished = dispatcher.take(now)
+                for cur_worker, cur_result in finished:
+                    yield self._handle_result(cur_worker, cur_result)
+                for cur_worker in started:
+                    inflight[asyncio.ensure_future(self._loop.run_in_executor(executor, cur_worker.execute_once))] = cur_worker
+
+                wakeup = dispatcher.next_wakeup(now)
+                if (not inflight) and (wakeup is None):
+                    break       # nothing running and nothing due, only possible when every host was answered
+                wakeups = [cur_at for cur_at in (wakeup, deadline_at) if cur_at is not None]
+                timeout = max(min(wakeups) - now, 0) if wakeups else None
+                done, _ = await asyncio.wait(set(inflight) | {cancel_waiter}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if cancel_waiter in done:
+                    stop_reason = 'cancelled'
+                    break
+                for cur_future in done:
+                    worker = inflight.pop(cur_future)
+                    result = dispatcher.done(worker, self._future_results(cur_future), time.monotonic())
+                    if result is not None:
+                        yield self._handle_result(worker, result)
+                if (deadline_at is not None) and (time.monotonic() >= deadline_at):
+                    stop_reason = 'deadline exceeded'
+                    break
 
-        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
-            futures_workers = {executor.submit(cur_worker.execute): cur_worker for cur_worker in workers}
+            # The running attempts would otherwise go on until cmd_timeout, holding their connections and writing spill files
+            # after the sink is closed
+            for cur_worker in inflight.values():
+                cur_worker.abort()
+            for cur_worker in list(inflight.values()) + dispatcher.drain():
+                cur_worker.cancel()
+                yield self._handle_result(cur_worker, cur_worker.finish({'error': stop_reason}))
+            if inflight:
+                await asyncio.wait(set(inflight), timeout=PROC_TASK_ABORT_WAIT)
+            inflight = {}
+        finally:
+            # Also reached when the consumer stops iterating or the surrounding task is cancelled
+            for cur_future, cur_worker in inflight.items():
+                cur_worker.abort()
+                cur_future.cancel()
+            cancel_waiter.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._loop = None
+
+    async def run_async(self):
+        async for _ in self.iter_results():
+            pass
+        return self.results
 
-        for cur_future_worker in as_completed(futures_workers):
-            worker = futures_workers[cur_future_worker]
-            result = cur_future_worker.result()
-            self.results[worker.task_desc.host_ip] = result
+    def run(self):
+        return asyncio.run(self.run_async())
 
 
 class ProcTaskExecutor:
-    def __init__(self):
-        self.cfg_mgr = ProcTaskExecutorCfgMgr()
-
-    def start(self):
+    def __init__(self, p_shard_index=0, p_shard_count=1):
+        self.cfg_mgr = ProcTaskExecutorCfgMgr(p_shard_index=p_shard_index, p_shard_count=p_shard_count)
+        # Kept across start() calls, repeated tasks against the same host reuse the transport
+        self.ssh_pool = UtilsSSHConnPool(self.cfg_mgr.username, self.cfg_mgr.password, cur_logger,
+                                         p_connect_timeout=self.cfg_mgr.connect_timeout, p_keepalive_interval=self.cfg_mgr.ssh_keepalive_interval,
+                                         p_idle_timeout=self.cfg_mgr.ssh_idle_timeout, p_health_check_idle=self.cfg_mgr.ssh_health_check_idle,
+                                         p_max_conns=self.cfg_mgr.ssh_max_conns, p_name='proc_task_executor')
+        utils_metrics_serve(self.cfg_mgr.metrics_port)
+        # Also kept across start() calls, a run starts from the concurrency the last one learned and skips hosts still cooling down
+        self.limiter = ProcTaskConcurrencyLimiter(self.cfg_mgr.min_concurrency, self.cfg_mgr.max_concurrency, self.cfg_mgr.concurrency_window,
+                                                  self.cfg_mgr.concurrency_latency_target, self.cfg_mgr.concurrency_error_rate_max, self.cfg_mgr.adaptive_concurrency,
+                                                  self.cfg_mgr.initial_concurrency)
+        self.breaker = ProcTaskCircuitBreaker(self.cfg_mgr.retry_interval, self.cfg_mgr.retry_interval_max, self.cfg_mgr.breaker_threshold)
+        self.fetcher = self._build_fetcher()
+
+    def _build_fetcher(self):
+        # One per process, its bandwidth budget is shared by every host and file of a run
+        return ProcTaskFetcher(self.cfg_mgr.fetch_dir, self.cfg_mgr.fetch_host_concurrency, self.cfg_mgr.fetch_bandwidth * 1024, self.cfg_mgr.fetch_chunk_size,
+                               self.cfg_mgr.fetch_pipeline, self.cfg_mgr.fetch_compress, self.cfg_mgr.fetch_compress_level, self.cfg_mgr.fetch_checkpoint_bytes,
+                               self.cfg_mgr.fetch_verify, self.cfg_mgr.cmd_timeout or None, cur_logger)
+
+    def _reload_cfg(self):
+        # Checked before every run, hosts still listed keep their pooled connections, breaker state and cached answers
+        diff = self.cfg_mgr.reload()
+        if diff is None:
+            return
+        added, removed = diff
+        self.ssh_pool.configure(self.cfg_mgr.username, self.cfg_mgr.password, self.cfg_mgr.connect_timeout, self.cfg_mgr.ssh_keepalive_interval,
+                                self.cfg_mgr.ssh_idle_timeout, self.cfg_mgr.ssh_health_check_idle, self.cfg_mgr.ssh_max_conns)
+        self.limiter.configure(self.cfg_mgr.min_concurrency, self.cfg_mgr.max_concurrency, self.cfg_mgr.concurrency_window,
+                               self.cfg_mgr.concurrency_latency_target, self.cfg_mgr.concurrency_error_rate_max, self.cfg_mgr.adaptive_concurrency)
+        self.breaker.backoff_base, self.breaker.backoff_max, self.breaker.threshold = self.cfg_mgr.retry_interval, self.cfg_mgr.retry_interval_max, max(self.cfg_mgr.breaker_threshold, 1)
+        self.breaker.forget(removed)
+        self.fetcher = self._build_fetcher()
+        for cur_ip in removed:
+            self.ssh_pool.discard(cur_ip)
+            utils_result_cache.invalidate(cur_ip)
+        cur_logger.info('ProcTaskExecutor reloaded [{}]: [added: {}], [removed: {}], [hosts: {}]', self.cfg_mgr.cfg_file, added, removed, len(self.cfg_mgr.ips_of_proc),
+                        added=added, removed=removed)
+
+    def start(self, p_run_id=''):
+        self._reload_cfg()
+        run_id = p_run_id or self.cfg_mgr.results_run_id or f"{time.strftime('%Y_%m_%d_%H_%M_%S')}_{uuid.uuid4().hex[:8]}"
+        if self.cfg_mgr.shard_count > 1:
+            # One results file per shard, a restarted shard resumes from its own
+            run_id = f'{run_id}_shard{self.cfg_mgr.shard_index}'
+        sink = None
+        if self.cfg_mgr.results_dir:
+            sink = ProcTaskResultsSink(self.cfg_mgr.results_dir, run_id, self.cfg_mgr.results_max_output_bytes, self.cfg_mgr.results_flush_every, cur_logger)
+
+        ips_of_proc = self.cfg_mgr.ips_of_proc
+        if (sink is not None) and self.cfg_mgr.results_resume and sink.done_hosts:
+            ips_of_proc = [cur_ip for cur_ip in ips_of_proc if cur_ip not in sink.done_hosts]
+            cur_logger.info(f'ProcTaskExecutor resume [run_id: {run_id}]: [skipped: {len(self.cfg_mgr.ips_of_proc) - len(ips_of_proc)}], [remaining: {len(ips_of_proc)}]')
 
         tasks_desc = []
-        for cur_ip in self.cfg_mgr.ips_of_proc:
-            task_desc = ProcTaskDesc(cur_ip, self.cfg_mgr.username, self.cfg_mgr.password, self.cfg_mgr.tasks, self.cfg_mgr.max_retries, self.cfg_mgr.retry_interval)
+        for cur_ip in ips_of_proc:
+            task_desc = ProcTaskDesc(cur_ip, self.cfg_mgr.username, self.cfg_mgr.password, self.cfg_mgr.tasks, self.cfg_mgr.max_retries, self.cfg_mgr.retry_interval, self.cfg_mgr.batch_mode, self.cfg_mgr.ip_groups.get(cur_ip, ''),
+                                     self.fetcher, self.cfg_mgr.cmd_timeout or None)
             tasks_desc.append(task_desc)
 
-        proc_task_master = ProcTaskMaster(tasks_desc, self.cfg_mgr.max_concurrency)
-        proc_task_master.run()
+        if self.cfg_mgr.engine == 'asyncio':
+            proc_task_master = ProcTaskMasterAsync(tasks_desc, self.cfg_mgr.max_concurrency, self.ssh_pool, self._log_result, utils_result_cache, sink, self.cfg_mgr.deadline,
+                                                   self.limiter, self.breaker, self.cfg_mgr.group_limits)
+        else:
+            proc_task_master = ProcTaskMaster(tasks_desc, self.cfg_mgr.max_concurrency, self.ssh_pool, self._log_result, utils_result_cache, sink,
+                                              self.limiter, self.breaker, self.cfg_mgr.group_limits)
+        try:
+            with utils_metrics.timer('proc_ops_task_run_seconds'):
+                proc_task_master.run()
+        finally:
+            if sink is not None:
+                sink.close()
+                cur_logger.info(f'ProcTaskExecutor [run_id: {run_id}] recorded in [{sink.file_name}]')
+        return proc_task_master.results
+
+    @staticmethod
+    def _log_result(p_result):
+        results = p_result['results']
+        if p_result['success']:
+            failed = [cur_result['command'] for cur_result in results if cur_result['exit_status'] != 0]
+            cached = sum(1 for cur_result in results if cur_result.get('cached'))
+            cur_logger.info('ProcTaskExecutor [{}] done: [commands: {}], [cached: {}], [failed: {}]', p_result['hostname'], len(results), cached, failed, host=p_result['hostname'])
+        else:
+            cur_logger.warning('ProcTaskExecutor [{}] failed: {}', p_result['hostname'], results.get('error'), host=p_result['hostname'])
+
+    def stop(self):
+        self.ssh_pool.close_all()
 
 
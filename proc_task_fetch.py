@@ -0,0 +1,216 @@
+import os
+import json
+import gzip
+import stat
+import time
+import shlex
+import fnmatch
+import hashlib
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import utils_metrics
+
+
+PROC_TASK_FETCH_CMD_MD5 = 'md5sum {}'    # run on the host, its first word is compared with the md5 of the retrieved bytes
+
+utils_metrics.describe('proc_ops_task_fetch_bytes_total', 'counter', 'Bytes read over SFTP per host')
+utils_metrics.describe('proc_ops_task_fetch_files_total', 'counter', 'Files handled by fetch tasks per status')
+
+
+class ProcTaskTokenBucket:
+    # rate bytes/s over every transfer of the process, a caller takes its bytes up front and sleeps off the debt,
+    # so concurrent transfers share the rate in the order they asked
+    def __init__(self, p_rate, p_burst=0):
+        self.rate = p_rate              # 0 unlimited
+        self.burst = p_burst or p_rate
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+
+    def consume(self, p_amount, p_cancel_event=None):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= p_amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            if p_cancel_event is not None:
+                p_cancel_event.wait(wait)
+            else:
+                time.sleep(wait)
+
+
+class ProcTaskFetcher:
+    # Retrieves the files matching a remote pattern to <fetch_dir>/<host>/<name>[.gz], streamed window by window to a
+    # .part file whose progress is checkpointed in <part>.json, a later attempt resumes from the last checkpoint. A
+    # finished file gets <file>.json with its remote size, mtime and md5, it is skipped while its size and mtime still match,
+    # md5sum only runs on the host for a new or changed file
+    def __init__(self, p_fetch_dir, p_host_concurrency=1, p_bandwidth=0, p_chunk_size=32768, p_pipeline=64, p_compress=False,
+                 p_compress_level=6, p_checkpoint_bytes=8388608, p_verify=True, p_cmd_timeout=None, p_logger=None):
+        self.fetch_dir = p_fetch_dir
+        self.host_concurrency = max(p_host_concurrency, 1)    # files of one host in flight, each over its own SFTP channel
+        self.bucket = ProcTaskTokenBucket(p_bandwidth, p_chunk_size * p_pipeline)
+        self.chunk_size = p_chunk_size          # bytes per SFTP read request
+        self.pipeline = p_pipeline              # read requests in flight per file, chunk_size * pipeline bytes buffered at most
+        self.compress = p_compress
+        self.compress_level = p_compress_level
+        self.checkpoint_bytes = p_checkpoint_bytes
+        self.verify = p_verify                  # md5 on the host, to check retrieved files and to skip touched but unchanged ones
+        self.cmd_timeout = p_cmd_timeout        # second without output before md5sum is given up, None waits forever
+        self.logger = p_logger
+
+    @staticmethod
+    def _write_json(p_file_name, p_data):
+        tmp_file = p_file_name + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(p_data, f)
+        os.replace(tmp_file, p_file_name)
+
+    @staticmethod
+    def _read_json(p_file_name):
+        try:
+            with open(p_file_name, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remote_md5(self, p_ssh_client, p_remote_file):
+        # -> hex digest, None when the host cannot tell, a timeout is raised like any transport error
+        stdin, stdout, stderr = p_ssh_client.exec_command(PROC_TASK_FETCH_CMD_MD5.format(shlex.quote(p_remote_file)), timeout=self.cmd_timeout)
+        output = stdout.read().decode('utf-8', errors='ignore')
+        if stdout.channel.recv_exit_status() != 0 or not output.split():
+            return None
+        return output.split()[0].lower()
+
+    def _is_retrieved(self, p_manifest, p_local_file, p_attr, p_remote_md5):
+        if (p_manifest is None) or (not os.path.exists(p_local_file)) or (p_manifest['size'] != p_attr.st_size):
+            return False
+        if (not p_manifest['compressed']) and (os.path.getsize(p_local_file) != p_attr.st_size):
+            return False
+        if p_remote_md5 is not None:
+            return p_manifest['md5'] == p_remote_md5
+        return p_manifest['mtime'] == p_attr.st_mtime
+
+    def _resume_point(self, p_part_file, p_meta_file, p_attr):
+        # -> (offset, part_size, md5 of the first offset bytes, gzip members), a changed remote file starts over
+        meta = self._read_json(p_meta_file)
+        if (meta is None) or (not os.path.exists(p_part_file)) or (meta['size'], meta['mtime'], meta['compressed']) != (p_attr.st_size, p_attr.st_mtime, self.compress):
+            return 0, 0, hashlib.md5(), []
+        # Only what the last checkpoint synced counts, bytes written after it or a gzip member cut by a crash are dropped
+        offset, part_size, members = meta['offset'], meta['part_size'], meta['members']
+        if os.path.getsize(p_part_file) < part_size:
+            return 0, 0, hashlib.md5(), []
+        md5 = hashlib.md5()
+        with open(p_part_file, 'rb+') as f:
+            f.truncate(part_size)
+        with (gzip.open(p_part_file, 'rb') if self.compress else open(p_part_file, 'rb')) as f:
+            for cur_block in iter(lambda: f.read(1048576), b''):
+                md5.update(cur_block)
+        return offset, part_size, md5, members
+
+    def _fetch_file(self, p_ssh_client, p_host_ip, p_remote_file, p_attr, p_cancel_event):
+        local_file = os.path.join(self.fetch_dir, p_host_ip, p_attr.filename + ('.gz' if self.compress else ''))
+        manifest_file, part_file = local_file + '.json', local_file + '.part'
+        meta_file = part_file + '.json'
+        ret_file = {'file': p_remote_file, 'local': local_file, 'size': p_attr.st_size, 'bytes': 0}
+
+        manifest = self._read_json(manifest_file)
+        if self._is_retrieved(manifest, local_file, p_attr, None):
+            ret_file['status'] = 'skipped'
+            return ret_file
+        remote_md5 = self._remote_md5(p_ssh_client, p_remote_file) if self.verify else None
+        if (remote_md5 is not None) and self._is_retrieved(manifest, local_file, p_attr, remote_md5):
+            # Touched but the same bytes, the new mtime spares the next md5sum
+            self._write_json(manifest_file, dict(manifest, mtime=p_attr.st_mtime))
+            ret_file['status'] = 'skipped'
+            return ret_file
+
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        offset, part_size, md5, members = self._resume_point(part_file, meta_file, p_attr)
+        ret_file['resumed_at'] = offset
+        begin = time.monotonic()
+        with p_ssh_client.open_sftp() as sftp, sftp.open(p_remote_file, 'rb') as remote, open(part_file, 'ab') as raw:
+            out = None
+            try:
+                while (offset < p_attr.st_size) and not p_cancel_event.is_set():
+                    if not self.compress:
+                        out = raw
+                    elif out is None:
+                        # A new gzip member per checkpoint, its (source offset, file offset) is what a resume goes back to
+                        members.append((offset, raw.tell()))
+                        out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.compress_level)
+                    checkpoint_at = offset + self.checkpoint_bytes
+                    while (offset < min(checkpoint_at, p_attr.st_size)) and not p_cancel_event.is_set():
+                        # One window of pipelined reads, the next is only asked for once this one is on disk
+                        window = min(self.chunk_size * self.pipeline, p_attr.st_size - offset)
+                        self.bucket.consume(window, p_cancel_event)
+                        chunks = [(cur_offset, min(self.chunk_size, offset + window - cur_offset)) for cur_offset in range(offset, offset + window, self.chunk_size)]
+                        for cur_data in remote.readv(chunks, self.pipeline):
+                            if not cur_data:
+                                raise EOFError(f'{p_remote_file} shrank below {p_attr.st_size} bytes')
+                            md5.update(cur_data)
+                            out.write(cur_data)
+                            offset += len(cur_data)
+                            ret_file['bytes'] += len(cur_data)
+                        utils_metrics.inc('proc_ops_task_fetch_bytes_total', window, host=p_host_ip)
+                    if self.compress:
+                        out.close()     # ends the member, raw stays open
+                        out = None
+                    self._checkpoint(raw, meta_file, p_attr, offset, members)
+            finally:
+                # Whatever reached the file is kept for the next attempt
+                if out is not None:
+                    if self.compress:
+                        out.close()
+                    self._checkpoint(raw, meta_file, p_attr, offset, members)
+
+        ret_file['seconds'] = round(time.monotonic() - begin, 3)
+        if p_cancel_event.is_set():
+            ret_file['status'] = 'cancelled'
+            return ret_file
+        ret_file['md5'] = md5.hexdigest()
+        if (remote_md5 is not None) and (remote_md5 != ret_file['md5']):
+            # Changed while it was read or corrupted on the way, the next attempt starts over
+            os.remove(part_file)
+            os.remove(meta_file)
+            ret_file['status'] = 'md5 mismatch'
+            return ret_file
+        os.replace(part_file, local_file)
+        self._write_json(manifest_file, {'file': p_remote_file, 'size': p_attr.st_size, 'mtime': p_attr.st_mtime, 'md5': ret_file['md5'],
+                                         'compressed': self.compress, 'members': members})
+        os.remove(meta_file)
+        ret_file['status'] = 'fetched'
+        return ret_file
+
+    def _checkpoint(self, p_raw, p_meta_file, p_attr, p_offset, p_members):
+        p_raw.flush()
+        os.fsync(p_raw.fileno())
+        self._write_json(p_meta_file, {'size': p_attr.st_size, 'mtime': p_attr.st_mtime, 'compressed': self.compress,
+                                       'offset': p_offset, 'part_size': p_raw.tell(), 'members': p_members})
+
+    def fetch(self, p_ssh_client, p_host_ip, p_remote_path, p_cancel_event):
+        # -> (exit_status, files), 1 when nothing matches or a file failed its check, transport errors are raised for a retry
+        remote_dir, pattern = posixpath.split(p_remote_path)
+        with p_ssh_client.open_sftp() as sftp:
+            try:
+                attrs = [cur_attr for cur_attr in sftp.listdir_attr(remote_dir or '.') if fnmatch.fnmatch(cur_attr.filename, pattern or '*') and stat.S_ISREG(cur_attr.st_mode)]
+            except IOError as e:
+                return 1, [{'file': p_remote_path, 'status': f'cannot list: {e}'}]
+        if not attrs:
+            return 1, [{'file': p_remote_path, 'status': 'no match'}]
+
+        with ThreadPoolExecutor(max_workers=self.host_concurrency) as executor:
+            futures = [executor.submit(self._fetch_file, p_ssh_client, p_host_ip, posixpath.join(remote_dir, cur_attr.filename), cur_attr, p_cancel_event)
+                       for cur_attr in sorted(attrs, key=lambda p_attr: p_attr.filename)]
+            files = [cur_future.result() for cur_future in futures]
+        for cur_file in files:
+            utils_metrics.inc('proc_ops_task_fetch_files_total', status=cur_file['status'])
+            if self.logger is not None:
+                self.logger.debug('ProcTaskFetcher [{}] {} [{}]: [bytes: {}], [resumed_at: {}]', p_host_ip, cur_file['file'], cur_file['status'],
+                                  cur_file['bytes'], cur_file.get('resumed_at'), host=p_host_ip, **cur_file)
+        return (0 if all(cur_file['status'] in ('fetched', 'skipped') for cur_file in files) else 1), files
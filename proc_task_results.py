@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import threading
+
+
+class ProcTaskOutputCapture:
+    # One output stream of one command written chunk by chunk as it is read, only the first max_bytes stay in memory,
+    # past them the whole stream goes to spill_file, None keeps everything in memory
+    def __init__(self, p_spill_file=None, p_max_bytes=0):
+        self.spill_file = p_spill_file
+        self.max_bytes = p_max_bytes
+        self.head = bytearray()
+        self.size = 0
+        self._file = None
+
+    def write(self, p_data):
+        self.size += len(p_data)
+        if self._file is not None:
+            self._file.write(p_data)
+            return
+        self.head += p_data
+        if (self.spill_file is not None) and (len(self.head) > self.max_bytes):
+            os.makedirs(os.path.dirname(self.spill_file), exist_ok=True)
+            self._file = open(self.spill_file, 'wb')
+            self._file.write(self.head)
+            del self.head[self.max_bytes:]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def entry(self, p_stream):
+        # -> fields of a result entry, the same ProcTaskResultsSink writes for an output it caps itself
+        self.close()
+        if self._file is None:
+            return {p_stream: self.head.decode('utf-8', errors='replace')}
+        return {p_stream: self.head.decode('utf-8', errors='ignore'), f'{p_stream}_bytes': self.size, f'{p_stream}_spill': self.spill_file}
+
+
+class ProcTaskResultsSink:
+    # Append-only <results_dir>/<run_id>.jsonl, one line per host as soon as it is done, outputs over max_output_bytes
+    # spill to <results_dir>/<run_id>/ and only their head stays inline
+    def __init__(self, p_results_dir, p_run_id, p_max_output_bytes=65536, p_flush_every=64, p_logger=None):
+        self.results_dir = p_results_dir
+        self.run_id = p_run_id
+        self.max_output_bytes = p_max_output_bytes
+        self.flush_every = p_flush_every
+        self.logger = p_logger
+
+        self.file_name = os.path.join(self.results_dir, f'{self.run_id}.jsonl')
+        self.spill_dir = os.path.join(self.results_dir, self.run_id)
+        self.done_hosts = set()     # hosts recorded as successful for this run_id, by an earlier start or this one
+
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        os.makedirs(self.results_dir, exist_ok=True)
+        self._load()
+        self._file = open(self.file_name, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.file_name):
+            return
+        with open(self.file_name, 'rb+') as f:
+            for cur_line in f:
+                try:
+                    record = json.loads(cur_line)
+                except ValueError:
+                    continue    # the line cut by a crash
+                if record.get('success'):
+                    self.done_hosts.add(record['hostname'])
+                else:
+                    self.done_hosts.discard(record['hostname'])
+            # Keep the next record off a half written last line
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        if self.logger is not None:
+            self.logger.info(f'ProcTaskResultsSink resume [run_id: {self.run_id}], [done_hosts: {len(self.done_hosts)}]')
+
+    def capture(self, p_host_ip, p_index, p_stream):
+        # Read side of the cap, a worker streams a long output into the spill file instead of holding it
+        return ProcTaskOutputCapture(os.path.join(self.spill_dir, f'{p_host_ip}_{p_index}.{p_stream}'), self.max_output_bytes)
+
+    def _cap_output(self, p_host_ip, p_index, p_stream, p_entry):
+        if f'{p_stream}_spill' in p_entry:
+            return    # capped while it was read
+        output = p_entry.get(p_stream, '')
+        encoded = output.encode('utf-8')
+        if len(encoded) <= self.max_output_bytes:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        spill_file = os.path.join(self.spill_dir, f'{p_host_ip}_{p_index}.{p_stream}')
+        with open(spill_file, 'wb') as f:
+            f.write(encoded)
+        p_entry[p_stream] = encoded[:self.max_output_bytes].decode('utf-8', errors='ignore')
+        p_entry[f'{p_stream}_bytes'] = len(encoded)
+        p_entry[f'{p_stream}_spill'] = spill_file
+
+    def _cap_entries(self, p_host_ip, p_entries):
+        ret_entries = [dict(cur_entry) for cur_entry in p_entries]
+        for cur_index, cur_entry in enumerate(ret_entries):
+            self._cap_output(p_host_ip, cur_index, 'stdout', cur_entry)
+            self._cap_output(p_host_ip, cur_index, 'stderr', cur_entry)
+        return ret_entries
+
+    def write(self, p_result):
+        # -> the record as written, the caller may keep it instead of the full result
+        host_ip = p_result['hostname']
+        results = p_result['results']
+        record = {'run_id': self.run_id, 'ts': time.time(), 'hostname': host_ip, 'success': p_result['success']}
+        if isinstance(results, list):
+            record['results'] = self._cap_entries(host_ip, results)
+        elif isinstance(results.get('results'), list):
+            # Cancelled half way, the commands finished before are kept
+            record['results'] = dict(results, results=self._cap_entries(host_ip, results['results']))
+        else:
+            record['results'] = results
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+
+        with self._lock:
+            self._file.write(line)
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._flush_locked()
+            if record['success']:
+                self.done_hosts.add(host_ip)
+        return record
+
+    def _flush_locked(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._flush_locked()
+                self._file.close()
@@ -0,0 +1,174 @@
+import os
+import re
+import sys
+import json
+import time
+import yaml
+import argparse
+import datetime
+import threading
+import collections
+
+
+# launch_type holds the value of ProcLaunchType, mem_ram_free in KB (int), mem_vsz in MB (float), cpu_pct (float)
+ProcTopRecord = collections.namedtuple('ProcTopRecord', ['launch_type', 'pid', 'mem_ram_free', 'mem_vsz', 'cpu_pct'])
+
+PROC_TOP_VSZ_PATTERN = re.compile(r'(\d+(?:\.\d+)?)([mg]?)')
+
+
+def proc_top_vsz_to_mb(p_vsz):
+    # top prints VSZ in KB without suffix, "998m" in MB or "2g" in GB, a merged "1222m149.9" is read up to the suffix
+    match = PROC_TOP_VSZ_PATTERN.match(p_vsz)
+    if match is None:
+        return 0.0
+    value, unit = float(match.group(1)), match.group(2)
+    return value if unit == 'm' else value * 1024 if unit == 'g' else value / 1024
+
+
+class ProcTopMatcher:
+    def __init__(self, p_mem_keyword, p_normal_includes, p_normal_excludes, p_valgrind_includes, p_valgrind_excludes):
+        self.mem_keyword = p_mem_keyword
+        self.normal_includes = list(p_normal_includes)
+        self.normal_excludes = list(p_normal_excludes)
+        self.valgrind_includes = list(p_valgrind_includes)
+        self.valgrind_excludes = list(p_valgrind_excludes)
+
+        self.pattern = self._compile()
+
+    @staticmethod
+    def _any_of(p_keywords):
+        return '|'.join(re.escape(cur_keyword) for cur_keyword in p_keywords) if p_keywords else '(?!)'
+
+    def _compile(self):
+        # One multiline pattern matching the lines the rules pick, same precedence as the rules it replaces:
+        #   mem line: contains mem_keyword
+        #   valgrind: contains any valgrind include and none of the valgrind excludes    !!! valgrind must before normal !!!
+        #   normal:   ends with any normal include and contains none of the normal excludes
+        def excludes(p_keywords):
+            return f'(?![^\n]*(?:{self._any_of(p_keywords)}))' if p_keywords else ''
+
+        mem = f'(?P<mem>(?=[^\n]*{re.escape(self.mem_keyword)}))' if self.mem_keyword else '(?P<mem>(?!))'
+        valgrind = f'(?P<valgrind>{excludes(self.valgrind_excludes)}(?=[^\n]*(?:{self._any_of(self.valgrind_includes)})))'
+        normal = f'(?P<normal>{excludes(self.normal_excludes)}(?=[^\n]*(?:{self._any_of(self.normal_includes)})$))'
+        return re.compile(f'^(?:{mem}|{valgrind}|{normal})[^\n]*', re.MULTILINE)
+
+    def parse(self, p_stdout):
+        ret_launch_type, ret_pid, ret_mem_ram_free, ret_mem_vsz, ret_cpu_pct = 'Unknown', '', 0, 0, 0
+        for cur_match in self.pattern.finditer(p_stdout):
+            parts = cur_match.group().split()
+            if cur_match.lastgroup == 'mem':
+                ret_mem_ram_free = int(parts[3].rstrip('K'))    # remove last 'K'
+                continue
+
+            # parts[4] maybe "998m" followed by "54.6" or "1222m149.9" when %VSZ reaches 100, then everything after it shifts left
+            _, _, vsz_pct = parts[4].partition('m')
+            ret_launch_type = 'Valgrind' if cur_match.lastgroup == 'valgrind' else 'Normal'
+            ret_pid, ret_mem_vsz, ret_cpu_pct = parts[0], proc_top_vsz_to_mb(parts[4]), float(parts[6] if vsz_pct else parts[7])
+        return ProcTopRecord(ret_launch_type, ret_pid, ret_mem_ram_free, ret_mem_vsz, ret_cpu_pct)
+
+
+def proc_top_parse_reference(p_stdout, p_matcher):
+    # The original line by line rules, kept verbatim to verify the compiled matcher against recorded snapshots,
+    # the fields are the strings they returned, see proc_top_reference_record
+    def closure_extract_metric():
+        parts = [cur_part.strip() for cur_part in cur_line.split()]
+        part_mem_split = [cur_part.strip() for cur_part in parts[4].split('m') if cur_part]    # parts[4] maybe "998m 54.6" or "1222m149.9", should be split
+        parts = parts[:4] + part_mem_split + parts[5:]
+        return parts[0], parts[4], parts[7]
+
+    ret_launch_type, ret_pid, ret_mem_ram_free, ret_mem_vsz, ret_cpu_pct = 'Unknown', '', 0, 0, 0
+    for cur_line in p_stdout.split('\n'):
+        if p_matcher.mem_keyword in cur_line:
+            ret_mem_ram_free = [cur_part.strip() for cur_part in cur_line.split()][3].rstrip('K')    # remove last 'K'
+        elif any(include in cur_line for include in p_matcher.valgrind_includes) and all(exclude not in cur_line for exclude in p_matcher.valgrind_excludes):
+            ret_launch_type = 'Valgrind'
+            ret_pid, ret_mem_vsz, ret_cpu_pct = closure_extract_metric()
+        elif any(cur_line.endswith(include) for include in p_matcher.normal_includes) and all(exclude not in cur_line for exclude in p_matcher.normal_excludes):
+            ret_launch_type = 'Normal'
+            ret_pid, ret_mem_vsz, ret_cpu_pct = closure_extract_metric()
+    return ProcTopRecord(ret_launch_type, ret_pid, ret_mem_ram_free, ret_mem_vsz, ret_cpu_pct)
+
+
+def proc_top_reference_record(p_record):
+    # A reference record in the units of ProcTopMatcher.parse, only done for the comparison: the original VSZ is the number before
+    # its 'm', a 'g' one is left whole, one without suffix (KB) was taken as MB and differs on purpose
+    try:
+        mem_vsz = float(p_record.mem_vsz)
+    except ValueError:
+        mem_vsz = proc_top_vsz_to_mb(p_record.mem_vsz)
+    return p_record._replace(mem_ram_free=int(p_record.mem_ram_free), mem_vsz=mem_vsz, cpu_pct=float(p_record.cpu_pct))
+
+
+class ProcTopRecorder:
+    def __init__(self, p_record_dir):
+        self.record_dir = p_record_dir
+        self._lock = threading.Lock()
+        os.makedirs(self.record_dir, exist_ok=True)
+
+    def record(self, p_host_ip, p_stdout):
+        # One JSON line per snapshot, one file per day
+        line = json.dumps({'ts': time.time(), 'host': p_host_ip, 'stdout': p_stdout}) + '\n'
+        file_name = os.path.join(self.record_dir, f"top_{datetime.date.today().strftime('%Y_%m_%d')}.jsonl")
+        with self._lock:
+            with open(file_name, 'a') as f:
+                f.write(line)
+
+
+def proc_top_load_snapshots(p_paths):
+    snapshots = []
+    for cur_path in p_paths:
+        file_names = sorted(os.path.join(cur_path, cur_name) for cur_name in os.listdir(cur_path) if cur_name.endswith('.jsonl')) if os.path.isdir(cur_path) else [cur_path]
+        for cur_file_name in file_names:
+            with open(cur_file_name, 'r') as f:
+                snapshots.extend(json.loads(cur_line) for cur_line in f if cur_line.strip())
+    return snapshots
+
+
+def proc_top_matcher_from_cfg(p_cfg_file):
+    with open(p_cfg_file, 'r') as cfg:
+        config = yaml.safe_load(cfg)
+    prompt_of_proc = config['proc_metrics_collector']['prompt_of_proc']
+    return ProcTopMatcher(prompt_of_proc['mem_keyword'],
+                          prompt_of_proc['launch_by_normal']['includes'], prompt_of_proc['launch_by_normal']['excludes'],
+                          prompt_of_proc['launch_by_valgrind']['includes'], prompt_of_proc['launch_by_valgrind']['excludes'])
+
+
+def main():
+    # Replay recorded top snapshots offline: parse throughput and, with --verify, differences against the original rules
+    parser = argparse.ArgumentParser(description='Replay recorded top snapshots through the top parser')
+    parser.add_argument('paths', nargs='+', help='.jsonl files written by ProcTopRecorder, or directories of them')
+    parser.add_argument('--cfg', default='proc_metrics_collector_cfg.yaml', help='collector config holding prompt_of_proc')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the corpus this many times')
+    parser.add_argument('--verify', action='store_true', help='compare every snapshot with the reference parser')
+    args = parser.parse_args()
+
+    matcher = proc_top_matcher_from_cfg(args.cfg)
+    snapshots = proc_top_load_snapshots(args.paths)
+    stdouts = [cur_snapshot['stdout'] for cur_snapshot in snapshots]
+    total_bytes = sum(len(cur_stdout) for cur_stdout in stdouts) * args.repeat
+
+    report = {'snapshots': len(stdouts) * args.repeat, 'bytes': total_bytes}
+    for cur_name, cur_parse in (('compiled', matcher.parse), ('reference', lambda p_stdout: proc_top_parse_reference(p_stdout, matcher))):
+        begin = time.perf_counter()
+        for _ in range(args.repeat):
+            for cur_stdout in stdouts:
+                cur_parse(cur_stdout)
+        elapsed = time.perf_counter() - begin
+        report[cur_name] = {'seconds': round(elapsed, 6),
+                            'snapshots_per_second': round(report['snapshots'] / elapsed, 1) if elapsed else None,
+                            'mb_per_second': round(total_bytes / elapsed / 1e6, 3) if elapsed else None}
+
+    if args.verify:
+        mismatches = []
+        for cur_snapshot in snapshots:
+            compiled, reference = matcher.parse(cur_snapshot['stdout']), proc_top_reference_record(proc_top_parse_reference(cur_snapshot['stdout'], matcher))
+            if compiled != reference:
+                mismatches.append({'host': cur_snapshot.get('host'), 'ts': cur_snapshot.get('ts'), 'compiled': compiled._asdict(), 'reference': reference._asdict()})
+        report['mismatches'] = mismatches
+
+    print(json.dumps(report, indent=4))
+    return 1 if report.get('mismatches') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
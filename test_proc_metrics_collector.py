@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from proc_metrics_collector import ProcMetricsCollector, ProcMetricsScheduler, ProcMetric, ProcStatusType, ProcLaunchType
+from proc_metrics_history import ProcMetricsHistory
+from utils import utils_result_cache
+
+
+HOST_IP = '127.0.0.2'
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    # The config manager reads its yaml from the working directory
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    ret_collector = ProcMetricsCollector()
+    ret_collector.cfg_mgr.proc_name = 'kvm4'
+    ret_collector.history = ProcMetricsHistory([HOST_IP], 16)
+    yield ret_collector
+    utils_result_cache.invalidate(HOST_IP)
+
+
+def normal_sample(p_collector, p_pid):
+    ret_proc_metric = ProcMetric(HOST_IP, p_collector.cfg_mgr.prompt_misc)
+    ret_proc_metric.proc_status, ret_proc_metric.launch_type, ret_proc_metric.pid = ProcStatusType.NORMAL, ProcLaunchType.NORMAL, p_pid
+    p_collector._record_sample(ret_proc_metric)
+    return ret_proc_metric
+
+
+def test_pid_fact_ttl_capped(collector, monkeypatch):
+    puts = []
+    monkeypatch.setattr(utils_result_cache, 'put', lambda *p_args: puts.append(p_args))
+    collector.cfg_mgr.collect_interval, collector.cfg_mgr.proc_fact_ttl = 120, 10
+    normal_sample(collector, '4242')
+    assert puts == [(HOST_IP, 'pid:kvm4', '4242\n', 10)]
+
+
+@pytest.mark.parametrize('p_status', [ProcStatusType.CRASH, ProcStatusType.UNKNOWN])
+def test_pid_fact_withdrawn_on_bad_sample(collector, p_status):
+    proc_metric = normal_sample(collector, '4242')
+    assert utils_result_cache.get(HOST_IP, 'pid:kvm4') == '4242\n'
+    proc_metric._reset_meter(p_status)
+    collector._record_sample(proc_metric)
+    assert utils_result_cache.get(HOST_IP, 'pid:kvm4') is None
+
+
+def test_pid_fact_withdrawn_on_disconn(collector):
+    proc_metric = normal_sample(collector, '4242')
+    collector._record_disconn(proc_metric)
+    assert utils_result_cache.get(HOST_IP, 'pid:kvm4') is None
+
+
+def test_pid_fact_follows_new_pid(collector):
+    normal_sample(collector, '4242')
+    normal_sample(collector, '4343')
+    assert utils_result_cache.get(HOST_IP, 'pid:kvm4') == '4343\n'
+
+
+def test_host_readded_while_sampled_keeps_one_entry(collector):
+    scheduler = ProcMetricsScheduler(collector.cfg_mgr)
+    scheduler.add_hosts([HOST_IP], 0, p_spread=False)
+    assert scheduler.pop_due(0) == [(HOST_IP, 0)]
+    # Removed and added back by reloads while its sample runs, then the sample finishes
+    scheduler.remove_hosts([HOST_IP])
+    scheduler.add_hosts([HOST_IP], 1, p_spread=False)
+    proc_metric = normal_sample(collector, '4242')
+    scheduler.reschedule(proc_metric, 2)
+    assert len(scheduler.pop_due(10 ** 6)) == 1
+    assert scheduler.next_due() is None
+
+
+def proc_probe_stdout(p_proc_ticks, p_total_ticks):
+    return (f'4242 (kvm4) S 1 1 1 0 -1 0 0 0 0 0 {p_proc_ticks} 0 0 0 20 0 1 0 100 1000 10\n'
+            'Name:\tkvm4\nVmSize:\t  1048576 kB\n'
+            f'cpu  {p_total_ticks} 0 0 0 0 0 0 0 0 0\nMemFree:  60000 kB\n')
+
+
+def test_proc_probe_keeps_cpu_until_two_readings(collector, monkeypatch):
+    outputs = [proc_probe_stdout(100, 1000), proc_probe_stdout(150, 1100)]
+    monkeypatch.setattr('proc_metrics_collector.utils_execute_cmd_by_ssh', lambda *p_args: outputs.pop(0))
+    proc_metric = normal_sample(collector, '4242')
+    proc_metric.cpu_pct = 12.5      # from the top scan
+    proc_metric.probe_adopt('4242', ProcLaunchType.NORMAL, 'kvm4')
+    assert proc_metric._metric_collect_by_proc(None)
+    assert proc_metric.cpu_pct == 12.5
+    assert proc_metric._metric_collect_by_proc(None)
+    assert proc_metric.cpu_pct == 50.0
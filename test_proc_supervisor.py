@@ -0,0 +1,96 @@
+import os
+import queue
+
+import pytest
+
+from proc_supervisor import ProcSupervisor, PROC_SUPERVISOR_CONTEXT, proc_supervisor_share_facts
+from proc_metrics_collector import ProcMetricsCollector, ProcMetric, ProcStatusType, ProcLaunchType
+from proc_task_executor import ProcTaskExecutorCfgMgr, ProcTaskDesc, ProcTaskWorker
+from utils import utils_result_cache
+
+
+HOST_IP = '127.0.0.2'
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    # The config managers read their yaml from the working directory
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_in_child(p_target, *p_args):
+    # -> what the forked child put on the queue, the child sees the facts only through the shared store
+    results = PROC_SUPERVISOR_CONTEXT.Queue()
+    process = PROC_SUPERVISOR_CONTEXT.Process(target=p_target, args=(results,) + p_args)
+    process.start()
+    process.join(30)
+    assert process.exitcode == 0
+    try:
+        return results.get(timeout=5)
+    except queue.Empty:
+        return None
+
+
+def collector_publish(p_results, p_facts):
+    proc_supervisor_share_facts(p_facts)
+    collector = ProcMetricsCollector()
+    proc_metric = ProcMetric(HOST_IP, collector.cfg_mgr.prompt_misc)
+    proc_metric.proc_status, proc_metric.launch_type, proc_metric.pid = ProcStatusType.NORMAL, ProcLaunchType.NORMAL, '4242'
+    collector._publish_pid_fact(proc_metric)
+    utils_result_cache.put(HOST_IP, 'uptime', 'not shared', 60)
+    p_results.put(collector.cfg_mgr.proc_name)
+
+
+def executor_lookup(p_results, p_facts):
+    proc_supervisor_share_facts(p_facts)
+    cfg_mgr = ProcTaskExecutorCfgMgr()
+    tasks = [cur_task for cur_task in cfg_mgr.tasks if cur_task.cache_key.startswith('pid:')][:1]
+    worker = ProcTaskWorker(ProcTaskDesc(HOST_IP, cfg_mgr.username, cfg_mgr.password, tasks), None, utils_result_cache)
+    p_results.put((worker._cached_results(), utils_result_cache.get(HOST_IP, 'uptime')))
+
+
+@pytest.fixture
+def supervisor():
+    ret_supervisor = ProcSupervisor()
+    yield ret_supervisor
+    if ret_supervisor.manager is not None:
+        ret_supervisor.manager.shutdown()
+
+
+def test_workers_get_one_fact_store(supervisor):
+    supervisor.cfg_mgr.collector_shards, supervisor.cfg_mgr.executor_shards = 2, 2
+    supervisor._build_workers()
+    assert supervisor.facts is not None
+    assert [cur_worker.args[-1] is supervisor.facts for cur_worker in supervisor.workers] == [True] * 4
+
+
+def test_no_fact_store_for_one_component(supervisor):
+    supervisor.cfg_mgr.collector_shards, supervisor.cfg_mgr.executor_shards = 2, 0
+    supervisor._build_workers()
+    assert (supervisor.manager, supervisor.facts) == (None, None)
+    assert all(cur_worker.args[-1] is None for cur_worker in supervisor.workers)
+
+
+def test_pid_fact_crosses_processes(supervisor):
+    supervisor.cfg_mgr.collector_shards, supervisor.cfg_mgr.executor_shards = 1, 1
+    supervisor._build_workers()
+    proc_name = run_in_child(collector_publish, supervisor.facts)
+    cached_results, uptime = run_in_child(executor_lookup, supervisor.facts)
+    assert proc_name
+    assert [(cur_result['stdout'], cur_result['cached']) for cur_result in cached_results] == [('4242\n', True)]
+    assert uptime is None
+    # The parent never had the fact in its own cache
+    assert utils_result_cache.get(HOST_IP, f'pid:{proc_name}') is None
+
+
+def test_fact_store_gone_is_a_miss(supervisor):
+    supervisor.cfg_mgr.collector_shards, supervisor.cfg_mgr.executor_shards = 1, 1
+    supervisor._build_workers()
+    supervisor.manager.shutdown()
+    supervisor.manager = None
+    proc_supervisor_share_facts(supervisor.facts)
+    try:
+        utils_result_cache.put(HOST_IP, 'pid:kvm4', '4242\n', 60)
+        assert utils_result_cache.get(HOST_IP, 'pid:kvm4') is None
+    finally:
+        utils_result_cache.share(None, ())
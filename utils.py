@@ -1,32 +1,508 @@
 
+import sys
+import zlib
+import socket
+import time
+import bisect
 import datetime
+import threading
+import contextlib
+import http.server
+import paramiko
 from loguru import logger
 
 
 '''
 Init logger
 '''
-time_start = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-logger_for_proc_metrics_collector = logger.bind(functional_area="proc_metrics_collector")
-logger_for_proc_metrics_collector.add(f"./logs/proc_metrics_collector_{time_start}.log", level="DEBUG", format="{time} - {level} - {message}", rotation="1 week")
+# Sinks write from loguru's background thread (enqueue=True) so a slow disk never stalls a round, each functional_area
+# gets its own JSONL file with the fields bound to a record under 'extra'. A record below the level of every sink is
+# dropped before its message is formatted, hot paths pass arguments instead of f-strings so that costs nothing
+UTILS_LOG_DIR = './logs'
+UTILS_LOG_LEVEL_FILE = 'DEBUG'
+UTILS_LOG_LEVEL_CONSOLE = 'INFO'
+UTILS_LOG_ROTATION = '100 MB'
+UTILS_LOG_RETENTION = 10      # rotated files kept per functional_area
+
+
+def utils_logger_add_sinks(p_functional_area, p_time_start):
+    logger.add(f"{UTILS_LOG_DIR}/{p_functional_area}_{p_time_start}.jsonl", level=UTILS_LOG_LEVEL_FILE, serialize=True, enqueue=True,
+               rotation=UTILS_LOG_ROTATION, retention=UTILS_LOG_RETENTION,
+               filter=lambda p_record: p_record['extra'].get('functional_area') == p_functional_area)
+    return logger.bind(functional_area=p_functional_area)
+
+
+logger.remove()
+logger.add(sys.stderr, level=UTILS_LOG_LEVEL_CONSOLE, enqueue=True)
 
 time_start = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
-logger_for_proc_task_executor = logger.bind(functional_area="proc_task_executor")
-logger_for_proc_task_executor.add(f"./logs/proc_task_executor_{time_start}.log", level="DEBUG", format="{time} - {level} - {message}", rotation="1 week")
+logger_for_proc_metrics_collector = utils_logger_add_sinks('proc_metrics_collector', time_start)
+logger_for_proc_task_executor = utils_logger_add_sinks('proc_task_executor', time_start)
+logger_for_proc_supervisor = utils_logger_add_sinks('proc_supervisor', time_start)
+
+
+class UtilsLogLimiter:
+    # The first warning of a host and kind goes out, repeats within interval are only counted until summary() reports
+    # them, reset() lets the next warning of a recovered host out at once
+    def __init__(self, p_interval=300):
+        self.interval = p_interval    # second
+        self._lock = threading.Lock()
+        self._last = {}               # (host_ip, kind) -> monotonic of the last warning let out
+        self._suppressed = {}         # kind -> [times, {host_ip}]
+
+    def allow(self, p_host_ip, p_kind):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get((p_host_ip, p_kind))
+            if (last is not None) and (now - last < self.interval):
+                suppressed = self._suppressed.setdefault(p_kind, [0, set()])
+                suppressed[0] += 1
+                suppressed[1].add(p_host_ip)
+                return False
+            self._last[(p_host_ip, p_kind)] = now
+            return True
+
+    def reset(self, p_host_ip, p_kind):
+        with self._lock:
+            self._last.pop((p_host_ip, p_kind), None)
+
+    def summary(self, p_logger):
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, {}
+        for cur_kind, (cur_times, cur_hosts) in sorted(suppressed.items()):
+            p_logger.warning('Suppressed repeated warnings [kind: {}]: [times: {}], [hosts: {}]', cur_kind, cur_times, len(cur_hosts),
+                             kind=cur_kind, times=cur_times, hosts=sorted(cur_hosts))
+
+
+utils_log_limiter = UtilsLogLimiter()
+
+
+class UtilsMetrics:
+    # In process counters, gauges and fixed bucket histograms rendered in the Prometheus text format,
+    # an update is a dict lookup and an add under one lock so it can stay on in production
+    # Histograms carry no host label, 16 series per host and label set would not scale with the fleet, per host counts go to counters
+    HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}        # name -> (type, help)
+        self._values = {}       # (name, labels) -> value of a counter or gauge, [bucket counts..., sum, count] of a histogram
+        self._collectors = []   # callables rendering state that is cheaper to read at scrape time, -> [(name, type, help, [(labels, value)])]
+
+    @staticmethod
+    def _labels(p_labels):
+        return tuple(sorted((cur_key, str(cur_value)) for cur_key, cur_value in p_labels.items()))
+
+    def describe(self, p_name, p_type, p_help):
+        self._types[p_name] = (p_type, p_help)
+
+    def inc(self, p_name, p_value=1, **p_labels):
+        key = (p_name, self._labels(p_labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + p_value
+
+    def set(self, p_name, p_value, **p_labels):
+        key = (p_name, self._labels(p_labels))
+        with self._lock:
+            self._values[key] = p_value
+
+    def observe(self, p_name, p_value, **p_labels):
+        key = (p_name, self._labels(p_labels))
+        index = bisect.bisect_left(self.HISTOGRAM_BUCKETS, p_value)
+        with self._lock:
+            buckets = self._values.get(key)
+            if buckets is None:
+                buckets = self._values[key] = [0] * (len(self.HISTOGRAM_BUCKETS) + 3)
+            buckets[index] += 1     # the last bucket slot is +Inf, cumulated when rendering
+            buckets[-2] += p_value
+            buckets[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, p_name, **p_labels):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(p_name, time.perf_counter() - begin, **p_labels)
+
+    def add_collector(self, p_collector):
+        self._collectors.append(p_collector)
+
+    def remove_collector(self, p_collector):
+        if p_collector in self._collectors:
+            self._collectors.remove(p_collector)
+
+    @staticmethod
+    def _format_labels(p_labels, p_extra=()):
+        labels = tuple(p_labels) + tuple(p_extra)
+        if not labels:
+            return ''
+        escaped = (str(cur_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, cur_value in labels)
+        return '{' + ','.join(f'{cur_key}="{cur_value}"' for (cur_key, _), cur_value in zip(labels, escaped)) + '}'
+
+    def render(self):
+        with self._lock:
+            values = [(cur_key, list(cur_value) if isinstance(cur_value, list) else cur_value) for cur_key, cur_value in self._values.items()]
+        families = {}
+        for (cur_name, cur_labels), cur_value in values:
+            families.setdefault(cur_name, []).append((cur_labels, cur_value))
+        for cur_collector in list(self._collectors):
+            try:
+                for cur_name, cur_type, cur_help, cur_samples in cur_collector():
+                    self._types.setdefault(cur_name, (cur_type, cur_help))
+                    families.setdefault(cur_name, []).extend((self._labels(cur_labels), cur_value) for cur_labels, cur_value in cur_samples)
+            except Exception:
+                continue    # a failing collector must not break the scrape
+
+        lines = []
+        for cur_name in sorted(families):
+            metric_type, metric_help = self._types.get(cur_name, ('untyped', ''))
+            lines.append(f'# HELP {cur_name} {metric_help}')
+            lines.append(f'# TYPE {cur_name} {metric_type}')
+            for cur_labels, cur_value in families[cur_name]:
+                if metric_type != 'histogram':
+                    lines.append(f'{cur_name}{self._format_labels(cur_labels)} {cur_value}')
+                    continue
+                cumulated = 0
+                for cur_bound, cur_count in zip(self.HISTOGRAM_BUCKETS + ('+Inf',), cur_value[:-2]):
+                    cumulated += cur_count
+                    lines.append(f'{cur_name}_bucket{self._format_labels(cur_labels, (("le", cur_bound),))} {cumulated}')
+                lines.append(f'{cur_name}_sum{self._format_labels(cur_labels)} {cur_value[-2]}')
+                lines.append(f'{cur_name}_count{self._format_labels(cur_labels)} {cur_value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+utils_metrics = UtilsMetrics()
+utils_metrics.describe('proc_ops_ssh_phase_seconds', 'histogram', 'SSH latency per phase: connect (tcp, handshake and auth), exec, read, fetch')
+utils_metrics.describe('proc_ops_ssh_connect_failures_total', 'counter', 'Failed SSH connects per host')
+utils_metrics.describe('proc_ops_ssh_pool_acquire_total', 'counter', 'Pool acquires per pool, reused or newly connected')
+
+
+class UtilsMetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = utils_metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, p_format, *p_args):
+        pass    # scrapes are not worth a log line
+
+
+utils_metrics_server = None
+
 
+def utils_metrics_serve(p_port, p_host='127.0.0.1'):
+    # Idempotent, the collector and the executor may both ask for it in one process
+    global utils_metrics_server
+    if (not p_port) or (utils_metrics_server is not None):
+        return utils_metrics_server
+    utils_metrics_server = http.server.ThreadingHTTPServer((p_host, p_port), UtilsMetricsHandler)
+    utils_metrics_server.daemon_threads = True
+    threading.Thread(target=utils_metrics_server.serve_forever, name='utils_metrics_server', daemon=True).start()
+    return utils_metrics_server
 
-def utils_execute_cmd_by_ssh(p_ssh_client, p_host_ip, p_cmd, p_logger):
+
+# A host that stops answering in the middle of a command, the caller drops its connections and reports it disconnected
+UTILS_SSH_CMD_ERRORS = (socket.timeout, paramiko.SSHException)
+
+
+def utils_execute_cmd_by_ssh(p_ssh_client, p_host_ip, p_cmd, p_logger, p_timeout=None):
+    # p_timeout second without any output gives up the command, UTILS_SSH_CMD_ERRORS are raised, other failures return ''
     try:
-        stdin, stdout, stderr = p_ssh_client.exec_command(p_cmd)
-        ret_stdout, ret_stderr = stdout.read().decode(), stderr.read().decode()
+        with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='exec'):
+            stdin, stdout, stderr = p_ssh_client.exec_command(p_cmd, timeout=p_timeout)
+        with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='read'):
+            ret_stdout, ret_stderr = stdout.read().decode(), stderr.read().decode()
         if ret_stderr:
             raise Exception(ret_stderr)
-        p_logger.debug(f'Execute successful: [[host: {p_host_ip}], cmd: {p_cmd}]')
+        p_logger.debug('Execute successful: [[host: {}], cmd: {}]', p_host_ip, p_cmd)
         return ret_stdout
+    except UTILS_SSH_CMD_ERRORS as e:
+        p_logger.error('Execute timed out: [[host: {}], cmd: {}]:\n    except: {!r}', p_host_ip, p_cmd, e, host=p_host_ip)
+        raise
     except Exception as e:
-        p_logger.error(f'Execute failed: [[host: {p_host_ip}], cmd: {p_cmd}]:\n    except: {e}')
+        p_logger.error('Execute failed: [[host: {}], cmd: {}]:\n    except: {}', p_host_ip, p_cmd, e, host=p_host_ip)
         return ''
 
 
+class UtilsSSHConnPool:
+    def __init__(self, p_username, p_password, p_logger, p_port=22, p_connect_timeout=8, p_keepalive_interval=15, p_idle_timeout=300, p_health_check_idle=60, p_max_conns=64, p_acquire_timeout=30, p_name='ssh'):
+        self.username = p_username
+        self.password = p_password
+        self.logger = p_logger
+        self.port = p_port
+        self.connect_timeout = p_connect_timeout          # second
+        self.keepalive_interval = p_keepalive_interval    # second, 0 means disabled
+        self.idle_timeout = p_idle_timeout                # second, idle connections older than this are closed
+        self.health_check_idle = p_health_check_idle      # second, idle connections older than this are probed before reuse
+        self.max_conns = p_max_conns                      # idle + in use
+        self.acquire_timeout = p_acquire_timeout          # second, wait for a free slot when max_conns is reached
+        self.name = p_name                                # pool label of the metrics
+
+        self._cond = threading.Condition()
+        self._idle = {}        # host_ip -> [(ssh_client, last_used), ...], most recently used at the end
+        self._conn_cnt = 0
+
+        utils_metrics.add_collector(self._metrics)
+
+    def configure(self, p_username, p_password, p_connect_timeout, p_keepalive_interval, p_idle_timeout, p_health_check_idle, p_max_conns):
+        # Live settings change, pooled connections stay, new credentials and timeouts apply to the next connect
+        with self._cond:
+            self.username = p_username
+            self.password = p_password
+            self.connect_timeout = p_connect_timeout
+            self.keepalive_interval = p_keepalive_interval
+            self.idle_timeout = p_idle_timeout
+            self.health_check_idle = p_health_check_idle
+            self.max_conns = p_max_conns
+            self._cond.notify_all()
+
+    def _metrics(self):
+        with self._cond:
+            idle_cnt = sum(len(cur_entries) for cur_entries in self._idle.values())
+            conn_cnt = self._conn_cnt
+        labels = {'pool': self.name}
+        return [('proc_ops_ssh_pool_conns', 'gauge', 'Connections of the pool, idle and in use', [(labels, conn_cnt)]),
+                ('proc_ops_ssh_pool_idle_conns', 'gauge', 'Idle connections of the pool', [(labels, idle_cnt)]),
+                ('proc_ops_ssh_pool_max_conns', 'gauge', 'Connection cap of the pool', [(labels, self.max_conns)])]
+
+    @staticmethod
+    def _is_active(p_ssh_client):
+        transport = p_ssh_client.get_transport()
+        return (transport is not None) and transport.is_active() and transport.is_authenticated()
+
+    def _is_healthy(self, p_ssh_client, p_idle_time):
+        if not self._is_active(p_ssh_client):
+            return False
+        if p_idle_time < self.health_check_idle:
+            return True
+        # Idle for a long time, a session round trip tells whether the peer is still there
+        try:
+            p_ssh_client.get_transport().open_session(timeout=self.connect_timeout).close()
+            return True
+        except Exception:
+            return False
+
+    def _connect(self, p_host_ip):
+        ssh_client = paramiko.SSHClient()
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            with utils_metrics.timer('proc_ops_ssh_phase_seconds', phase='connect'):
+                ssh_client.connect(hostname=p_host_ip, port=self.port, username=self.username, password=self.password,
+                                   timeout=self.connect_timeout, banner_timeout=self.connect_timeout, auth_timeout=self.connect_timeout)
+        except Exception:
+            utils_metrics.inc('proc_ops_ssh_connect_failures_total', host=p_host_ip)
+            ssh_client.close()
+            raise
+        if self.keepalive_interval:
+            ssh_client.get_transport().set_keepalive(self.keepalive_interval)
+        self.logger.debug('SSHConnPool connected: [host: {}]', p_host_ip)
+        return ssh_client
+
+    def _pop_expired_locked(self, p_now):
+        expired = []
+        for cur_host_ip in list(self._idle):
+            entries = self._idle[cur_host_ip]
+            expired.extend(cur_client for cur_client, cur_last_used in entries if p_now - cur_last_used >= self.idle_timeout)
+            entries[:] = [cur_entry for cur_entry in entries if p_now - cur_entry[1] < self.idle_timeout]
+            if not entries:
+                del self._idle[cur_host_ip]
+        self._conn_cnt -= len(expired)
+        return expired
+
+    def _pop_lru_locked(self):
+        lru_host_ip, lru_last_used = None, None
+        for cur_host_ip, cur_entries in self._idle.items():
+            if (lru_last_used is None) or (cur_entries[0][1] < lru_last_used):
+                lru_host_ip, lru_last_used = cur_host_ip, cur_entries[0][1]
+        if lru_host_ip is None:
+            return None
+        ssh_client, _ = self._idle[lru_host_ip].pop(0)
+        if not self._idle[lru_host_ip]:
+            del self._idle[lru_host_ip]
+        self._conn_cnt -= 1
+        return ssh_client
+
+    def acquire(self, p_host_ip):
+        to_close = []
+        entry = None
+        with self._cond:
+            now = time.monotonic()
+            to_close.extend(self._pop_expired_locked(now))
+            if self._idle.get(p_host_ip):
+                entry = self._idle[p_host_ip].pop()
+                if not self._idle[p_host_ip]:
+                    del self._idle[p_host_ip]
+            else:
+                deadline = now + self.acquire_timeout
+                while self._conn_cnt >= self.max_conns:
+                    lru_client = self._pop_lru_locked()
+                    if lru_client is not None:
+                        to_close.append(lru_client)
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if (remaining <= 0) or (not self._cond.wait(remaining)):
+                        raise TimeoutError(f'SSHConnPool exhausted: [max_conns: {self.max_conns}], [host: {p_host_ip}]')
+                self._conn_cnt += 1
+
+        for cur_client in to_close:
+            cur_client.close()
+
+        # The slot is reserved from here, either reuse the idle client or replace it
+        if entry is not None:
+            ssh_client, last_used = entry
+            if self._is_healthy(ssh_client, time.monotonic() - last_used):
+                utils_metrics.inc('proc_ops_ssh_pool_acquire_total', pool=self.name, result='reused')
+                return ssh_client
+            self.logger.debug('SSHConnPool broken transport, reconnect: [host: {}]', p_host_ip)
+            ssh_client.close()
+        try:
+            ssh_client = self._connect(p_host_ip)
+            utils_metrics.inc('proc_ops_ssh_pool_acquire_total', pool=self.name, result='connected')
+            return ssh_client
+        except Exception:
+            with self._cond:
+                self._conn_cnt -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, p_host_ip, p_ssh_client, p_broken=False):
+        keep = (not p_broken) and self._is_active(p_ssh_client)
+        with self._cond:
+            if keep:
+                self._idle.setdefault(p_host_ip, []).append((p_ssh_client, time.monotonic()))
+            else:
+                self._conn_cnt -= 1
+            self._cond.notify()
+        if not keep:
+            p_ssh_client.close()
+
+    @contextlib.contextmanager
+    def connection(self, p_host_ip):
+        ssh_client = self.acquire(p_host_ip)
+        broken, silent = False, False
+        try:
+            yield ssh_client
+        except UTILS_SSH_CMD_ERRORS:
+            # The transport may still look fine while the host does not answer, none of its connections is reused
+            broken, silent = True, True
+            raise
+        except Exception:
+            broken = not self._is_active(ssh_client)
+            raise
+        finally:
+            self.release(p_host_ip, ssh_client, broken)
+            if silent:
+                self.discard(p_host_ip)
+
+    def discard(self, p_host_ip):
+        with self._cond:
+            entries = self._idle.pop(p_host_ip, [])
+            self._conn_cnt -= len(entries)
+            self._cond.notify_all()
+        for cur_client, _ in entries:
+            cur_client.close()
+
+    def close_all(self):
+        with self._cond:
+            entries = [cur_entry for cur_entries in self._idle.values() for cur_entry in cur_entries]
+            self._idle.clear()
+            self._conn_cnt -= len(entries)
+            self._cond.notify_all()
+        for cur_client, _ in entries:
+            cur_client.close()
+
+
+class UtilsTTLCache:
+    # Per host results that stay valid for a while, shared by every module of the process through utils_result_cache,
+    # the keys starting with a shared prefix go to a store other processes see, e.g. the pid facts of proc_supervisor workers
+    def __init__(self, p_max_entries=100000):
+        self.max_entries = p_max_entries
+        self._lock = threading.Lock()
+        self._entries = {}     # (host_ip, key) -> (value, expire_at)
+        self.shared = None     # dict like store of another process, a multiprocessing.Manager dict, same layout as _entries
+        self.shared_prefixes = ()
+
+    def share(self, p_store, p_prefixes):
+        # monotonic is system wide, expire_at means the same in every process of the host
+        self.shared = p_store
+        self.shared_prefixes = tuple(p_prefixes)
+
+    def _is_shared(self, p_key):
+        return (self.shared is not None) and p_key.startswith(self.shared_prefixes)
+
+    def get(self, p_host_ip, p_key):
+        if self._is_shared(p_key):
+            # An expired entry is left for the next put to overwrite, deleting it could drop a fresher one of another process
+            try:
+                entry = self.shared.get((p_host_ip, p_key))
+            except (OSError, EOFError):
+                return None     # store gone with the supervisor, a miss
+            return entry[0] if (entry is not None) and (entry[1] > time.monotonic()) else None
+        with self._lock:
+            entry = self._entries.get((p_host_ip, p_key))
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[(p_host_ip, p_key)]
+                return None
+            return entry[0]
+
+    def put(self, p_host_ip, p_key, p_value, p_ttl):
+        if p_ttl <= 0:
+            return
+        if self._is_shared(p_key):
+            try:
+                self.shared[(p_host_ip, p_key)] = (p_value, time.monotonic() + p_ttl)
+            except (OSError, EOFError):
+                pass
+            return
+        with self._lock:
+            if ((p_host_ip, p_key) not in self._entries) and (len(self._entries) >= self.max_entries):
+                self._purge_locked()
+            self._entries[(p_host_ip, p_key)] = (p_value, time.monotonic() + p_ttl)
+
+    def invalidate(self, p_host_ip, p_key=None):
+        if self.shared is not None:
+            try:
+                if p_key is None:
+                    for cur_key in [cur_key for cur_key in self.shared.keys() if cur_key[0] == p_host_ip]:
+                        self.shared.pop(cur_key, None)
+                elif self._is_shared(p_key):
+                    self.shared.pop((p_host_ip, p_key), None)    # one round trip, a collector withdraws its fact on every bad sample
+            except (OSError, EOFError):
+                pass
+        with self._lock:
+            for cur_key in [cur_key for cur_key in self._entries if (cur_key[0] == p_host_ip) and (p_key is None or cur_key[1] == p_key)]:
+                del self._entries[cur_key]
+
+    def _purge_locked(self):
+        now = time.monotonic()
+        for cur_key in [cur_key for cur_key, cur_entry in self._entries.items() if cur_entry[1] <= now]:
+            del self._entries[cur_key]
+        # Still full, drop the oldest insertions
+        for cur_key in list(self._entries)[:max(len(self._entries) - self.max_entries + 1, 0)]:
+            del self._entries[cur_key]
+
+
+utils_result_cache = UtilsTTLCache()
+
+
+# Shard k of n owns the hosts whose crc32 falls on k, the same on every process and restart unlike the salted hash()
+UTILS_SHARD_PORT_STRIDE = 100    # shard k of a component serves its metrics on metrics_port + k * stride
+
+
+def utils_shard_of(p_host_ip, p_shard_count):
+    return zlib.crc32(p_host_ip.encode()) % p_shard_count
 
 
+def utils_shard_ips(p_ips, p_shard_index, p_shard_count):
+    if p_shard_count <= 1:
+        return list(p_ips)
+    return [cur_ip for cur_ip in p_ips if utils_shard_of(cur_ip, p_shard_count) == p_shard_index]